@@ -0,0 +1,77 @@
+"""Compares two benchmark result files.
+
+    python -m benchmarks.compare benchmarks/results/<base>.json benchmarks/results/<head>.json
+
+exits with 1 when a benchmark got slower, or a memory benchmark bigger, than
+the threshold allows.
+"""
+
+import argparse
+import json
+import sys
+
+
+def load(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(base: dict, head: dict, threshold: float) -> list[str]:
+    regressions = []
+    print(f"{'benchmark':<48} {base['commit']:>12} {head['commit']:>12} {'change':>8}")
+    for name in sorted(set(base["results"]) | set(head["results"])):
+        before = base["results"].get(name)
+        after = head["results"].get(name)
+        if before is None or after is None:
+            print(f"{name:<48} {'-' if before is None else format_result(before):>12} "
+                  f"{'-' if after is None else format_result(after):>12}")
+            continue
+        change = value(after) / value(before) - 1
+        flag = ""
+        if change > threshold:
+            flag = "  slower" if "median" in after else "  bigger"
+            regressions.append(name)
+        print(f"{name:<48} {format_result(before):>12} {format_result(after):>12} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def value(result: dict) -> float:
+    """ median seconds per call, or bytes per item of a memory benchmark """
+    return result["median"] if "median" in result else result["bytes"]
+
+
+def format_result(result: dict) -> str:
+    if "median" not in result:
+        return format_size(result["bytes"])
+    return format_time(result["median"])
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def format_size(size: float) -> str:
+    for unit, scale in (("MiB", 1 << 20), ("KiB", 1 << 10)):
+        if size >= scale:
+            return f"{size / scale:.1f}{unit}"
+    return f"{size:.0f}B"
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="compare two benchmark runs by their median timings and sizes")
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown, default 0.10")
+    args = parser.parse_args(argv)
+    regressions = compare(load(args.base), load(args.head), args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} benchmarks slower by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""Benchmark fixtures, results are written as json so commits can be compared."""
+
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from pathlib import Path
+
+import pytest
+
+RESULTS_DIR = Path(__file__).parent / "results"
+RESULTS: dict[str, dict] = {}
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmarks")
+    group.addoption("--bench-output", default=None, help="json file for the results, default benchmarks/results/<commit>.json")
+    group.addoption("--bench-rounds", type=int, default=5, help="timed rounds per benchmark")
+    group.addoption("--bench-connections", type=int, default=2000, help="idle websockets of the capacity benchmark")
+    group.addoption("--bench-memory", type=int, default=1024, help="MiB a worker may spend on websockets, for the capacity estimate")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class Bench:
+    """ times a callable over a number of rounds and records per call statistics """
+    def __init__(self, rounds: int, loop: asyncio.AbstractEventLoop) -> None:
+        self.rounds = rounds
+        self.loop = loop
+
+    def record(self, name: str, timings: list[float], number: int) -> dict:
+        result = {
+            "rounds": len(timings),
+            "number": number,
+            "mean": statistics.mean(timings),
+            "median": statistics.median(timings),
+            "min": min(timings),
+            "stddev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+            "ops_per_sec": 1 / statistics.median(timings),
+        }
+        RESULTS[name] = result
+        return result
+
+    def __call__(self, name: str, fn, number: int = 1000) -> dict:
+        fn()
+        timings = []
+        for _ in range(self.rounds):
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            timings.append((time.perf_counter() - start) / number)
+        return self.record(name, timings, number)
+
+    def size(self, name: str, total: int, count: int, **extra) -> dict:
+        """ records the memory of count items, compared by bytes per item """
+        result = {"count": count, "bytes": total / count, **extra}
+        RESULTS[name] = result
+        return result
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def measure(self, name: str, factory, number: int = 100) -> dict:
+        """ like calling the bench, for a coroutine function """
+        async def timed() -> list[float]:
+            await factory()
+            timings = []
+            for _ in range(self.rounds):
+                start = time.perf_counter()
+                for _ in range(number):
+                    await factory()
+                timings.append((time.perf_counter() - start) / number)
+            return timings
+
+        return self.record(name, self.run(timed()), number)
+
+
+@pytest.fixture
+def bench(request):
+    loop = asyncio.new_event_loop()
+    try:
+        yield Bench(request.config.getoption("--bench-rounds"), loop)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if not RESULTS:
+        return
+    commit = git_commit()
+    output = session.config.getoption("--bench-output")
+    path = Path(output) if output else RESULTS_DIR / f"{commit}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({
+        "commit": commit,
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": RESULTS,
+    }, indent=2, sort_keys=True))
+    print(f"\nbenchmark results written to {path}")
@@ -0,0 +1,163 @@
+"""In-process LNbits stub, served through an httpx mock transport."""
+
+import asyncio
+import hashlib
+import json
+import itertools
+
+import httpx
+
+from webapp.breaker import Breakers
+from webapp.cache import SingleFlightCache
+from webapp.database import Database
+from webapp.http import HttpClient
+from webapp.metrics import Metrics
+from webapp.models import UserPrincipal
+from webapp.ratelimit import Admission, RateLimiter
+from webapp.repositories import PaymentRepository, UserRepository
+from webapp.serializer import create_serializer
+from webapp.services.connections import ConnectionRegistry
+from webapp.services.eventbus import LocalEventBus
+from webapp.services.ledger import LedgerService
+from webapp.services.lnbits import LnbitsService
+from webapp.services.sse import SSEDispatcher, SSEHub, SSEService
+from webapp.services.wallet import WalletService
+from webapp.services.websocket import WebSocketDispatcher, WebSocketService
+
+STUB_URL = "http://lnbits.stub"
+
+
+def payment(index: int, wallet_id: str = "wallet", amount: int = 21_000) -> dict:
+    payment_hash = hashlib.sha256(f"{wallet_id}:{index}".encode()).hexdigest()
+    return {
+        "checking_id": payment_hash,
+        "pending": False,
+        "amount": amount if index % 3 else -amount,
+        "fee": 0 if index % 3 else -1000,
+        "memo": f"payment number {index}",
+        "time": 1_660_000_000 + index * 60,
+        "bolt11": "lnbc210n1" + payment_hash * 4,
+        "preimage": hashlib.sha256(payment_hash.encode()).hexdigest(),
+        "payment_hash": payment_hash,
+        "expiry": 1_660_000_000 + index * 60 + 3600,
+        "extra": {"tag": "lnurlp", "link": "abcdef", "comment": "thanks!"},
+        "wallet_id": wallet_id,
+        "webhook": None,
+        "webhook_status": None,
+    }
+
+
+def payments(count: int, wallet_id: str = "wallet") -> list[dict]:
+    """ newest first, like /api/v1/payments """
+    return [payment(index, wallet_id) for index in reversed(range(count))]
+
+
+class StubLnbits:
+    """ answers the lnbits endpoints the services use, without any network """
+    def __init__(self, history: int = 500) -> None:
+        self.history = payments(history)
+        self._invoices = itertools.count()
+        self.requests = 0
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        path = request.url.path
+        if path == "/api/v1/payments" and request.method == "GET":
+            limit = request.url.params.get("limit")
+            offset = int(request.url.params.get("offset") or 0)
+            data = self.history[offset:offset + int(limit)] if limit else self.history
+            return httpx.Response(200, json=data)
+        if path == "/api/v1/payments" and request.method == "POST":
+            body = json.loads(request.content)
+            if "bolt11" in body:
+                return httpx.Response(201, json={"payment_hash": "00" * 32})
+            payment_hash = hashlib.sha256(str(next(self._invoices)).encode()).hexdigest()
+            return httpx.Response(201, json={
+                "payment_hash": payment_hash,
+                "payment_request": "lnbc1" + payment_hash,
+                "checking_id": payment_hash,
+            })
+        if path == "/api/v1/payments/decode":
+            return httpx.Response(200, json={
+                "payment_hash": "11" * 32,
+                "amount_msat": 21_000,
+                "description": "stub invoice",
+                "payee": "02" + "33" * 32,
+                "date": 1_660_000_000,
+                "expiry": 3600,
+            })
+        if path == "/api/v1/wallet":
+            return httpx.Response(200, json={"id": "wallet", "name": "stub", "balance": 21_000_000})
+        return httpx.Response(404, json={"detail": "not found"})
+
+
+class StubHttpClient(HttpClient):
+    """ the shared http client, with its transport replaced by the stub """
+    def __init__(self, stub: StubLnbits) -> None:
+        super().__init__()
+        self._stub = stub
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(transport=httpx.MockTransport(self._stub.handle))
+        return self._client
+
+
+class Stack:
+    """ the services behind the websocket, wired like the container does, on in-memory sqlite """
+    def __init__(self, history: int = 500, db_url: str = "sqlite:///:memory:") -> None:
+        self.lnbits = StubLnbits(history)
+        self.http = StubHttpClient(self.lnbits)
+        self.serializer = create_serializer()
+        self.metrics = Metrics()
+        self.database = Database(db_url)
+        self.event_bus = LocalEventBus()
+        self.users = UserRepository(session_factory=self.database.session)
+        self.payments = PaymentRepository(session_factory=self.database.session)
+        self.lnbits_service = LnbitsService(
+            {"lnbits": {"url": STUB_URL}}, self.http, self.serializer, self.metrics, SingleFlightCache(), Breakers(),
+        )
+        self.sse_hub = SSEHub(STUB_URL, self.event_bus, self.serializer, self.metrics)
+        self.ledger = LedgerService(
+            self.payments, self.users, self.lnbits_service, self.serializer, self.sse_hub, self.event_bus,
+        )
+        self.wallet = WalletService(self.ledger, self.payments)
+        # the default rule covers pings, it is checked on every one but never hit
+        unlimited = {"default": {"rate": 1e9, "burst": 1e9}}
+        self.rate_limiter = RateLimiter(self.metrics, user=unlimited, ip=unlimited)
+        self.admission = Admission(self.metrics, max_upstream=1_000_000)
+        self.dispatcher = WebSocketDispatcher(self.lnbits_service, self.wallet, self.metrics, self.admission)
+        self.registry = ConnectionRegistry(self.event_bus, self.serializer, self.metrics)
+        self.websocket_service = WebSocketService(self.dispatcher, self.serializer, self.metrics, self.rate_limiter)
+        self.sse_service = SSEService(self.sse_hub, SSEDispatcher(), self.registry)
+
+    async def start(self) -> "Stack":
+        await self.database.create_database()
+        return self
+
+    async def close(self) -> None:
+        # passes started by invalidate() run detached from the benchmarked calls, and may queue a follow-up
+        while True:
+            await asyncio.sleep(0)
+            if not self.ledger._syncing:
+                break
+            await asyncio.gather(*self.ledger._syncing.values(), return_exceptions=True)
+        await self.ledger.close()
+        self.sse_hub.close()
+        await self.http.close()
+        await self.database.dispose()
+
+
+def principal(index: int = 0) -> UserPrincipal:
+    return UserPrincipal(
+        id=index,
+        username=f"user{index}",
+        is_active=True,
+        usr=f"usr{index}",
+        wallet_id="wallet",
+        api_key=f"key{index}",
+        lnurlp="lnurlp",
+        lnurlw="lnurlw",
+        tpos="tpos",
+    )
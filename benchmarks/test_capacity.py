@@ -0,0 +1,185 @@
+"""Websockets per worker: memory of an idle connection and the cost of waking all of them.
+
+connections run through the real /ws endpoint against stand-in sockets. the
+memory is the app's state per connection, uvicorn's own buffers and the
+upstream sse sockets come on top.
+"""
+
+import asyncio
+import gc
+import tracemalloc
+
+import pytest
+
+from benchmarks.stub import Stack, principal
+from webapp.endpoints.websocket import websocket_endpoint
+from webapp.services.sse import SSEStream
+
+
+class Replies:
+    """ counts frames sent to all sockets, wakes the waiter at the target """
+    def __init__(self) -> None:
+        self.count = 0
+        self.target = 0
+        self.done: asyncio.Future | None = None
+
+    def expect(self, count: int) -> asyncio.Future:
+        self.count = 0
+        self.target = count
+        self.done = asyncio.get_running_loop().create_future()
+        return self.done
+
+    def sent(self) -> None:
+        self.count += 1
+        if self.count >= self.target and self.done and not self.done.done():
+            self.done.set_result(None)
+
+
+class IdleSocket:
+    """ stands in for a starlette websocket, frames are fed through a queue """
+    client = None
+
+    def __init__(self, replies: Replies) -> None:
+        self.frames: asyncio.Queue = asyncio.Queue()
+        self.replies = replies
+
+    async def accept(self) -> None:
+        pass
+
+    async def iter_text(self):
+        while True:
+            text = await self.frames.get()
+            if text is None:
+                return
+            yield text
+
+    async def send_text(self, _: str) -> None:
+        self.replies.sent()
+
+    async def close(self, _: int = 1000) -> None:
+        self.frames.put_nowait(None)
+
+
+class Logins:
+    def __init__(self, users: dict) -> None:
+        self.users = users
+
+    async def user(self, token: str):
+        return self.users[token]
+
+
+@pytest.fixture
+def stack(bench, monkeypatch):
+    # the upstream sse sockets are not what is measured here
+    monkeypatch.setattr(SSEStream, "start", lambda self: None)
+    stack = bench.run(Stack(history=10).start())
+    yield stack
+    bench.run(stack.close())
+
+
+@pytest.fixture
+def connections(request):
+    return request.config.getoption("--bench-connections")
+
+
+def open_all(stack: Stack, sockets: list[IdleSocket], logins: Logins) -> list[asyncio.Task]:
+    return [
+        asyncio.create_task(websocket_endpoint(
+            websocket=socket,
+            access_token=f"token{index}",
+            websocket_service=stack.websocket_service,
+            login_service=logins,
+            sse_service=stack.sse_service,
+            connection_registry=stack.registry,
+            admission=stack.admission,
+        ))
+        for index, socket in enumerate(sockets)
+    ]
+
+
+async def settle(stack: Stack, count: int) -> None:
+    while len(stack.registry) < count:
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+async def close_all(stack: Stack, tasks: list[asyncio.Task]) -> None:
+    await stack.registry.close_all()
+    await asyncio.gather(*tasks)
+
+
+def test_idle_connection_memory(bench, stack, connections, request):
+    replies = Replies()
+    logins = Logins({f"token{index}": principal(index) for index in range(connections)})
+    sockets = [IdleSocket(replies) for _ in range(connections)]
+
+    async def measure() -> tuple[int, int]:
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tasks_before = len(asyncio.all_tasks())
+        tasks = open_all(stack, sockets, logins)
+        await settle(stack, connections)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tasks_used = len(asyncio.all_tasks()) - tasks_before
+        tracemalloc.stop()
+        await close_all(stack, tasks)
+        return used, tasks_used
+
+    used, tasks = bench.run(measure())
+    budget = request.config.getoption("--bench-memory") << 20
+    result = bench.size(
+        "capacity.idle_connection", used, connections,
+        tasks=tasks / connections, max_connections=int(budget // (used / connections)),
+    )
+    print(f"\n{result['bytes']:.0f} bytes and {result['tasks']:.0f} tasks per idle websocket, "
+          f"{result['max_connections']} fit in {budget >> 20}MiB")
+    assert len(stack.registry) == 0
+
+
+def test_wake_all(bench, stack, connections):
+    """ every connection sends a ping and waits for its pong, one round per call """
+    replies = Replies()
+    logins = Logins({f"token{index}": principal(index) for index in range(connections)})
+    sockets = [IdleSocket(replies) for _ in range(connections)]
+    tasks = []
+
+    async def start() -> None:
+        tasks.extend(open_all(stack, sockets, logins))
+        await settle(stack, connections)
+
+    async def ping_all() -> None:
+        done = replies.expect(len(sockets))
+        for socket in sockets:
+            socket.frames.put_nowait('{"type": "ping"}')
+        await done
+
+    bench.run(start())
+    bench.measure(f"capacity.ping_all.{connections}", ping_all, number=3)
+    bench.run(close_all(stack, tasks))
+
+
+def test_sse_fanout(bench, stack, connections):
+    """ a payment event reaching every connection through the hub """
+    replies = Replies()
+    logins = Logins({f"token{index}": principal(index) for index in range(connections)})
+    sockets = [IdleSocket(replies) for _ in range(connections)]
+    tasks = []
+    serial = iter(range(1_000_000))
+
+    async def start() -> None:
+        tasks.extend(open_all(stack, sockets, logins))
+        await settle(stack, connections)
+
+    async def publish_all() -> None:
+        done = replies.expect(len(sockets))
+        # a new payment hash each round, the registry drops repeated deliveries
+        event = {"event": "payment-received", "data": {"payment_hash": f"hash{next(serial)}"}}
+        for stream in stack.sse_hub.streams.values():
+            stream.emit(event)
+        await done
+
+    bench.run(start())
+    bench.measure(f"capacity.sse_fanout.{connections}", publish_all, number=3)
+    bench.run(close_all(stack, tasks))
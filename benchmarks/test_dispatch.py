@@ -0,0 +1,63 @@
+"""WebSocketDispatcher.dispatch throughput, lnbits answered by the in-process stub."""
+
+import pytest
+
+from benchmarks.stub import Stack, principal
+
+
+@pytest.fixture
+def stack(bench):
+    stack = bench.run(Stack(history=200).start())
+    yield stack
+    bench.run(stack.close())
+
+
+def test_dispatch_ping(bench, stack):
+    user = principal()
+    bench.measure("dispatch.ping", lambda: stack.dispatcher.dispatch(user, "ping", None), number=2000)
+
+
+def test_dispatch_unhandled(bench, stack):
+    user = principal()
+    bench.measure("dispatch.unhandled", lambda: stack.dispatcher.dispatch(user, "nope", {}), number=2000)
+
+
+def test_dispatch_invalid_payload(bench, stack):
+    user = principal()
+    bench.measure("dispatch.invalid", lambda: stack.dispatcher.dispatch(user, "create_invoice", {"amount": "x"}), number=1000)
+
+
+def test_dispatch_invoice(bench, stack):
+    user = principal()
+    data = {"bolt11": "lnbc210n1stub"}
+    result = bench.run(stack.dispatcher.dispatch(user, "invoice", data))
+    assert result["type"] == "invoice"
+    bench.measure("dispatch.invoice", lambda: stack.dispatcher.dispatch(user, "invoice", data), number=300)
+
+
+def test_dispatch_create_invoice(bench, stack):
+    user = principal()
+    data = {"amount": 21, "description": "bench"}
+    result = bench.run(stack.dispatcher.dispatch(user, "create_invoice", data))
+    assert result["type"] == "create_invoice"
+    bench.measure("dispatch.create_invoice", lambda: stack.dispatcher.dispatch(user, "create_invoice", data), number=300)
+
+
+def test_dispatch_user(bench, stack):
+    user = principal()
+    result = bench.run(stack.dispatcher.dispatch(user, "user", {}))
+    assert result["data"]["delta"] is False
+    bench.measure("dispatch.user.full", lambda: stack.dispatcher.dispatch(user, "user", {}), number=50)
+
+
+def test_dispatch_user_delta(bench, stack):
+    user = principal()
+    result = bench.run(stack.dispatcher.dispatch(user, "user", {}))
+    cursor = result["data"]["cursor"]
+    bench.measure("dispatch.user.delta", lambda: stack.dispatcher.dispatch(user, "user", {"cursor": cursor}), number=300)
+
+
+def test_dispatch_payments_page(bench, stack):
+    user = principal()
+    bench.run(stack.dispatcher.dispatch(user, "user", {}))
+    bench.measure("dispatch.payments.page", lambda: stack.dispatcher.dispatch(user, "payments", {"limit": 50}), number=200)
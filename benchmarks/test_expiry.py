@@ -0,0 +1,90 @@
+"""Instance expiry: a window load of the scheduler against the full table scan it replaced.
+
+the table holds far more instances destroyed or disabled in the past than
+running ones, the window load must not grow with them.
+"""
+
+import time
+
+import pytest
+from sqlalchemy import insert, select
+
+from webapp.database import Database
+from webapp.models import Instance
+from webapp.repositories import InstanceRepository
+from webapp.services.eventbus import LocalEventBus
+from webapp.services.expiry import ExpiryScheduler
+
+INSTANCES = 20_000
+# instances stopping within the next window
+DUE = 50
+# instances destroyed long ago, and disabled ones waiting for their destroy
+DESTROYED = 200_000
+DISABLED = 2_000
+DESTROY_TIME = 1_296_000
+WINDOW = 3600
+
+
+@pytest.fixture
+def scheduler(bench, tmp_path):
+    database = Database(f"sqlite:///{tmp_path / 'bench.db'}")
+    now = int(time.time())
+
+    async def populate():
+        await database.create_database()
+        running = [{
+            "instance_id": f"instance{index}",
+            "user": f"user{index}",
+            "enabled": True,
+            # most running instances stop in months, a few within the window
+            "timestamp_stop": now + (WINDOW // 2 if index < DUE else 90 * 86400 + index),
+        } for index in range(INSTANCES)]
+        destroyed = [{
+            "instance_id": f"destroyed{index}",
+            "user": f"user{index}",
+            "enabled": False,
+            "timestamp_stop": now - DESTROY_TIME - 86400 - index,
+            "action": "destroy",
+        } for index in range(DESTROYED)]
+        disabled = [{
+            "instance_id": f"disabled{index}",
+            "user": f"user{index}",
+            "enabled": False,
+            "timestamp_stop": now - 86400 - index,
+            "action": "disable",
+        } for index in range(DISABLED)]
+        async with database.session() as session:
+            for rows in (running, destroyed, disabled):
+                await session.execute(insert(Instance), rows)
+            await session.commit()
+
+    bench.run(populate())
+    yield ExpiryScheduler(InstanceRepository(database.session), LocalEventBus(), DESTROY_TIME, WINDOW)
+    bench.run(database.dispose())
+
+
+def test_window_load(bench, scheduler):
+    now = time.time()
+    bench.measure("expiry.load_window", lambda: scheduler.load(now), number=50)
+    assert scheduler.last_load == DUE
+
+
+def test_full_scan(bench, scheduler):
+    """ what every tick of the polling loop read before """
+    async def scan():
+        async with scheduler._instances.session_factory() as session:
+            result = await session.execute(select(Instance))
+            return result.scalars().all()
+
+    bench.measure("expiry.full_scan", scan, number=2)
+
+
+def test_apply_due(bench, scheduler):
+    """ all instances of the window stop at once, one update disables them """
+    applied = []
+    scheduler.observe(lambda action, instance_ids: applied.extend(instance_ids))
+    now = time.time()
+    bench.run(scheduler.load(now))
+    assert bench.run(scheduler.apply_due(now + WINDOW)) == DUE
+    assert sorted(applied) == sorted(f"instance{index}" for index in range(DUE))
+    assert bench.run(scheduler.apply_due(now + WINDOW)) == 0
@@ -0,0 +1,34 @@
+"""Serialization of large payment lists, the user and payments replies."""
+
+import pytest
+
+from benchmarks.stub import payments
+from webapp.serializer import RawJSON, create_serializer
+
+COUNT = 1000
+
+
+@pytest.fixture(params=["json", "orjson"])
+def serializer(request):
+    serializer = create_serializer(request.param)
+    if serializer.name != request.param:
+        pytest.skip(f"{request.param} is not installed")
+    return serializer
+
+
+def test_dumps_payments(bench, serializer):
+    reply = {"type": "user", "data": {"balance": 21.0, "payments": payments(COUNT)}}
+    bench(f"json.dumps.payments.{serializer.name}", lambda: serializer.dumps_text(reply), number=20)
+
+
+def test_dumps_raw_payments(bench, serializer):
+    """ the ledger keeps every payment encoded, replies splice them in """
+    rows = [serializer.dumps(item) for item in payments(COUNT)]
+    reply = {"type": "user", "data": {"balance": 21.0, "payments": RawJSON(b"[" + b",".join(rows) + b"]")}}
+    assert serializer.loads(serializer.dumps(reply))["data"]["payments"][0]["memo"] == f"payment number {COUNT - 1}"
+    bench(f"json.dumps.raw_payments.{serializer.name}", lambda: serializer.dumps_text(reply), number=50)
+
+
+def test_loads_payments(bench, serializer):
+    body = serializer.dumps(payments(COUNT))
+    bench(f"json.loads.payments.{serializer.name}", lambda: serializer.loads(body), number=20)
@@ -0,0 +1,57 @@
+"""bcrypt cost of a login, hashing runs in the PasswordHasher pool."""
+
+import asyncio
+
+import pytest
+from bcrypt import gensalt, hashpw
+
+from benchmarks.stub import Stack
+from webapp.cache import TTLCache
+from webapp.models import User
+from webapp.services.hashing import PasswordHasher
+from webapp.services.user import UserService
+
+PASSWORD = "correct horse battery staple"
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(pool_size=2)
+    yield hasher
+    hasher.close()
+
+
+@pytest.mark.parametrize("rounds", [4, 10, 12])
+def test_verify(bench, hasher, rounds):
+    """ 12 rounds is the bcrypt default the app hashes with """
+    hashed = hashpw(PASSWORD.encode(), gensalt(rounds))
+    number = 50 if rounds <= 4 else 3
+    bench.measure(f"login.verify.rounds{rounds}", lambda: hasher.verify(PASSWORD, hashed), number=number)
+
+
+def test_verify_concurrent(bench, hasher):
+    """ logins queued onto the pool at once, reported per login """
+    hashed = hashpw(PASSWORD.encode(), gensalt(10))
+    burst = 8
+
+    async def logins():
+        await asyncio.gather(*(hasher.verify(PASSWORD, hashed) for _ in range(burst)))
+
+    result = bench.measure("login.verify.burst8.rounds10", logins, number=1)
+    result["per_login"] = result["median"] / burst
+
+
+def test_user_service_login(bench, hasher):
+    stack = bench.run(Stack(history=0).start())
+    service = UserService(stack.users, stack.lnbits_service, hasher, TTLCache())
+
+    async def populate():
+        async with stack.database.session() as session:
+            session.add(User(username="alice", hashed_password=hashpw(PASSWORD.encode(), gensalt(10)).decode(), is_active=True))
+            await session.commit()
+
+    try:
+        bench.run(populate())
+        bench.measure("login.user_service.rounds10", lambda: service.login("alice", PASSWORD), number=3)
+    finally:
+        bench.run(stack.close())
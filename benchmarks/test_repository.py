@@ -0,0 +1,57 @@
+"""UserRepository lookups and payment history reads under SQLite."""
+
+import pytest
+
+from benchmarks.stub import Stack, principal
+from webapp.models import User
+
+USERS = 1000
+
+
+@pytest.fixture
+def stack(bench, tmp_path):
+    # a file database, so WAL and the connection pool are part of the measurement
+    stack = bench.run(Stack(history=500, db_url=f"sqlite:///{tmp_path / 'bench.db'}").start())
+
+    async def populate():
+        async with stack.database.session() as session:
+            session.add_all(User(
+                username=f"user{index}",
+                hashed_password="x",
+                is_active=True,
+                usr=f"usr{index}",
+                wallet_id=f"wallet{index}",
+                api_key=f"key{index}",
+            ) for index in range(USERS))
+            await session.commit()
+
+    bench.run(populate())
+    yield stack
+    bench.run(stack.close())
+
+
+def test_get_by_username(bench, stack):
+    usernames = [f"user{index}" for index in range(0, USERS, 7)]
+    state = {"index": 0}
+
+    def lookup():
+        state["index"] += 1
+        return stack.users.get_by_username(usernames[state["index"] % len(usernames)])
+
+    bench.measure("repository.get_by_username", lookup, number=500)
+
+
+def test_find_missing_username(bench, stack):
+    bench.measure("repository.find_by_username.missing", lambda: stack.users.find_by_username("nobody"), number=500)
+
+
+def test_payments_list(bench, stack):
+    user = principal()
+    bench.run(stack.ledger.ensure_synced(user))
+    bench.measure("repository.payments.list.50", lambda: stack.payments.list(user.wallet_id, limit=50), number=200)
+
+
+def test_payments_balance(bench, stack):
+    user = principal()
+    bench.run(stack.ledger.ensure_synced(user))
+    bench.measure("repository.payments.balance", lambda: stack.payments.balance(user.wallet_id), number=200)
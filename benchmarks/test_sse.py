@@ -0,0 +1,61 @@
+"""SSEStream.process_sse over a recorded lnbits payment stream."""
+
+import asyncio
+import json
+
+import pytest
+
+from benchmarks.stub import payment
+from webapp.serializer import create_serializer
+from webapp.services.sse import SSEStream
+
+EVENTS = 500
+
+
+def recording(events: int = EVENTS) -> bytes:
+    """ the body lnbits sends, payments interleaved with pings """
+    body = []
+    for index in range(events):
+        if index % 10 == 0:
+            body.append(b": ping\n\n")
+        body.append(b"event: payment-received\n")
+        body.append(b"data: " + json.dumps(payment(index)).encode() + b"\n\n")
+    return b"".join(body)
+
+
+def chunked(body: bytes, size: int) -> bytes:
+    """ http/1.1 chunked framing, as it comes off the socket """
+    out = []
+    for start in range(0, len(body), size):
+        chunk = body[start:start + size]
+        out.append(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+    out.append(b"0\r\n\r\n")
+    return b"".join(out)
+
+
+async def drain(stream: SSEStream, data: bytes) -> int:
+    stream.reader = asyncio.StreamReader(limit=2 ** 20)
+    stream.reader.feed_data(data)
+    stream.reader.feed_eof()
+    stream.parser.reset()
+    received = 0
+    try:
+        while True:
+            received += len(await stream.process_sse())
+    except ConnectionError:
+        return received
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+@pytest.mark.parametrize("framing,size", [("identity", 65536), ("chunked", 512), ("chunked", 4096)])
+def test_process_sse(bench, backend, framing, size):
+    serializer = create_serializer(backend)
+    if serializer.name != backend:
+        pytest.skip(f"{backend} is not installed")
+    stream = SSEStream("http://lnbits.stub", queue_size=100, loads=serializer.loads)
+    body = recording()
+    stream.chunked = framing == "chunked"
+    data = chunked(body, size) if stream.chunked else body
+    assert bench.run(drain(stream, data)) == EVENTS
+    result = bench.measure(f"sse.process_sse.{framing}.{size}.{backend}", lambda: drain(stream, data), number=5)
+    result["events_per_sec"] = EVENTS * result["ops_per_sec"]
@@ -0,0 +1,39 @@
+"""Test fixtures, the services run against the lnbits stub of the benchmarks on in-memory sqlite."""
+
+import asyncio
+
+import pytest
+
+from benchmarks.stub import Stack
+
+
+@pytest.fixture
+def run():
+    """ runs a coroutine to completion, on a loop kept for the whole test """
+    loop = asyncio.new_event_loop()
+    try:
+        yield loop.run_until_complete
+    finally:
+        # tasks a test cancelled on its way out still have to unwind
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+@pytest.fixture
+def stack(run):
+    stack = run(Stack(history=0).start())
+    yield stack
+    run(stack.close())
+
+
+@pytest.fixture
+def file_stack(run, tmp_path):
+    """ like stack on a sqlite file, in-memory sqlite shares one connection between all sessions """
+    stack = run(Stack(history=0, db_url=f"sqlite:///{tmp_path / 'webapp.db'}").start())
+    yield stack
+    run(stack.close())
@@ -0,0 +1,18 @@
+"""Application lifecycle: shutdown closes only what the worker built."""
+
+from pathlib import Path
+
+from webapp.application import create_app
+from webapp.containers import Container
+
+
+def test_shutdown_closes_only_built_singletons(run, tmp_path):
+    container = Container()
+    container.config.from_yaml(Path(__file__).parents[1] / "config.template.yml")
+    container.config.from_dict({"db": {"url": f"sqlite+aiosqlite:///{tmp_path}/app.db"}})
+    app = create_app(container)
+    container.db()
+    run(app.router.shutdown())
+    assert container.db.built
+    for singleton in (container.password_hasher, container.sse_hub, container.http_client, container.event_bus):
+        assert not singleton.built
@@ -0,0 +1,148 @@
+"""CircuitBreaker and LnbitsService._hedge: how lnbits and lnurl hosts failing is handled."""
+
+import asyncio
+
+import httpx
+import pytest
+
+from benchmarks.stub import STUB_URL, StubHttpClient
+from webapp import breaker as breaker_module
+from webapp.breaker import Breakers, CircuitBreaker, CircuitOpen
+from webapp.cache import SingleFlightCache
+from webapp.metrics import Metrics
+from webapp.serializer import create_serializer
+from webapp.services.lnbits import LnbitsService
+
+WALLET = f"{STUB_URL}/api/v1/wallet"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(breaker_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_opens_after_threshold_failures(clock):
+    breaker = CircuitBreaker("lnbits", threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.acquire()
+        breaker.failure()
+    breaker.acquire()
+    breaker.success()
+    # only failures in a row count
+    for _ in range(3):
+        breaker.acquire()
+        breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.acquire()
+    assert breaker.rejected == 1 and breaker.trips == 1
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker("lnbits", threshold=1, reset_timeout=30)
+    breaker.acquire()
+    breaker.failure()
+    clock[0] += 31
+    breaker.acquire()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.acquire()
+    # a failed probe opens it for another reset_timeout
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN and breaker.trips == 2
+    clock[0] += 31
+    breaker.acquire()
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.acquire()
+    breaker.acquire()
+
+
+def test_abandoned_probe_frees_the_slot(clock):
+    breaker = CircuitBreaker("lnbits", threshold=1, reset_timeout=30)
+    breaker.acquire()
+    breaker.failure()
+    clock[0] += 31
+    breaker.acquire()
+    breaker.release()
+    breaker.acquire()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_healthy_hosts_are_pruned():
+    breakers = Breakers(threshold=1, maxsize=2)
+    breakers.get("down.example").failure()
+    breakers.get("up.example")
+    breakers.get("new.example")
+    assert set(breakers.stats()) == {"down.example"}
+    assert breakers.open() == 1
+    assert "up.example" not in breakers._breakers
+
+
+class Upstream:
+    """ answers each request after the delay and with the status of its turn """
+    def __init__(self, *turns: tuple[float, int]) -> None:
+        self.turns = list(turns)
+        self.requests = 0
+        self.cancelled = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        delay, status = self.turns[min(self.requests, len(self.turns) - 1)]
+        self.requests += 1
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return httpx.Response(status, json={"turn": self.requests})
+
+
+def send(run, upstream: Upstream, hedges: int = 1, breakers: Breakers | None = None):
+    http = StubHttpClient(upstream)  # type: ignore
+    config = {"lnbits": {"url": STUB_URL, "hedges": hedges, "hedge_delay": 0.05}}
+    service = LnbitsService(config, http, create_serializer(), Metrics(), SingleFlightCache(), breakers or Breakers())
+
+    async def request():
+        try:
+            return await service._send("GET /api/v1/wallet", "GET", WALLET, hedge=True)
+        finally:
+            await asyncio.sleep(0)
+            await http.close()
+
+    return run(request())
+
+
+def test_fast_answer_sends_one_request(run):
+    upstream = Upstream((0, 200))
+    assert send(run, upstream).status_code == 200
+    assert upstream.requests == 1
+
+
+def test_slow_attempt_is_hedged(run):
+    upstream = Upstream((1, 200), (0, 200))
+    response = send(run, upstream)
+    assert response.json() == {"turn": 2}
+    assert upstream.requests == 2 and upstream.cancelled == 1
+
+
+def test_failed_attempt_is_retried(run):
+    upstream = Upstream((0, 503), (0, 200))
+    assert send(run, upstream).status_code == 200
+    assert upstream.requests == 2
+
+
+def test_last_failure_is_returned(run):
+    upstream = Upstream((0, 503))
+    assert send(run, upstream, hedges=2).status_code == 503
+    assert upstream.requests == 3
+
+
+def test_open_circuit_is_not_hedged(run):
+    breakers = Breakers(threshold=1)
+    breakers.get(httpx.URL(WALLET).netloc.decode("ascii")).failure()
+    upstream = Upstream((0, 200))
+    with pytest.raises(CircuitOpen):
+        send(run, upstream, hedges=3, breakers=breakers)
+    assert upstream.requests == 0
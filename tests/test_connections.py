@@ -0,0 +1,49 @@
+"""ConnectionRegistry: pushes of the same payment from sse and the webhook."""
+
+from benchmarks.stub import principal
+from webapp.metrics import Metrics
+from webapp.serializer import create_serializer
+from webapp.services.connections import ConnectionRegistry
+from webapp.services.eventbus import LocalEventBus
+
+
+class Socket:
+    client = None
+
+    def __init__(self) -> None:
+        self.sent: list[str] = []
+
+    async def send_text(self, text: str) -> None:
+        self.sent.append(text)
+
+
+def received(pending: bool, payment_hash: str = "ab" * 32) -> dict:
+    return {"type": "payment_received", "data": {"payment_hash": payment_hash, "pending": pending}}
+
+
+def test_confirmation_follows_webhook_stand_in(run):
+    registry = ConnectionRegistry(LocalEventBus(), create_serializer(), Metrics())
+    socket = Socket()
+    connection = registry.add(principal(), socket)
+    for message in (received(True), received(True), received(False), received(False), received(True)):
+        run(registry.send(connection, message))
+    assert [text.count('"pending":true') for text in socket.sent] == [1, 0]
+
+
+def test_confirmation_first_hides_stand_in(run):
+    registry = ConnectionRegistry(LocalEventBus(), create_serializer(), Metrics())
+    socket = Socket()
+    connection = registry.add(principal(), socket)
+    run(registry.send(connection, received(False)))
+    run(registry.send(connection, received(True)))
+    assert len(socket.sent) == 1
+
+
+def test_each_socket_hears_of_a_payment(run):
+    registry = ConnectionRegistry(LocalEventBus(), create_serializer(), Metrics())
+    sockets = [Socket(), Socket()]
+    for socket in sockets:
+        registry.add(principal(), socket)
+    assert run(registry.broadcast(principal().username, received(False))) == 2
+    assert run(registry.broadcast(principal().username, received(False))) == 2
+    assert [len(socket.sent) for socket in sockets] == [1, 1]
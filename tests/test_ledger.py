@@ -0,0 +1,191 @@
+"""LedgerService: reconciliation passes against the lnbits stub."""
+
+import asyncio
+import json
+
+from benchmarks.stub import payment, principal
+
+
+def pending(index: int, amount: int) -> dict:
+    return {**payment(index, amount=amount), "pending": True}
+
+
+def test_full_pass_drops_failed_payments(run, stack):
+    user = principal()
+    received = payment(1, amount=20_000)
+    stack.lnbits.history = [received]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    assert run(stack.wallet.balance(user.wallet_id)) == 20
+
+    # a pay in flight is reserved, by an incremental pass and by sse alike
+    stack.lnbits.history = [pending(3, 4_981_000), received]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key))
+    run(stack.ledger.record(user.wallet_id, [pending(6, 1_000)]))
+    assert run(stack.wallet.balance(user.wallet_id)) == 20 - 4_982 - 2
+
+    # lnbits deletes both once they failed
+    stack.lnbits.history = [received]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    assert run(stack.wallet.balance(user.wallet_id)) == 20
+    assert run(stack.payments.count(user.wallet_id)) == 1
+
+
+def test_full_pass_keeps_settled_payments(run, stack):
+    """ lnbits never deletes a settled payment, one missing from a pass was skipped by shifting offsets """
+    user = principal()
+    stack.lnbits.history = [payment(2, amount=5_000), payment(1, amount=20_000)]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    stack.lnbits.history = stack.lnbits.history[1:]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    assert run(stack.wallet.balance(user.wallet_id)) == 25
+
+
+def test_full_pass_keeps_payments_written_meanwhile(run, stack):
+    """ a payment recorded by sse while the pass walks its pages may be missing from them """
+    user = principal()
+    stack.lnbits.history = [payment(1, amount=20_000)]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    get_payments = stack.lnbits_service.get_payments
+
+    async def listed_then_paid(*args, **kwargs):
+        page = await get_payments(*args, **kwargs)
+        await stack.ledger.record(user.wallet_id, [pending(3, 1_000)])
+        return page
+
+    stack.lnbits_service.get_payments = listed_then_paid
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    assert run(stack.payments.count(user.wallet_id)) == 2
+
+
+def synced(run, stack, cursor: str | None = None) -> tuple[list[str], dict]:
+    reply = run(stack.wallet.sync(principal(), cursor))
+    return [row["checking_id"] for row in json.loads(reply["payments"].data)], reply
+
+
+def test_delta_sync_sends_what_changed_after_the_cursor(run, stack):
+    user = principal()
+    stack.lnbits.history = [payment(2), payment(1)]
+    hashes, reply = synced(run, stack)
+    assert hashes == [payment(2)["checking_id"], payment(1)["checking_id"]]
+    assert not reply["delta"]
+    cursor = reply["cursor"]
+
+    hashes, reply = synced(run, stack, cursor)
+    assert hashes == [] and reply["delta"] and reply["cursor"] == cursor
+
+    # a new payment, and an old invoice settling, both come after the cursor
+    invoice = pending(4, 7_000)
+    run(stack.ledger.record(user.wallet_id, [payment(5), invoice]))
+    hashes, reply = synced(run, stack, cursor)
+    assert sorted(hashes) == sorted([payment(5)["checking_id"], invoice["checking_id"]])
+    cursor = reply["cursor"]
+    run(stack.ledger.record(user.wallet_id, [{**invoice, "pending": False}]))
+    hashes, reply = synced(run, stack, cursor)
+    assert hashes == [invoice["checking_id"]]
+
+    # recording the same payment again is no change
+    run(stack.ledger.record(user.wallet_id, [payment(5)]))
+    assert synced(run, stack, reply["cursor"])[0] == []
+
+
+def test_unknown_cursors_get_the_full_list(run, stack):
+    stack.lnbits.history = [payment(2), payment(1)]
+    _, reply = synced(run, stack)
+    ahead = str(int(reply["cursor"]) + 10)
+    for cursor in (ahead, "not a payment"):
+        hashes, reply = synced(run, stack, cursor)
+        assert len(hashes) == 2 and not reply["delta"]
+
+
+def test_legacy_payment_hash_cursor(run, stack):
+    user = principal()
+    stack.lnbits.history = [payment(2), payment(1)]
+    synced(run, stack)
+    run(stack.ledger.record(user.wallet_id, [payment(5)]))
+    # older payments of the anchor's batch may come again, clients merge by payment_hash
+    hashes, reply = synced(run, stack, payment(2)["payment_hash"])
+    assert payment(5)["checking_id"] in hashes and payment(2)["checking_id"] not in hashes
+    assert reply["delta"]
+
+
+def test_webhook_stand_in_stays_out_of_the_balance(run, stack):
+    user = principal()
+    stack.lnbits.history = [payment(1, amount=20_000)]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    paid = payment(4, amount=5_000)
+    webhook = {"payment_hash": paid["payment_hash"], "amount": 5_000, "payment_request": "lnbc1", "comment": "hi"}
+    run(stack.ledger.record_webhook(user, [webhook]))
+    assert run(stack.payments.count(user.wallet_id)) == 2
+    assert run(stack.wallet.balance(user.wallet_id)) == 20
+
+    # lnbits lists the payment under another checking_id, it replaces the stand in
+    stack.lnbits.history = [{**paid, "checking_id": "internal_" + paid["payment_hash"]}, payment(1, amount=20_000)]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key))
+    assert run(stack.payments.count(user.wallet_id)) == 2
+    assert run(stack.wallet.balance(user.wallet_id)) == 25
+
+    # a webhook repeated after the payment is known changes nothing
+    run(stack.ledger.record_webhook(user, [webhook]))
+    assert run(stack.payments.count(user.wallet_id)) == 2
+    assert run(stack.wallet.balance(user.wallet_id)) == 25
+
+
+def test_forged_webhook_is_dropped_by_a_full_pass(run, stack):
+    user = principal()
+    stack.lnbits.history = [payment(1, amount=20_000)]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    run(stack.ledger.record_webhook(user, [{"payment_hash": "ff" * 32, "amount": 1_000_000}]))
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key))
+    assert run(stack.payments.count(user.wallet_id)) == 2
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    assert run(stack.payments.count(user.wallet_id)) == 1
+    assert run(stack.wallet.balance(user.wallet_id)) == 20
+
+
+def test_concurrent_writes_of_one_payment(run, file_stack):
+    """ sse and a pass inserting the same new payment, on a fresh wallet whose seq counter does not exist yet """
+    user = principal()
+    stack = file_stack
+
+    async def race():
+        return await asyncio.gather(*(
+            stack.ledger.record(user.wallet_id, [payment(index) for index in range(count)]) for count in (1, 2, 3, 4, 4)
+        ))
+
+    written = run(race())
+    assert sum(written) >= 4
+    assert run(stack.payments.count(user.wallet_id)) == 4
+    rows = run(stack.payments.list(user.wallet_id))
+    assert len({row.seq for row in rows}) == 4
+    assert max(row.seq for row in rows) <= run(stack.payments.last_seq(user.wallet_id))
+
+
+def test_changes_during_a_pass_get_one_more_pass(run, stack):
+    user = principal()
+    stack.lnbits.history = [payment(1)]
+    run(stack.ledger.reconcile(user.wallet_id, user.api_key, full=True))
+    passes = stack.ledger.reconciled
+    gate = asyncio.Event()
+    get_payments = stack.lnbits_service.get_payments
+
+    async def slow(*args, **kwargs):
+        await gate.wait()
+        return await get_payments(*args, **kwargs)
+
+    stack.lnbits_service.get_payments = slow
+
+    async def changes():
+        stack.ledger.changed(user)
+        await asyncio.sleep(0)
+        # paid while the first pass waits for lnbits
+        stack.lnbits.history = [payment(2), payment(1)]
+        for _ in range(3):
+            stack.ledger.changed(user)
+        gate.set()
+        while stack.ledger._syncing:
+            await asyncio.gather(*stack.ledger._syncing.values())
+            await asyncio.sleep(0)
+
+    run(changes())
+    assert stack.ledger.reconciled - passes == 2
+    assert run(stack.payments.count(user.wallet_id)) == 2
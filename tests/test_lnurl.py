@@ -0,0 +1,63 @@
+"""LnbitsService.decode_lnurl: which lnurl responses are shared between scans."""
+
+import itertools
+
+import httpx
+
+from benchmarks.stub import STUB_URL, StubHttpClient
+from webapp.breaker import Breakers
+from webapp.cache import SingleFlightCache
+from webapp.metrics import Metrics
+from webapp.serializer import create_serializer
+from webapp.services.lnbits import LnbitsService
+
+
+class LnurlServer:
+    def __init__(self) -> None:
+        self.requests = 0
+        self._k1 = itertools.count()
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        if request.url.path == "/pay":
+            return httpx.Response(200, json={
+                "tag": "payRequest",
+                "callback": "https://lnurl.example/pay/callback",
+                "minSendable": 1000,
+                "maxSendable": 1_000_000,
+                "metadata": "[]",
+            })
+        return httpx.Response(200, json={
+            "tag": "withdrawRequest",
+            "callback": "https://lnurl.example/withdraw/callback",
+            "k1": f"k1-{next(self._k1)}",
+            "minWithdrawable": 1000,
+            "maxWithdrawable": 1000,
+        })
+
+
+def lnbits(server: LnurlServer) -> tuple[LnbitsService, StubHttpClient]:
+    http = StubHttpClient(server)  # type: ignore
+    service = LnbitsService(
+        {"lnbits": {"url": STUB_URL}}, http, create_serializer(), Metrics(), SingleFlightCache(ttl=60), Breakers(),
+    )
+    return service, http
+
+
+def test_pay_metadata_is_cached(run):
+    server = LnurlServer()
+    service, http = lnbits(server)
+    first = run(service.decode_lnurl("https://lnurl.example/pay"))
+    assert run(service.decode_lnurl("https://lnurl.example/pay")) == first
+    assert server.requests == 1
+    run(http.close())
+
+
+def test_withdraw_k1_is_never_shared(run):
+    server = LnurlServer()
+    service, http = lnbits(server)
+    first = run(service.decode_lnurl("https://lnurl.example/withdraw"))
+    second = run(service.decode_lnurl("https://lnurl.example/withdraw"))
+    assert first["k1"] != second["k1"]
+    assert server.requests == 2
+    run(http.close())
@@ -0,0 +1,48 @@
+"""Metrics: registry snapshots, merging across workers and the text format."""
+
+import logging
+
+import pytest
+
+from webapp.metrics import Metric, Metrics, merge, render
+
+
+def test_metric_is_abstract():
+    with pytest.raises(TypeError):
+        Metric("metric", "abstract")  # type: ignore
+
+
+def test_workers_are_summed():
+    snapshots = []
+    for _ in range(2):
+        metrics = Metrics()
+        metrics.counter("requests_total", "requests", ("endpoint",)).labels("pay").inc()
+        metrics.histogram("latency_seconds", "latency", buckets=(0.1, 1.0)).observe(0.5)
+        metrics.gauge("connections", "open connections", lambda: 3)
+        snapshots.append(metrics.snapshot())
+    text = render(merge(snapshots))
+    assert 'requests_total{endpoint="pay"} 2' in text
+    assert 'latency_seconds_bucket{le="1"} 2' in text
+    assert 'latency_seconds_bucket{le="0.1"} 0' in text
+    assert "latency_seconds_count 2" in text
+    assert "connections 6" in text
+
+
+def test_broken_gauge_is_logged(caplog):
+    metrics = Metrics()
+    metrics.gauge("broken", "fails when read", lambda: 1 / 0)
+    metrics.gauge("working", "reads fine", lambda: 1)
+    with caplog.at_level(logging.ERROR, logger="webapp.metrics"):
+        snapshot = metrics.snapshot()
+    assert list(snapshot) == ["working"]
+    assert "broken" in caplog.text
+
+
+def test_labels_are_checked():
+    metrics = Metrics()
+    counter = metrics.counter("rejected_total", "rejections", ("scope", "rule"))
+    with pytest.raises(ValueError):
+        counter.labels("user")
+    assert counter.labels("user", "pay") is counter.labels("user", "pay")
+    with pytest.raises(ValueError):
+        metrics.histogram("rejected_total", "same name, other type")
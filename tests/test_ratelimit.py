@@ -0,0 +1,89 @@
+"""TokenBucket, RateLimiter and Admission: turning away work over its limits."""
+
+import pytest
+
+from webapp import ratelimit
+from webapp.metrics import Metrics, merge, render
+from webapp.ratelimit import Admission, Overloaded, RateLimited, RateLimiter, TokenBucket
+
+
+def rendered(metrics: Metrics) -> str:
+    return render(merge([metrics.snapshot()]))
+
+
+def test_bucket_spends_its_burst_then_refills():
+    bucket = TokenBucket(burst=3, now=0)
+    assert [bucket.take(rate=2, burst=3, now=0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(rate=2, burst=3, now=0) == pytest.approx(0.5)
+    assert bucket.take(rate=2, burst=3, now=0.25) == pytest.approx(0.25)
+    assert bucket.take(rate=2, burst=3, now=0.5) == 0
+    # idle time refills no more than burst
+    assert [bucket.take(rate=2, burst=3, now=100) for _ in range(4)][-1] > 0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_limiter_keeps_rules_and_keys_apart(clock):
+    metrics = Metrics()
+    limiter = RateLimiter(metrics, user={"pay": {"rate": 1, "burst": 2}})
+    limiter.take("user", "pay", "alice")
+    limiter.take("user", "pay", "alice")
+    with pytest.raises(RateLimited) as raised:
+        limiter.take("user", "pay", "alice")
+    assert raised.value.rule == "pay" and raised.value.retry_after == 1
+    limiter.take("user", "pay", "bob")
+    limiter.take("user", "payments", "alice")
+    clock[0] += 1
+    limiter.take("user", "pay", "alice")
+    assert 'ratelimit_rejections_total{scope="user",rule="pay"} 1' in rendered(metrics)
+
+
+def test_rules_fall_back_to_default_and_can_be_lifted(clock):
+    limiter = RateLimiter(Metrics(), ip={"default": {"rate": 1, "burst": 1}, "signup": None})
+    limiter.take("ip", "unknown", "10.0.0.1")
+    with pytest.raises(RateLimited):
+        limiter.take("ip", "unknown", "10.0.0.1")
+    for _ in range(100):
+        limiter.take("ip", "signup", "10.0.0.1")
+
+
+def test_least_recently_used_buckets_are_forgotten(clock):
+    limiter = RateLimiter(Metrics(), user={"pay": {"rate": 1, "burst": 1}}, maxsize=2)
+    limiter.take("user", "pay", "alice")
+    limiter.take("user", "pay", "bob")
+    with pytest.raises(RateLimited):
+        limiter.take("user", "pay", "alice")
+    limiter.take("user", "pay", "carol")
+    assert limiter.stats()["buckets"] == 2
+    # bob was least recently used, his bucket starts full again
+    limiter.take("user", "pay", "bob")
+    with pytest.raises(RateLimited):
+        limiter.take("user", "pay", "carol")
+
+
+def test_admission_caps_upstream_work():
+    metrics = Metrics()
+    admission = Admission(metrics, max_upstream=2)
+    admission.acquire_upstream()
+    admission.acquire_upstream()
+    with pytest.raises(Overloaded) as raised:
+        admission.acquire_upstream()
+    assert raised.value.resource == "upstream requests"
+    assert admission.upstream == 2
+    admission.release_upstream()
+    admission.acquire_upstream()
+    text = rendered(metrics)
+    assert "upstream_in_flight 2" in text
+    assert 'admission_rejections_total{resource="upstream"} 1' in text
+
+
+def test_admission_caps_websockets():
+    admission = Admission(Metrics(), max_websockets=2)
+    admission.admit_websocket(1)
+    with pytest.raises(Overloaded):
+        admission.admit_websocket(2)
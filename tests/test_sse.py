@@ -0,0 +1,99 @@
+"""SSEParser and SSEStream: the lnbits payment stream as it comes off the wire."""
+
+import asyncio
+import json
+
+import pytest
+
+from webapp.metrics import Metrics
+from webapp.serializer import create_serializer
+from webapp.services.eventbus import LocalEventBus
+from webapp.services.sse import SSEHub, SSEParser, SSEStream
+
+PAYMENT = b'event: payment-received\ndata: {"payment_hash": "ab", "amount": 1000}\n\n'
+
+
+def test_events_and_comments():
+    parser = SSEParser()
+    events = parser.feed(b": keepalive\n\n" + PAYMENT + b"event: ping\ndata: hello\n\n")
+    assert events == [
+        {"event": "payment-received", "data": {"payment_hash": "ab", "amount": 1000}, "id": None},
+        {"event": "ping", "data": "hello", "id": None},
+    ]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_events_split_across_chunks(size):
+    body = (PAYMENT + b"data: line one\r\ndata: line two\r\n\r\n") * 2
+    parser = SSEParser()
+    events = []
+    for start in range(0, len(body), size):
+        events.extend(parser.feed(body[start:start + size]))
+    assert [event["event"] for event in events] == ["payment-received", "message"] * 2
+    assert events[1]["data"] == "line one\nline two"
+
+
+def test_line_endings():
+    parser = SSEParser()
+    assert len(parser.feed(b"data: 1\r\rdata: 2\n\ndata: 3\r\n\r\n")) == 3
+    # a lone cr at the end of a chunk may be half of a crlf
+    assert parser.feed(b"data: 4\r") == []
+    assert parser.feed(b"\n\r\n") == [{"event": "message", "data": 4, "id": None}]
+
+
+def test_id_and_retry_fields():
+    parser = SSEParser()
+    events = parser.feed(b"id: 7\nretry: 2500\nretry: soon\ndata: {}\n\nid: bad\0id\ndata: {}\n\n")
+    assert [event["id"] for event in events] == ["7", "7"]
+    assert parser.retry == 2500
+
+
+def test_reset_drops_a_partial_event():
+    parser = SSEParser()
+    parser.feed(b"event: payment-received\ndata: {\"half")
+    parser.reset()
+    assert parser.feed(b"data: 1\n\n") == [{"event": "message", "data": 1, "id": None}]
+
+
+def test_backoff_grows_and_is_capped():
+    stream = SSEStream("http://lnbits", 10)
+    delays = [stream.backoff(attempt) for attempt in range(12)]
+    assert all(0.5 * min(2 ** attempt, 30) <= delay <= min(2 ** attempt, 30) for attempt, delay in enumerate(delays))
+    stream.parser.retry = 100
+    assert stream.backoff(0) <= 0.1
+
+
+def test_reconnect_after_interruption_is_reported(run):
+    """ lnbits does not replay missed events, the ledger is told to catch up """
+    connections = 0
+
+    async def upstream(reader, writer):
+        nonlocal connections
+        connections += 1
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n\r\nretry: 10\n" + PAYMENT)
+        await writer.drain()
+        if connections == 1:
+            writer.close()
+            return
+        await asyncio.sleep(1)
+        writer.close()
+
+    async def scenario():
+        server = await asyncio.start_server(upstream, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        hub = SSEHub(f"http://127.0.0.1:{port}", LocalEventBus(), create_serializer(), Metrics())
+        seen, reconnected = [], []
+        hub.observe(lambda api_key, event: seen.append(event["event"]))
+        hub.observe_reconnect(reconnected.append)
+        queue = hub.subscribe("key")
+        events = [await asyncio.wait_for(queue.get(), 5) for _ in range(2)]
+        hub.close()
+        server.close()
+        await server.wait_closed()
+        return events, seen, reconnected
+
+    events, seen, reconnected = run(scenario())
+    assert [json.dumps(event["data"]) for event in events] == ['{"payment_hash": "ab", "amount": 1000}'] * 2
+    assert seen == ["payment-received"] * 2
+    assert reconnected == ["key"]
@@ -0,0 +1,88 @@
+"""UserService: signups that fail halfway, and the principals cached meanwhile."""
+
+import pytest
+
+from webapp.cache import TTLCache
+from webapp.models import UserPrincipal, createUser
+from webapp.services.user import UserService
+
+
+class Hasher:
+    async def hash(self, password: str) -> str:
+        return f"hashed:{password}"
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return hashed_password == f"hashed:{password}"
+
+
+class Lnbits:
+    """ account setup in lnbits, the tpos step fails until fixed """
+    def __init__(self) -> None:
+        self.tpos_fails = True
+
+    async def create_user_and_wallet(self, username: str):
+        return f"usr-{username}", f"wallet-{username}", f"key-{username}"
+
+    async def create_user_lnurlp(self, username, api_key, wallet_id) -> str:
+        return f"lnurlp-{username}"
+
+    async def create_user_lnurlw(self, username, api_key, wallet_id) -> str:
+        return f"lnurlw-{username}"
+
+    async def create_user_tpos(self, username, api_key) -> str:
+        if self.tpos_fails:
+            raise Exception("tpos is down")
+        return f"tpos-{username}"
+
+
+@pytest.fixture
+def users(stack):
+    lnbits = Lnbits()
+    return UserService(stack.users, lnbits, Hasher(), TTLCache(ttl=60)), lnbits  # type: ignore
+
+
+def signup(username: str = "alice") -> createUser:
+    return createUser(username=username, password="password1", password_repeat="password1")
+
+
+def test_resumed_signup_is_seen_by_the_token_loader(run, users):
+    service, lnbits = users
+    with pytest.raises(Exception):
+        run(service.create_user(signup()))
+    # a webhook for the half made account
+    assert not run(service.get_principal("alice")).is_active
+
+    lnbits.tpos_fails = False
+    run(service.create_user(signup()))
+    principal = run(service.get_principal("alice"))
+    assert principal.is_active and principal.tpos == "tpos-alice"
+
+
+def test_updates_invalidate_the_cached_principal(run, users):
+    service, lnbits = users
+    with pytest.raises(Exception):
+        run(service.create_user(signup()))
+    stale = run(service.get_principal("alice"))
+    # cached by a worker before inactive principals were left out
+    service._principals.set("alice", stale)
+
+    lnbits.tpos_fails = False
+    run(service.create_user(signup()))
+    assert run(service.get_principal("alice")).is_active
+
+
+def test_active_principals_are_cached(run, users):
+    service, lnbits = users
+    lnbits.tpos_fails = False
+    run(service.create_user(signup()))
+    first = run(service.get_principal("alice"))
+    assert isinstance(first, UserPrincipal)
+    assert run(service.get_principal("alice")) is first
+
+
+def test_other_users_cannot_resume_a_signup(run, users):
+    service, _ = users
+    with pytest.raises(Exception):
+        run(service.create_user(signup()))
+    with pytest.raises(Exception, match="user exists"):
+        run(service.create_user(createUser(username="alice", password="password2", password_repeat="password2")))
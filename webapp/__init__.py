@@ -1 +1,8 @@
 """Top-level package."""
+
+import os
+import time
+
+# the startup report measures imports from here
+IMPORT_STARTED = time.perf_counter()
+IMPORT_PID = os.getpid()
@@ -1,39 +1,99 @@
 """Application module."""
 
-from fastapi import Depends, FastAPI
+import time
+
+from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 from .endpoints import (
         login,
         websocket,
+        webhook,
         status,
 )
 
-from .containers import Container
+from .containers import ClosingSingleton, Container
+from .serializer import json_response_class
+from .startup import StartupReport
+
+# everything create_app needs is imported by now
+IMPORTED = time.perf_counter()
 
-def include_routes(app, login_manager):
+def include_routes(app):
     # public paths
     app.include_router(login.login_router)
     app.include_router(status.status_router)
+    app.include_router(webhook.webhook_router)
     # websocket auth
     app.include_router(websocket.websocket_router)
     # private
     # app.include_router(private.private_router, dependencies=[Depends(login_manager)])
 
 
-def create_app() -> FastAPI:
-    container = Container()
+def built(*singletons: ClosingSingleton) -> list:
+    return [singleton() for singleton in singletons if singleton.built]
+
+
+def create_app(container: Container | None = None) -> FastAPI:
+    """ app factory, serve it with uvicorn --factory webapp.application:create_app
 
-    db = container.db()
-    db.create_database()
+    only the config is read here. engine, pools, hubs and services are built
+    once, on startup, in the process that serves the app.
+    """
+    report = StartupReport(IMPORTED)
+    with report.phase("container"):
+        container = container or Container()
 
-    app = FastAPI()
-    app.container = container  # type: ignore
+    with report.phase("app"):
+        app = FastAPI(default_response_class=json_response_class(container.serializer()))
+        app.container = container  # type: ignore
+        app.state.startup = report
 
-    login_manager = container.login_service().manager()
-    login_manager.useRequest(app)
+        @app.middleware("http")
+        async def load_user(request: Request, call_next):
+            """ LoginManager.useRequest, with the login service built by the first request instead of here """
+            try:
+                request.state.user = await container.login_service().manager()(request)
+            except Exception:
+                request.state.user = None
+            return await call_next(request)
 
-    include_routes(app, login_manager)
+        include_routes(app)
+
+    @app.on_event("startup")
+    async def open_resources():
+        with report.phase("database"):
+            await container.db().create_database()
+        with report.phase("event_bus"):
+            await container.event_bus().start()
+        with report.phase("services"):
+            # action registries are compiled once, off the request path
+            container.websocket_service()
+            container.sse_service()
+            # answers metrics requests of the other workers, and registers its gauges before the first scrape
+            container.metrics_service()
+            container.connection_registry()
+        with report.phase("ledger"):
+            container.ledger_service().start()
+        with report.phase("expiry"):
+            container.expiry_scheduler().start()
+        with report.phase("signups"):
+            container.signup_sweeper().start()
+        report.done()
+
+    @app.on_event("shutdown")
+    async def close_resources():
+        """ closes what this worker built, a singleton it never used is not built just to be closed """
+        for task in built(container.ledger_service, container.expiry_scheduler, container.signup_sweeper):
+            await task.close()
+        for pool in built(container.sse_hub, container.password_hasher):
+            pool.close()
+        for client in built(container.http_client):
+            await client.close()
+        for db in built(container.db):
+            await db.dispose()
+        for bus in built(container.event_bus):
+            await bus.close()
 
     app.add_middleware(
         CORSMiddleware,
@@ -46,4 +106,14 @@ def create_app() -> FastAPI:
     return app
 
 
-app = create_app()
+_app: FastAPI | None = None
+
+
+def __getattr__(name: str):
+    """ keeps uvicorn webapp.application:app working, without building an app on every import """
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,112 @@
+"""Circuit breaker module."""
+
+import logging
+import time
+
+logger = logging.getLogger("uvicorn")
+
+
+class CircuitOpen(Exception):
+    def __init__(self, host: str, retry_in: float) -> None:
+        super().__init__(f"{host} is unavailable, retrying in {max(retry_in, 0):.0f}s")
+        self.host = host
+
+
+class CircuitBreaker:
+    """ health of one upstream host
+
+    closed passes every request. threshold failures in a row open it, requests
+    fail right away until reset_timeout passed. half open then lets a single
+    probe through, its outcome closes or opens the breaker again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, host: str, threshold: int, reset_timeout: float) -> None:
+        self.host = host
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._probing = False
+
+    def acquire(self) -> None:
+        """ raises CircuitOpen when the request must not be sent """
+        if self.state == self.CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpen(self.host, self.opened_at + self.reset_timeout - now)
+            self.state = self.HALF_OPEN
+        if self._probing:
+            self.rejected += 1
+            raise CircuitOpen(self.host, 0)
+        self._probing = True
+
+    def release(self) -> None:
+        """ the request was abandoned before it told anything about the host """
+        self._probing = False
+
+    def success(self) -> None:
+        self._probing = False
+        self.failures = 0
+        if self.state != self.CLOSED:
+            logger.info(f"upstream {self.host} recovered, closing its circuit")
+            self.state = self.CLOSED
+
+    def failure(self) -> None:
+        self._probing = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            logger.warning(f"upstream {self.host} failed {self.failures} times, opening its circuit for {self.reset_timeout}s")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.trips += 1
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+class Breakers:
+    """ process wide circuit breakers by upstream host """
+    def __init__(self, threshold: int | None = None, reset_timeout: float | None = None, maxsize: int | None = None) -> None:
+        self.threshold = threshold or 5
+        self.reset_timeout = reset_timeout or 30.0
+        # lnurl servers are arbitrary third party hosts, healthy ones are forgotten beyond this
+        self.maxsize = maxsize or 1024
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def get(self, host: str) -> CircuitBreaker:
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            if len(self._breakers) >= self.maxsize:
+                self._prune()
+            breaker = self._breakers[host] = CircuitBreaker(host, self.threshold, self.reset_timeout)
+        return breaker
+
+    def _prune(self) -> None:
+        for host, breaker in list(self._breakers.items()):
+            if breaker.state == CircuitBreaker.CLOSED and not breaker.failures:
+                del self._breakers[host]
+
+    def open(self) -> int:
+        return sum(1 for breaker in self._breakers.values() if breaker.state != CircuitBreaker.CLOSED)
+
+    def stats(self) -> dict:
+        """ hosts with a recent failure, all others are healthy """
+        return {
+            host: breaker.stats()
+            for host, breaker in self._breakers.items()
+            if breaker.state != CircuitBreaker.CLOSED or breaker.failures or breaker.trips
+        }
@@ -0,0 +1,128 @@
+"""Cache module."""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+MISSING = object()
+
+
+class TTLCache:
+    """ bounded lru cache whose entries expire after ttl seconds
+
+    entries may carry their own ttl and a size, with maxbytes the sizes are
+    bounded too.
+    """
+    def __init__(self, maxsize: int | None = None, ttl: float | None = None, maxbytes: int | None = None) -> None:
+        self.maxsize = maxsize or 1024
+        self.ttl = ttl or 60.0
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires, value, _ = entry
+        if expires <= time.monotonic():
+            self.invalidate(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """ like get, but leaves counters and recency untouched """
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None, size: int = 0) -> None:
+        self.invalidate(key)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value, size)
+        self.bytes += size
+        while len(self._data) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+            _, (_, _, dropped) = self._data.popitem(last=False)
+            self.bytes -= dropped
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        stats = {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+        if self.maxbytes is not None:
+            stats["bytes"] = self.bytes
+            stats["maxbytes"] = self.maxbytes
+        return stats
+
+
+Loader = Callable[[], Awaitable[tuple[Any, float, int]]]
+
+
+class SingleFlightCache(TTLCache):
+    """ ttl cache whose concurrent misses of one key share a single load
+
+    the loader returns the value, its ttl and its size. a ttl of 0 or less
+    hands the value to the waiting callers without storing it, failures are
+    never stored.
+    """
+    def __init__(self, maxsize: int | None = None, ttl: float | None = None, maxbytes: int | None = None) -> None:
+        super().__init__(maxsize, ttl, maxbytes)
+        self._loading: dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def get_or_load(self, key: Hashable, load: Loader) -> Any:
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        inflight = self._loading.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._load(key, load))
+            self._loading[key] = inflight
+            inflight.add_done_callback(lambda future: self._loaded(key, future))
+        else:
+            self.coalesced += 1
+        # a caller giving up must not cancel the load the others wait for
+        return await asyncio.shield(inflight)
+
+    async def _load(self, key: Hashable, load: Loader) -> Any:
+        value, ttl, size = await load()
+        if ttl > 0:
+            self.set(key, value, ttl, size)
+        return value
+
+    def _loaded(self, key: Hashable, future: asyncio.Future) -> None:
+        self._loading.pop(key, None)
+        if not future.cancelled():
+            # retrieved here, a load nobody waits for anymore must not log a warning
+            future.exception()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "coalesced": self.coalesced, "loading": len(self._loading)}
@@ -4,14 +4,43 @@
 # import logging
 from dependency_injector import containers, providers
 
+from .breaker import Breakers
+from .cache import SingleFlightCache, TTLCache
 from .database import Database
-from .repositories import UserRepository
+from .http import HttpClient
+from .metrics import Metrics
+from .ratelimit import Admission, RateLimiter
+from .repositories import InstanceRepository, PaymentRepository, UserRepository
+from .serializer import create_serializer
 
-from .services.user import UserService
+from .services.hashing import PasswordHasher
+from .services.connections import ConnectionRegistry
+from .services.eventbus import create_event_bus
+from .services.expiry import ExpiryScheduler
+from .services.ledger import LedgerService
+from .services.metrics import MetricsService
+from .services.user import SignupSweeper, UserService
+from .services.wallet import WalletService
 from .services.login import LoginService
 from .services.lnbits import LnbitsService
-from .services.websocket import WebSocketService
-from .services.sse import SSEService
+from .services.websocket import WebSocketDispatcher, WebSocketService
+from .services.sse import SSEDispatcher, SSEHub, SSEService
+from .services.webhook import WebhookService
+
+
+class ClosingSingleton(providers.Singleton):
+    """ a singleton holding resources, built tells shutdown whether this worker ever created it """
+    built = False
+
+    def __call__(self, *args, **kwargs):
+        instance = super().__call__(*args, **kwargs)
+        self.built = True
+        return instance
+
+    def reset(self):
+        self.built = False
+        return super().reset()
+
 
 class Container(containers.DeclarativeContainer):
 
@@ -19,11 +48,18 @@ class Container(containers.DeclarativeContainer):
         ".endpoints.login",
         ".endpoints.status",
         ".endpoints.websocket",
+        ".endpoints.webhook",
     ])
 
     config = providers.Configuration(yaml_files=["config.yml"])
 
-    db = providers.Singleton(Database, db_url=config.db.url)
+    db = ClosingSingleton(
+        Database,
+        db_url=config.db.url,
+        pool_size=config.db.pool_size,
+        max_overflow=config.db.max_overflow,
+        pool_recycle=config.db.pool_recycle,
+    )
 
     # logging = providers.Resource(
     #     logging.basicConfig,
@@ -32,34 +68,199 @@ class Container(containers.DeclarativeContainer):
     #     format=config.log.format,
     # )
 
-    lnbits_service = providers.Factory(
+    serializer = providers.Singleton(
+        create_serializer,
+        backend=config.json.backend,
+    )
+
+    metrics = providers.Singleton(Metrics)
+
+    http_client = ClosingSingleton(
+        HttpClient,
+        pool_size=config.lnbits.pool_size,
+        keepalive=config.lnbits.keepalive,
+        timeout=config.lnbits.timeout,
+    )
+
+    event_bus = ClosingSingleton(
+        create_event_bus,
+        backend=config.bus.backend,
+        path=config.bus.path,
+        batch_delay=config.bus.batch_delay,
+    )
+
+    metrics_service = providers.Singleton(
+        MetricsService,
+        metrics=metrics,
+        event_bus=event_bus,
+        timeout=config.metrics.timeout,
+    )
+
+    lnurl_cache = providers.Singleton(
+        SingleFlightCache,
+        maxsize=config.cache.lnurl_size,
+        ttl=config.cache.lnurl_ttl,
+        maxbytes=config.cache.lnurl_bytes,
+    )
+
+    rate_limiter = providers.Singleton(
+        RateLimiter,
+        metrics=metrics,
+        user=config.limits.user,
+        ip=config.limits.ip,
+    )
+
+    admission = providers.Singleton(
+        Admission,
+        metrics=metrics,
+        max_websockets=config.limits.max_websockets,
+        max_upstream=config.limits.max_upstream,
+    )
+
+    breakers = providers.Singleton(
+        Breakers,
+        threshold=config.lnbits.breaker_threshold,
+        reset_timeout=config.lnbits.breaker_reset,
+    )
+
+    # stateless services are built once and shared by every request and websocket
+    lnbits_service = providers.Singleton(
         LnbitsService,
         config=config,
+        http_client=http_client,
+        serializer=serializer,
+        metrics=metrics,
+        lnurl_cache=lnurl_cache,
+        breakers=breakers,
     )
 
-    user_repository = providers.Factory(
+    user_repository = providers.Singleton(
         UserRepository,
         session_factory=db.provided.session,
     )
 
-    user_service = providers.Factory(
+    password_hasher = ClosingSingleton(
+        PasswordHasher,
+        pool_size=config.hashing.pool_size,
+        queue_size=config.hashing.queue_size,
+    )
+
+    principal_cache = providers.Singleton(
+        TTLCache,
+        maxsize=config.cache.principal_size,
+        ttl=config.cache.principal_ttl,
+    )
+
+    user_service = providers.Singleton(
         UserService,
         user_repository=user_repository,
         lnbits_service=lnbits_service,
+        password_hasher=password_hasher,
+        principal_cache=principal_cache,
     )
 
-    login_service = providers.Factory(
+    signup_sweeper = ClosingSingleton(
+        SignupSweeper,
+        user_service=user_service,
+        event_bus=event_bus,
+        max_age=config.signup.max_age,
+        interval=config.signup.sweep_interval,
+    )
+
+    login_service = providers.Singleton(
         LoginService,
         secret=config.db.secret,
         user_service=user_service,
     )
 
-    websocket_service = providers.Factory(
-        WebSocketService,
-        login_service=login_service,
+    sse_hub = ClosingSingleton(
+        SSEHub,
+        url=config.lnbits.url,
+        event_bus=event_bus,
+        serializer=serializer,
+        metrics=metrics,
+        linger=config.lnbits.sse_linger,
+        queue_size=config.lnbits.sse_queue_size,
+    )
+
+    payment_repository = providers.Singleton(
+        PaymentRepository,
+        session_factory=db.provided.session,
+    )
+
+    ledger_service = ClosingSingleton(
+        LedgerService,
+        payment_repository=payment_repository,
+        user_repository=user_repository,
+        lnbits_service=lnbits_service,
+        serializer=serializer,
+        sse_hub=sse_hub,
+        event_bus=event_bus,
+        interval=config.ledger.reconcile_interval,
+        full_interval=config.ledger.full_interval,
+        page_size=config.ledger.page_size,
+        concurrency=config.ledger.concurrency,
+    )
+
+    instance_repository = providers.Singleton(
+        InstanceRepository,
+        session_factory=db.provided.session,
+    )
+
+    expiry_scheduler = ClosingSingleton(
+        ExpiryScheduler,
+        instance_repository=instance_repository,
+        event_bus=event_bus,
+        destroy_time=config.saas.destroy_time,
+        window=config.saas.window,
+    )
+
+    wallet_service = providers.Singleton(
+        WalletService,
+        ledger_service=ledger_service,
+        payment_repository=payment_repository,
+    )
+
+    websocket_dispatcher = providers.Singleton(
+        WebSocketDispatcher,
         lnbits_service=lnbits_service,
+        wallet_service=wallet_service,
+        metrics=metrics,
+        admission=admission,
+    )
+
+    websocket_service = providers.Singleton(
+        WebSocketService,
+        dispatcher=websocket_dispatcher,
+        serializer=serializer,
+        metrics=metrics,
+        rate_limiter=rate_limiter,
+        concurrency=config.websocket.concurrency,
+    )
+
+    connection_registry = providers.Singleton(
+        ConnectionRegistry,
+        event_bus=event_bus,
+        serializer=serializer,
+        metrics=metrics,
+    )
+
+    webhook_service = providers.Singleton(
+        WebhookService,
+        secret=config.webhook.secret,
+        user_service=user_service,
+        ledger_service=ledger_service,
+        connection_registry=connection_registry,
+    )
+
+    sse_dispatcher = providers.Singleton(
+        SSEDispatcher,
     )
 
-    sse_service = providers.Factory(
+    sse_service = providers.Singleton(
         SSEService,
+        hub=sse_hub,
+        dispatcher=sse_dispatcher,
+        connection_registry=connection_registry,
+        queue_size=config.lnbits.sse_queue_size,
     )
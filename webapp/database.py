@@ -1,40 +1,130 @@
 """Database module."""
 
 import logging
-from contextlib import AbstractContextManager, contextmanager
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
 from typing import Callable
 
-from sqlalchemy import create_engine, orm
+import time
+
+from sqlalchemy import event, inspect, orm, pool, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Session
 
 logger = logging.getLogger("uvicorn")
 
 Base = declarative_base()
 
+# plain urls from config.yml are mapped onto their asyncio drivers
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+# columns added to tables that deployments already have, create_all never alters a table.
+# the existing rows get the value of the backfill, rows from before count from the upgrade
+COLUMNS = {
+    "users": {"updated_at": ("INTEGER", lambda: int(time.time()))},
+}
+
+
+def add_columns(connection) -> None:
+    inspector = inspect(connection)
+    for table, columns in COLUMNS.items():
+        if not inspector.has_table(table):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table)}
+        for name, (ddl, backfill) in columns.items():
+            if name in existing:
+                continue
+            logger.info(f"adding column {table}.{name}")
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+            connection.execute(text(f"UPDATE {table} SET {name} = :value"), {"value": backfill()})
+
+
+def create_schema(connection) -> None:
+    Base.metadata.create_all(connection)
+    add_columns(connection)
+
+
+def sqlite_pragmas(dbapi_connection, _) -> None:
+    cursor = dbapi_connection.cursor()
+    # readers no longer block the writer, and commits skip one fsync per transaction
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
 
 class Database:
-    def __init__(self, db_url: str) -> None:
-        self._engine = create_engine(db_url)
-        self._session_factory = orm.scoped_session(
-            orm.sessionmaker(
-                autocommit=False,
-                autoflush=False,
-                bind=self._engine,
-            ),
+    def __init__(
+        self,
+        db_url: str,
+        pool_size: int | None = None,
+        max_overflow: int | None = None,
+        pool_recycle: int | None = None,
+    ) -> None:
+        url = make_url(db_url)
+        url = url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+        options: dict = {}
+        if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+            # every connection would see its own empty in-memory database
+            options["poolclass"] = pool.StaticPool
+        else:
+            options["poolclass"] = pool.AsyncAdaptedQueuePool
+            options["pool_size"] = pool_size or 5
+            options["max_overflow"] = max_overflow or 10
+            options["pool_recycle"] = pool_recycle or 3600
+            options["pool_pre_ping"] = url.get_backend_name() != "sqlite"
+        self._url = url
+        self._options = options
+        self._engine: AsyncEngine | None = None
+        self._session_factory: orm.sessionmaker | None = None
+
+    @property
+    def engine(self) -> AsyncEngine:
+        if self._engine is None:
+            self._connect()
+        return self._engine  # type: ignore
+
+    def _connect(self) -> orm.sessionmaker:
+        # created on first use, by the worker that serves and on the loop it runs
+        self._engine = create_async_engine(self._url, **self._options)
+        if self._url.get_backend_name() == "sqlite":
+            event.listen(self._engine.sync_engine, "connect", sqlite_pragmas)
+        self._session_factory = orm.sessionmaker(
+            bind=self._engine,
+            class_=AsyncSession,
+            autoflush=False,
+            expire_on_commit=False,
         )
+        return self._session_factory
+
+    async def create_database(self) -> None:
+        try:
+            async with self.engine.begin() as connection:
+                await connection.run_sync(create_schema)
+        except DBAPIError:
+            # workers starting together race on the schema, the tables exist on the second look
+            async with self.engine.begin() as connection:
+                await connection.run_sync(create_schema)
 
-    def create_database(self) -> None:
-        Base.metadata.create_all(self._engine)
+    async def dispose(self) -> None:
+        if self._engine is not None:
+            await self._engine.dispose()
 
-    @contextmanager  # type: ignore
-    def session(self) -> Callable[..., AbstractContextManager[Session]]:  # type: ignore
-        session: Session = self._session_factory()
+    @asynccontextmanager  # type: ignore
+    async def session(self) -> Callable[..., AbstractAsyncContextManager[AsyncSession]]:  # type: ignore
+        session: AsyncSession = (self._session_factory or self._connect())()
         try:
             yield session
         except Exception:
             logger.exception("Session rollback because of exception")
-            session.rollback()
+            await session.rollback()
             raise
         finally:
-            session.close()
+            await session.close()
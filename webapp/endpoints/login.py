@@ -1,10 +1,15 @@
-from fastapi import APIRouter, Depends, status, Response
+import time
+
+from fastapi import APIRouter, Depends, Request, status, Response
 
 from fastapi.security import OAuth2PasswordRequestForm
 from starlette.responses import Response, JSONResponse
 
 from dependency_injector.wiring import Provide, inject
 
+from webapp.metrics import Metrics
+from webapp.ratelimit import Admission, Overloaded, RateLimited, RateLimiter
+from webapp.services.hashing import HashingPoolSaturated
 from webapp.services.user import UserService
 from webapp.services.login import LoginService
 from webapp.models import createUser
@@ -13,22 +18,51 @@ from webapp.containers import Container
 
 login_router = APIRouter()
 
+
+def observe(metrics: Metrics, name: str, start: float, result: str) -> None:
+    metrics.histogram(f"{name}_seconds", f"{name} requests including the password hash", ("result",)) \
+        .labels(result).observe(time.perf_counter() - start)
+
+
+def shed(exc: RateLimited | Overloaded) -> JSONResponse:
+    code = status.HTTP_429_TOO_MANY_REQUESTS if isinstance(exc, RateLimited) else status.HTTP_503_SERVICE_UNAVAILABLE
+    return JSONResponse({"detail": str(exc)}, status_code=code, headers={"Retry-After": str(exc.retry_after)})
+
+
 # the python-multipart package is required to use the OAuth2PasswordRequestForm
 @login_router.post("/login")
 @inject
 async def login_endpoint(
+    request: Request,
     response: Response,
     data: OAuth2PasswordRequestForm = Depends(),
     user_service: UserService = Depends(Provide[Container.user_service]),
     login_service: LoginService = Depends(Provide[Container.login_service]),
+    metrics: Metrics = Depends(Provide[Container.metrics]),
+    rate_limiter: RateLimiter = Depends(Provide[Container.rate_limiter]),
 ):
+    start = time.perf_counter()
     try:
-        user = user_service.login(data.username, data.password)
+        # guessing passwords is slowed down per address and per attacked user from it,
+        # a bucket of the username alone would let anyone lock its owner out
+        ip = request.client.host if request.client else ""
+        rate_limiter.take("ip", "login", ip)
+        rate_limiter.take("user", "login", f"{data.username}@{ip}")
+    except RateLimited as exc:
+        observe(metrics, "login", start, "limited")
+        return shed(exc)
+    try:
+        user = await user_service.login(data.username, data.password)
         if user:
             access_token = login_service.create_access_token(data=dict(sub=user.username))
             login_service.set_cookie(response, access_token)
+            observe(metrics, "login", start, "ok")
             return {"access_token": access_token, "token_type": "bearer"}
+    except HashingPoolSaturated as exc:
+        observe(metrics, "login", start, "saturated")
+        return JSONResponse({"detail": str(exc)}, status_code=status.HTTP_429_TOO_MANY_REQUESTS)
     except:
+        observe(metrics, "login", start, "denied")
         return Response(status_code=status.HTTP_401_UNAUTHORIZED)
 
 @login_router.get("/logout")
@@ -40,9 +74,13 @@ async def logout(response: Response):
 @inject
 async def signup_endpoint(
     data: createUser,
+    request: Request,
     response: Response,
     user_service: UserService = Depends(Provide[Container.user_service]),
     login_service: LoginService = Depends(Provide[Container.login_service]),
+    metrics: Metrics = Depends(Provide[Container.metrics]),
+    rate_limiter: RateLimiter = Depends(Provide[Container.rate_limiter]),
+    admission: Admission = Depends(Provide[Container.admission]),
 ) -> dict[str, str] | Response:
     if (data.password != data.password_repeat):
         error_json = {"detail": [{
@@ -50,10 +88,25 @@ async def signup_endpoint(
             "msg": "passwords do not match",
         }]}
         return JSONResponse(error_json, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    start = time.perf_counter()
+    try:
+        rate_limiter.take("ip", "signup", request.client.host if request.client else "")
+        # a signup creates the user, wallet and links in lnbits
+        admission.acquire_upstream()
+    except (RateLimited, Overloaded) as exc:
+        observe(metrics, "signup", start, "limited" if isinstance(exc, RateLimited) else "busy")
+        return shed(exc)
     try:
-        user = user_service.create_user(data)
+        user = await user_service.create_user(data)
         access_token = login_service.create_access_token(data=dict(sub=user.username))
         login_service.set_cookie(response, access_token)
+        observe(metrics, "signup", start, "ok")
         return {"access_token": access_token, "token_type": "bearer"}
+    except HashingPoolSaturated as exc:
+        observe(metrics, "signup", start, "saturated")
+        return JSONResponse({"detail": str(exc)}, status_code=status.HTTP_429_TOO_MANY_REQUESTS)
     except Exception as exc:
+        observe(metrics, "signup", start, "failed")
         return JSONResponse({"detail": str(exc)}, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    finally:
+        admission.release_upstream()
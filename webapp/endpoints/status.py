@@ -1,7 +1,50 @@
-from fastapi import APIRouter
+from dependency_injector.wiring import Provide, inject
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import PlainTextResponse
+
+from webapp.breaker import Breakers
+from webapp.cache import SingleFlightCache, TTLCache
+from webapp.containers import Container
+from webapp.ratelimit import Admission, RateLimiter
+from webapp.services.expiry import ExpiryScheduler
+from webapp.services.ledger import LedgerService
+from webapp.services.metrics import MetricsService
 
 status_router = APIRouter()
 
 @status_router.get("/")
 def get_status():
     return {"status": "OK"}
+
+@status_router.get("/stats")
+@inject
+def get_stats(
+    request: Request,
+    principal_cache: TTLCache = Depends(Provide[Container.principal_cache]),
+    lnurl_cache: SingleFlightCache = Depends(Provide[Container.lnurl_cache]),
+    breakers: Breakers = Depends(Provide[Container.breakers]),
+    ledger_service: LedgerService = Depends(Provide[Container.ledger_service]),
+    rate_limiter: RateLimiter = Depends(Provide[Container.rate_limiter]),
+    admission: Admission = Depends(Provide[Container.admission]),
+    expiry_scheduler: ExpiryScheduler = Depends(Provide[Container.expiry_scheduler]),
+):
+    return {
+        "startup": request.app.state.startup.stats(),
+        "principal_cache": principal_cache.stats(),
+        "lnurl_cache": lnurl_cache.stats(),
+        "breakers": breakers.stats(),
+        "ledger": ledger_service.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "admission": admission.stats(),
+        "expiry": expiry_scheduler.stats(),
+    }
+
+@status_router.get("/metrics", response_class=PlainTextResponse)
+@inject
+async def get_metrics(
+    metrics_service: MetricsService = Depends(Provide[Container.metrics_service]),
+):
+    return PlainTextResponse(
+        await metrics_service.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
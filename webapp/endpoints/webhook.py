@@ -0,0 +1,29 @@
+from dependency_injector.wiring import Provide, inject
+from fastapi import APIRouter, Depends, Request, status
+from starlette.responses import JSONResponse
+
+from webapp.containers import Container
+from webapp.services.webhook import WebhookService
+
+webhook_router = APIRouter()
+
+# registered as lnurlp webhook_url in LnbitsService.create_user_lnurlp
+@webhook_router.post("/payment")
+@inject
+async def payment_webhook(
+    request: Request,
+    api_key: str,
+    username: str,
+    webhook_service: WebhookService = Depends(Provide[Container.webhook_service]),
+):
+    if not webhook_service.verify(api_key):
+        return JSONResponse({"detail": "invalid secret"}, status_code=status.HTTP_401_UNAUTHORIZED)
+    try:
+        body = await request.json()
+    except ValueError:
+        return JSONResponse({"detail": "invalid json"}, status_code=status.HTTP_400_BAD_REQUEST)
+    payments = body if isinstance(body, list) else [body]
+    payments = [payment for payment in payments if isinstance(payment, dict)]
+    # awaited inline, the login middleware cancels background tasks once the response is out
+    await webhook_service.deliver(username, payments)
+    return JSONResponse({"status": "accepted", "count": len(payments)}, status_code=status.HTTP_202_ACCEPTED)
@@ -6,6 +6,8 @@ from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, Cookie
 
 # from .application import app
 from webapp.containers import Container
+from webapp.ratelimit import Admission, Overloaded
+from webapp.services.connections import ConnectionRegistry
 from webapp.services.login import LoginService
 from webapp.services.websocket import WebSocketService
 from webapp.services.sse import SSEService
@@ -22,7 +24,8 @@ async def websocket_endpoint(
     websocket_service: WebSocketService = Depends(Provide[Container.websocket_service]),
     login_service: LoginService = Depends(Provide[Container.login_service]),
     sse_service: SSEService = Depends(Provide[Container.sse_service]),
-    url=Depends(Provide[Container.config.lnbits.url]),
+    connection_registry: ConnectionRegistry = Depends(Provide[Container.connection_registry]),
+    admission: Admission = Depends(Provide[Container.admission]),
 ):
     if not access_token:
         return await websocket.close()
@@ -33,26 +36,26 @@ async def websocket_endpoint(
     except:
         return await websocket.close()
 
-    sse_url = f"{url}/api/v1/payments/sse?api-key={user.api_key}"
     await websocket.accept()
     try:
-        tasks = await asyncio.gather(
-            websocket_service.start_listener(websocket, access_token),
-            sse_service.start_listener(websocket, sse_url)
-        )
-        # gather catched first exception, cancel all
-        print("gathered all tasks")
-        print(tasks)
-        for task in tasks:
-            if task:
-                task.cancel()
-        print("canceled all tasks")
+        admission.admit_websocket(len(connection_registry))
+    except Overloaded as exc:
+        # try again later, the client reconnects with backoff, likely to another worker
+        await websocket.send_json({"type": "error", "code": "busy", "message": str(exc), "retry_after": exc.retry_after})
+        return await websocket.close(1013)
+    connection = connection_registry.add(user, websocket)
+    # the sse subscription lives exactly as long as the websocket
+    sse_service.subscribe(connection)
+    try:
+        await websocket_service.listen(connection)
     except WebSocketDisconnect:
         print("websocket disconnect")
     except asyncio.exceptions.CancelledError:
         print("canceled error")
-        await websocket_service.cancel_listener()
-        sse_service.cancel_listener()
     except Exception as exc:
         print(str(exc))
         print("unhandled exception")
+    finally:
+        sse_service.unsubscribe(connection)
+        connection.cancel()
+        connection_registry.remove(connection)
@@ -0,0 +1,66 @@
+"""Http client module."""
+
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+logger = logging.getLogger("uvicorn")
+
+
+class HttpClient:
+    def __init__(
+        self,
+        pool_size: int | None = None,
+        keepalive: int | None = None,
+        timeout: float | None = None,
+    ) -> None:
+        self._limits = httpx.Limits(
+            max_connections=pool_size or 100,
+            max_keepalive_connections=keepalive or 20,
+        )
+        self._timeout = httpx.Timeout(timeout or 10.0)
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # created lazily, so the pool is bound to the event loop that uses it
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(limits=self._limits, timeout=self._timeout)
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info("closed http connection pool")
+        self._client = None
+
+
+def cache_ttl(headers: httpx.Headers, default: float) -> float:
+    """ seconds a shared cache may reuse a response, from Cache-Control, Expires and Age """
+    directives = {}
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip('" ')
+    if directives.keys() & {"no-store", "no-cache", "private"}:
+        return 0.0
+    try:
+        age = float(headers.get("age") or 0)
+    except ValueError:
+        age = 0.0
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            try:
+                return max(0.0, int(directives[name]) - age)
+            except ValueError:
+                return 0.0
+    if "expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["expires"])
+            date = parsedate_to_datetime(headers["date"]) if "date" in headers else datetime.now(timezone.utc)
+            return max(0.0, (expires - date).total_seconds() - age)
+        except (TypeError, ValueError):
+            # invalid dates, "0" for instance, mean already expired
+            return 0.0
+    return default
@@ -0,0 +1,243 @@
+"""Metrics module."""
+
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+# seconds, from a cached lookup up to a slow lnbits payment
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Timer:
+    """ context manager observing the time spent in its block """
+    __slots__ = ("_child", "_start")
+
+    def __init__(self, child: "HistogramChild") -> None:
+        self._child = child
+
+    def __enter__(self) -> "Timer":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self._child.observe(time.perf_counter() - self._start)
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class HistogramChild:
+    __slots__ = ("_bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self._bounds = bounds
+        # one slot per bucket plus +Inf, not cumulative
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self._bounds, value)] += 1
+        self.sum += value
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+
+class Metric(ABC):
+    """ a metric family """
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+
+    @abstractmethod
+    def samples(self) -> list:
+        """ label values and value of each sample, as json """
+
+
+class LabeledMetric(Metric):
+    """ a metric family tracked on the hot path, one child per combination of label values """
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._children: dict[tuple[str, ...], object] = {}
+
+    @abstractmethod
+    def new_child(self):
+        """ the state of one combination of label values """
+
+    def labels(self, *values: str):
+        """ resolve children once and keep them, the lookup is the costly part """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self.new_child()
+        return child
+
+
+class Counter(LabeledMetric):
+    kind = "counter"
+
+    def new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def samples(self) -> list:
+        return [[list(key), child.value] for key, child in self._children.items()]
+
+
+class Gauge(Metric):
+    """ read when scraped, nothing is tracked on the hot path """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], float]) -> None:
+        super().__init__(name, documentation)
+        self.fn = fn
+
+    def samples(self) -> list:
+        return [[[], float(self.fn())]]
+
+
+class Histogram(LabeledMetric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Iterable[str] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> Timer:
+        return self.labels().time()
+
+    def samples(self) -> list:
+        return [[list(key), [child.counts, child.sum]] for key, child in self._children.items()]
+
+
+class Metrics:
+    """ process wide metric registry
+
+    snapshots are plain json, the workers' snapshots are summed up before
+    rendering, see MetricsService.
+    """
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if existing.kind != metric.kind or existing.labelnames != metric.labelnames:
+                raise ValueError(f"metric {metric.name} is registered with another type or labels")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))  # type: ignore
+
+    def histogram(
+        self, name: str, documentation: str, labels: Iterable[str] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))  # type: ignore
+
+    def gauge(self, name: str, documentation: str, fn: Callable[[], float]) -> Gauge:
+        """ the latest callback wins, a gauge reads whichever instance registered last """
+        gauge = self._register(Gauge(name, documentation, fn))
+        gauge.fn = fn  # type: ignore
+        return gauge  # type: ignore
+
+    def snapshot(self) -> dict:
+        families = {}
+        for metric in self._metrics.values():
+            family = {"kind": metric.kind, "help": metric.documentation, "labels": list(metric.labelnames)}
+            if isinstance(metric, Histogram):
+                family["buckets"] = list(metric.buckets)
+            try:
+                family["samples"] = metric.samples()
+            except Exception as exc:
+                logger.error(f"reading metric {metric.name} failed: {exc!r}")
+                continue
+            families[metric.name] = family
+        return families
+
+
+def merge(snapshots: list[dict]) -> dict:
+    """ sums counters, gauges and histogram buckets of several workers """
+    merged: dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, family in snapshot.items():
+            target = merged.setdefault(name, {**family, "samples": {}})
+            samples = target["samples"]
+            for labels, value in family["samples"]:
+                key = tuple(labels)
+                if family["kind"] != "histogram":
+                    samples[key] = samples.get(key, 0.0) + value
+                    continue
+                counts, total = value
+                if key in samples:
+                    previous = samples[key]
+                    counts = [a + b for a, b in zip(previous[0], counts)]
+                    total += previous[1]
+                samples[key] = [counts, total]
+    return merged
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def label_text(names: list[str], values: Iterable, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+def render(merged: dict) -> str:
+    """ prometheus text exposition format 0.0.4 """
+    lines = []
+    for name in sorted(merged):
+        family = merged[name]
+        names = family["labels"]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['kind']}")
+        for key in sorted(family["samples"]):
+            value = family["samples"][key]
+            if family["kind"] != "histogram":
+                lines.append(f"{name}{label_text(names, key)} {number(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip([*family["buckets"], "+Inf"], counts):
+                cumulative += count
+                le = "+Inf" if bound == "+Inf" else number(bound)
+                extra = f'le="{le}"'
+                lines.append(f"{name}_bucket{label_text(names, key, extra)} {cumulative}")
+            lines.append(f"{name}_sum{label_text(names, key)} {number(total)}")
+            lines.append(f"{name}_count{label_text(names, key)} {cumulative}")
+    return "\n".join(lines) + "\n"
@@ -1,8 +1,11 @@
 """Models module."""
 
+import time
+from dataclasses import dataclass
+
 from fastapi import Query
-from pydantic import BaseModel
-from sqlalchemy import Boolean, Column, Integer, String
+from pydantic import AnyHttpUrl, BaseModel, conint, constr
+from sqlalchemy import BigInteger, Boolean, Column, Index, Integer, LargeBinary, String, UniqueConstraint, literal_column
 from .database import Base
 
 
@@ -12,6 +15,40 @@ class createUser(BaseModel):
     password_repeat: str = Query(default=..., min_length=8, max_length=50)
 
 
+class InvoicePayload(BaseModel):
+    amount: conint(gt=0)  # type: ignore
+    description: str | None = None
+
+
+class Bolt11Payload(BaseModel):
+    bolt11: constr(strip_whitespace=True, min_length=1)  # type: ignore
+
+
+class LnurlpPayload(BaseModel):
+    callback: AnyHttpUrl
+    amount: conint(gt=0)  # type: ignore
+    comment: str | None = None
+
+
+class LnurlwPayload(BaseModel):
+    callback: AnyHttpUrl
+    amount: conint(gt=0)  # type: ignore
+    k1: constr(strip_whitespace=True, min_length=1)  # type: ignore
+
+
+class PaymentsCursorPayload(BaseModel):
+    # the cursor of the last sync, older clients send the payment_hash of their newest payment
+    cursor: str | None = None
+    # or the time of its newest payment
+    since: conint(ge=0) | None = None  # type: ignore
+
+
+class PaymentsPagePayload(PaymentsCursorPayload):
+    # pages walk back from the payment_hash the previous page ended with
+    before: str | None = None
+    limit: conint(gt=0, le=500) = 50  # type: ignore
+
+
 class User(Base):
 
     __tablename__ = "users"
@@ -30,6 +67,9 @@ class User(Base):
     lnurlw = Column(String)
     tpos = Column(String)
 
+    # an inactive user untouched for long is an abandoned signup, null on rows older than the column
+    updated_at = Column(Integer, default=lambda: int(time.time()), onupdate=lambda: int(time.time()))
+
     def __repr__(self):
         return (
             f"<User(id={self.id}, "
@@ -43,3 +83,118 @@ class User(Base):
             f'tpos="{self.tpos}", '
             f"is_active={self.is_active})>"
         )
+
+
+class Payment(Base):
+    """ local mirror of one lnbits payment of a wallet """
+
+    __tablename__ = "payments"
+    __table_args__ = (
+        UniqueConstraint("wallet", "checking_id"),
+        Index("ix_payments_wallet_time", "wallet", "time", "id"),
+        Index("ix_payments_wallet_hash", "wallet", "payment_hash"),
+        Index("ix_payments_wallet_seq", "wallet", "seq"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    wallet = Column(String, nullable=False)
+    checking_id = Column(String, nullable=False)
+    payment_hash = Column(String)
+    # msat, negative for outgoing payments
+    amount = Column(BigInteger, nullable=False, default=0)
+    fee = Column(BigInteger, nullable=False, default=0)
+    pending = Column(Boolean, nullable=False, default=False)
+    # a stand in from a webhook, lnbits has not confirmed it yet
+    provisional = Column(Boolean, nullable=False, default=False)
+    time = Column(Integer, nullable=False, default=0)
+    # bumped on every insert and update, delta syncs send what changed after the client's seq
+    seq = Column(Integer, nullable=False, default=0)
+    # the payment as lnbits encoded it, served to clients verbatim
+    data = Column(LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return (
+            f"<Payment(id={self.id}, "
+            f'wallet="{self.wallet}", '
+            f'checking_id="{self.checking_id}", '
+            f"amount={self.amount}, "
+            f"pending={self.pending})>"
+        )
+
+
+class WalletSync(Base):
+    """ when the payments of a wallet were last reconciled against lnbits """
+
+    __tablename__ = "wallet_syncs"
+
+    wallet = Column(String, primary_key=True)
+    synced_at = Column(Integer, nullable=False, default=0)
+    full_at = Column(Integer, nullable=False, default=0)
+    # the last seq handed to a payment of the wallet
+    seq = Column(Integer, nullable=False, default=0)
+
+
+class Instance(Base):
+    """ a saas instance of a user, disabled when it stops and destroyed destroy_time later """
+
+    __tablename__ = "instances"
+
+    instance_id = Column(String, primary_key=True)
+    user = Column(String, nullable=False)
+    enabled = Column(Boolean, nullable=False, default=True)
+    timestamp_stop = Column(Integer, nullable=False)
+    # None, "disable" or "destroy", the last transition applied
+    action = Column(String)
+
+    # the deadlines ahead are read from partial indexes, instances past a
+    # transition drop out of its index. queries repeat these clauses verbatim,
+    # sqlite only picks a partial index whose where clause the query contains.
+    DISABLE_PENDING = enabled.is_(True)
+    DESTROY_PENDING = action.is_distinct_from(literal_column("'destroy'"))
+
+    def __repr__(self):
+        return (
+            f'<Instance(instance_id="{self.instance_id}", '
+            f'user="{self.user}", '
+            f"enabled={self.enabled}, "
+            f"timestamp_stop={self.timestamp_stop}, "
+            f'action="{self.action}")>'
+        )
+
+
+Index(
+    "ix_instances_disable_pending", Instance.timestamp_stop,
+    sqlite_where=Instance.DISABLE_PENDING, postgresql_where=Instance.DISABLE_PENDING,
+)
+Index(
+    "ix_instances_destroy_pending", Instance.timestamp_stop,
+    sqlite_where=Instance.DESTROY_PENDING, postgresql_where=Instance.DESTROY_PENDING,
+)
+
+
+@dataclass(frozen=True, slots=True)
+class UserPrincipal:
+    """ detached, immutable snapshot of an authenticated user, safe to cache """
+    id: int
+    username: str
+    is_active: bool
+    usr: str
+    wallet_id: str
+    api_key: str
+    lnurlp: str
+    lnurlw: str
+    tpos: str
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserPrincipal":
+        return cls(
+            id=user.id,  # type: ignore
+            username=user.username,  # type: ignore
+            is_active=user.is_active,  # type: ignore
+            usr=user.usr,  # type: ignore
+            wallet_id=user.wallet_id,  # type: ignore
+            api_key=user.api_key,  # type: ignore
+            lnurlp=user.lnurlp,  # type: ignore
+            lnurlw=user.lnurlw,  # type: ignore
+            tpos=user.tpos,  # type: ignore
+        )
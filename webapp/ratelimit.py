@@ -0,0 +1,141 @@
+"""Rate limit module."""
+
+import math
+import time
+from collections import OrderedDict
+
+from .metrics import Metrics
+
+
+class RateLimited(Exception):
+    def __init__(self, rule: str, retry_after: float) -> None:
+        self.rule = rule
+        self.retry_after = max(math.ceil(retry_after), 1)
+        super().__init__(f"too many {rule} requests, retry in {self.retry_after}s")
+
+
+class Overloaded(Exception):
+    def __init__(self, resource: str) -> None:
+        super().__init__(f"server is busy, too many {resource}, retry later")
+        self.resource = resource
+        self.retry_after = 1
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float) -> None:
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        """ 0 when a token was taken, else the seconds until the next one """
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class RateLimiter:
+    """ token buckets per scope, rule and key, e.g. the pay rule of one user
+
+    a bucket holds up to burst tokens and refills at rate per second, every
+    request takes one. rules missing in a scope fall back to its default.
+    buckets are per worker, the least recently used beyond maxsize are
+    forgotten, they would be full again by then anyway.
+    """
+    RULES = {
+        "user": {
+            "default": {"rate": 10, "burst": 20},
+            "pay": {"rate": 0.5, "burst": 5},
+            "pay_lnurlp": {"rate": 0.5, "burst": 5},
+            "pay_lnurlw": {"rate": 0.5, "burst": 5},
+            "create_invoice": {"rate": 2, "burst": 10},
+            "user": {"rate": 2, "burst": 10},
+            "payments": {"rate": 2, "burst": 10},
+            # attempts on one username from one address
+            "login": {"rate": 0.2, "burst": 5},
+        },
+        "ip": {
+            # pos terminals behind one nat share an address
+            "default": {"rate": 50, "burst": 100},
+            "login": {"rate": 1, "burst": 20},
+            "signup": {"rate": 0.05, "burst": 5},
+        },
+    }
+
+    def __init__(
+        self,
+        metrics: Metrics,
+        user: dict | None = None,
+        ip: dict | None = None,
+        maxsize: int | None = None,
+    ) -> None:
+        self._rules: dict[str, dict[str, tuple[float, float] | None]] = {}
+        for scope, overrides in (("user", user), ("ip", ip)):
+            rules = {**self.RULES[scope], **(overrides or {})}
+            # an empty rule lifts the limit
+            self._rules[scope] = {
+                name: (float(rule["rate"]), float(rule.get("burst") or max(rule["rate"], 1))) if rule else None
+                for name, rule in rules.items()
+            }
+        self.maxsize = maxsize or 100_000
+        self._buckets: OrderedDict[tuple[str, str, str], TokenBucket] = OrderedDict()
+        self._rejected = metrics.counter("ratelimit_rejections_total", "requests over their rate limit", ("scope", "rule"))
+
+    def take(self, scope: str, rule: str, key: str) -> None:
+        """ raises RateLimited when key has no token left for rule """
+        rules = self._rules[scope]
+        limit = rules[rule] if rule in rules else rules.get("default")
+        if limit is None:
+            return
+        rate, burst = limit
+        now = time.monotonic()
+        bucket_key = (scope, rule, key)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self._buckets[bucket_key] = TokenBucket(burst, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(bucket_key)
+        retry_after = bucket.take(rate, burst, now)
+        if retry_after:
+            self._rejected.labels(scope, rule).inc()
+            raise RateLimited(rule, retry_after)
+
+    def stats(self) -> dict:
+        return {"buckets": len(self._buckets), "maxsize": self.maxsize}
+
+
+class Admission:
+    """ process wide caps, work beyond them is turned away right away instead of queued """
+    def __init__(self, metrics: Metrics, max_websockets: int | None = None, max_upstream: int | None = None) -> None:
+        self.max_websockets = max_websockets or 10_000
+        self.max_upstream = max_upstream or 256
+        self.upstream = 0
+        self._rejected = metrics.counter("admission_rejections_total", "work turned away at a global cap", ("resource",))
+        metrics.gauge("upstream_in_flight", "websocket actions and signups waiting on lnbits", lambda: self.upstream)
+
+    def admit_websocket(self, open_websockets: int) -> None:
+        if open_websockets >= self.max_websockets:
+            self._rejected.labels("websockets").inc()
+            raise Overloaded("websockets")
+
+    def acquire_upstream(self) -> None:
+        if self.upstream >= self.max_upstream:
+            self._rejected.labels("upstream").inc()
+            raise Overloaded("upstream requests")
+        self.upstream += 1
+
+    def release_upstream(self) -> None:
+        self.upstream -= 1
+
+    def stats(self) -> dict:
+        return {
+            "upstream": self.upstream,
+            "max_upstream": self.max_upstream,
+            "max_websockets": self.max_websockets,
+        }
@@ -1,66 +1,379 @@
 """Repositories module."""
 
-from contextlib import AbstractContextManager
+import time
+from contextlib import AbstractAsyncContextManager
 from typing import Callable, List
 
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from .models import User
+from .models import Instance, Payment, User, WalletSync
 
 
 class UserRepository:
     def __init__(
-        self, session_factory: Callable[..., AbstractContextManager[Session]]
+        self, session_factory: Callable[..., AbstractAsyncContextManager[AsyncSession]]
     ) -> None:
         self.session_factory = session_factory
 
-    def get_all(self) -> List[User]:
-        with self.session_factory() as session:
-            return session.query(User).all()
+    async def get_all(self) -> List[User]:
+        async with self.session_factory() as session:
+            result = await session.execute(select(User))
+            return result.scalars().all()
 
-    def get_by_id(self, user_id: int) -> User:
-        with self.session_factory() as session:
-            user = session.query(User).filter(User.id == user_id).first()
+    async def get_by_id(self, user_id: int) -> User:
+        async with self.session_factory() as session:
+            user = await session.get(User, user_id)
             if not user:
                 raise UserNotFoundError(user_id)
             return user
 
-    def get_by_email(self, email: str) -> User:
-        with self.session_factory() as session:
-            user = session.query(User).filter(User.email == email).first()
+    async def get_by_email(self, email: str) -> User:
+        async with self.session_factory() as session:
+            result = await session.execute(select(User).where(User.email == email))
+            user = result.scalars().first()
             if not user:
                 raise UserNotFoundError(email)
             return user
 
-    def get_by_username(self, username: str) -> User:
-        with self.session_factory() as session:
-            query = session.query(User)
-            user = query.filter(User.username == username).first()
-            if not user:
-                raise UserNotFoundError(username)
-            return user
+    async def get_by_username(self, username: str) -> User:
+        user = await self.find_by_username(username)
+        if not user:
+            raise UserNotFoundError(username)
+        return user
 
-    def exists(self, username: str) -> bool:
-        with self.session_factory() as session:
-            user = session.query(User).filter(User.username == username).first()
-            if not user:
-                return False
-            return True
+    async def find_by_username(self, username: str) -> User | None:
+        async with self.session_factory() as session:
+            result = await session.execute(select(User).where(User.username == username))
+            return result.scalars().first()
 
-    def add(self, user: User) -> User:
-        with self.session_factory() as session:
+    async def find_by_api_key(self, api_key: str) -> User | None:
+        async with self.session_factory() as session:
+            result = await session.execute(select(User).where(User.api_key == api_key))
+            return result.scalars().first()
+
+    async def exists(self, username: str) -> bool:
+        user = await self.find_by_username(username)
+        if not user:
+            return False
+        return True
+
+    async def add(self, user: User) -> User:
+        async with self.session_factory() as session:
             session.add(user)
-            session.commit()
-            session.refresh(user)
+            await session.commit()
+            await session.refresh(user)
+            return user
+
+    async def update(self, user_id: int, **fields) -> User:
+        async with self.session_factory() as session:
+            user = await session.get(User, user_id)
+            if not user:
+                raise UserNotFoundError(user_id)
+            for name, value in fields.items():
+                setattr(user, name, value)
+            await session.commit()
+            await session.refresh(user)
             return user
 
-    def delete_by_id(self, user_id: int) -> None:
-        with self.session_factory() as session:
-            entity: User = session.query(User).filter(User.id == user_id).first()  # type: ignore
+    async def get_abandoned(self, before: int) -> List[User]:
+        """ signups not finished nor resumed since before """
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(User).where(
+                    User.is_active == False,  # noqa: E712
+                    # a null updated_at was written by a worker predating the column, it counts as now
+                    func.coalesce(User.updated_at, int(time.time())) < before,
+                )
+            )
+            return result.scalars().all()
+
+    async def delete_by_id(self, user_id: int) -> None:
+        async with self.session_factory() as session:
+            entity: User = await session.get(User, user_id)  # type: ignore
             if not entity:
                 raise UserNotFoundError(user_id)
-            session.delete(entity)
-            session.commit()
+            await session.delete(entity)
+            await session.commit()
+
+
+class PaymentRepository:
+    """ payments are ordered newest first by (time, id), page cursors are such pairs
+
+    every write stamps the rows it touches with the next seq of the wallet,
+    delta syncs ask for the rows changed after a seq.
+    """
+    COLUMNS = (Payment.id, Payment.time, Payment.payment_hash, Payment.seq, Payment.data)
+    # each conflict means another writer got ahead, this many concurrent writers of a wallet get through
+    WRITE_ATTEMPTS = 5
+
+    def __init__(
+        self, session_factory: Callable[..., AbstractAsyncContextManager[AsyncSession]]
+    ) -> None:
+        self.session_factory = session_factory
+
+    async def upsert(self, wallet: str, payments: List[dict], provisional: bool = False) -> int:
+        """ inserts new and updates changed payments, returns the number of rows written
+
+        provisional payments are keyed by payment_hash and never overwrite a row,
+        the real payment replaces them once lnbits reports it. until then they
+        are left out of the balance.
+        """
+        if not payments:
+            return 0
+        async with self.session_factory() as session:
+            attempt = 1
+            while True:
+                try:
+                    written = await self._write(session, wallet, payments, provisional)
+                    await session.commit()
+                    return written
+                except IntegrityError:
+                    # sse, a pass or a webhook committed one of the payments first, the next look finds its row
+                    if attempt == self.WRITE_ATTEMPTS:
+                        raise
+                    attempt += 1
+                    await session.rollback()
+
+    async def _write(self, session: AsyncSession, wallet: str, payments: List[dict], provisional: bool) -> int:
+        checking_ids = {payment["checking_id"] for payment in payments}
+        hashes = {payment["payment_hash"] for payment in payments if payment.get("payment_hash")}
+        result = await session.execute(
+            select(Payment).where(
+                Payment.wallet == wallet,
+                or_(Payment.checking_id.in_(checking_ids), Payment.payment_hash.in_(hashes)),
+            )
+        )
+        rows: dict[str, Payment] = {}
+        by_hash: dict[str, Payment] = {}
+        for row in result.scalars():
+            rows[row.checking_id] = row
+            if row.payment_hash:
+                by_hash.setdefault(row.payment_hash, row)
+        changed: list[Payment] = []
+        for payment in payments:
+            row = rows.get(payment["checking_id"])
+            if row is None and payment.get("payment_hash"):
+                # a stand in is replaced by the received payment, and never recorded next to a known one
+                known = by_hash.get(payment["payment_hash"])
+                if known is not None and (provisional or (known.provisional and payment["amount"] > 0)):
+                    row = known
+            if row is None:
+                row = Payment(wallet=wallet, provisional=provisional, **payment)
+                session.add(row)
+                rows[row.checking_id] = row
+                if row.payment_hash:
+                    by_hash.setdefault(row.payment_hash, row)
+                changed.append(row)
+            elif not provisional and (row.provisional or row.data != payment["data"]):
+                for name, value in payment.items():
+                    setattr(row, name, value)
+                row.provisional = False
+                changed.append(row)
+        if changed:
+            seq = await self._claim_seq(session, wallet, len(changed))
+            for row in changed:
+                seq += 1
+                row.seq = seq
+        return len(changed)
+
+    async def _claim_seq(self, session: AsyncSession, wallet: str, count: int) -> int:
+        """ reserves count seqs of the wallet, returns the last one taken before them
+
+        the update locks the counter until commit, writers of one wallet commit
+        in seq order and a client never skips a seq committed after its cursor.
+        """
+        result = await session.execute(
+            update(WalletSync)
+            .where(WalletSync.wallet == wallet)
+            .values(seq=WalletSync.seq + count)
+            .execution_options(synchronize_session=False)
+        )
+        if not result.rowcount:
+            session.add(WalletSync(wallet=wallet, synced_at=0, full_at=0, seq=count))
+            await session.flush()
+            return 0
+        last = await session.execute(select(WalletSync.seq).where(WalletSync.wallet == wallet))
+        return last.scalar_one() - count
+
+    def _ordered(self, wallet: str):
+        return (
+            select(*self.COLUMNS)
+            .where(Payment.wallet == wallet)
+            .order_by(Payment.time.desc(), Payment.id.desc())
+        )
+
+    async def list(
+        self,
+        wallet: str,
+        changed_after: int | None = None,
+        before: Row | None = None,
+        since: int | None = None,
+        limit: int | None = None,
+    ) -> List[Row]:
+        query = self._ordered(wallet)
+        if changed_after is not None:
+            query = query.where(Payment.seq > changed_after)
+        if before is not None:
+            query = query.where(or_(
+                Payment.time < before.time,
+                and_(Payment.time == before.time, Payment.id < before.id),
+            ))
+        if since is not None:
+            # payments in the client's newest second may be new to it, clients merge by payment_hash
+            query = query.where(Payment.time >= since)
+        if limit is not None:
+            query = query.limit(limit)
+        async with self.session_factory() as session:
+            result = await session.execute(query)
+            return result.all()
+
+    async def find(self, wallet: str, payment_hash: str) -> Row | None:
+        async with self.session_factory() as session:
+            result = await session.execute(
+                self._ordered(wallet).where(Payment.payment_hash == payment_hash).limit(1)
+            )
+            return result.first()
+
+    async def newest(self, wallet: str) -> Row | None:
+        async with self.session_factory() as session:
+            result = await session.execute(self._ordered(wallet).limit(1))
+            return result.first()
+
+    async def count(self, wallet: str) -> int:
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(func.count(Payment.id)).where(Payment.wallet == wallet)
+            )
+            return result.scalar_one()
+
+    async def balance(self, wallet: str) -> int:
+        """ msat, computed like lnbits: settled incoming plus all outgoing, fees included """
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(func.coalesce(func.sum(Payment.amount - func.abs(Payment.fee)), 0))
+                .where(Payment.wallet == wallet, Payment.provisional == False)  # noqa: E712
+                .where(or_(Payment.pending == False, Payment.amount < 0))  # noqa: E712
+            )
+            return int(result.scalar_one())
+
+    async def drop_missing(self, wallet: str, listed: set[str], through: int) -> int:
+        """ deletes the unsettled payments and stand ins up to seq through that lnbits did not list
+
+        lnbits never deletes a settled payment, one missing from a full pass was
+        skipped by offsets shifting under the pass and is kept.
+        """
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(Payment.id, Payment.checking_id)
+                .where(Payment.wallet == wallet, Payment.seq <= through)
+                .where(or_(Payment.pending == True, Payment.provisional == True))  # noqa: E712
+            )
+            missing = [row.id for row in result if row.checking_id not in listed]
+            for start in range(0, len(missing), 500):
+                await session.execute(
+                    delete(Payment)
+                    .where(Payment.id.in_(missing[start:start + 500]))
+                    .execution_options(synchronize_session=False)
+                )
+            await session.commit()
+            return len(missing)
+
+    async def last_seq(self, wallet: str) -> int:
+        async with self.session_factory() as session:
+            result = await session.execute(select(WalletSync.seq).where(WalletSync.wallet == wallet))
+            return result.scalar() or 0
+
+    async def get_sync(self, wallet: str) -> WalletSync | None:
+        async with self.session_factory() as session:
+            return await session.get(WalletSync, wallet)
+
+    async def get_syncs(self) -> dict[str, WalletSync]:
+        async with self.session_factory() as session:
+            result = await session.execute(select(WalletSync))
+            return {sync.wallet: sync for sync in result.scalars()}
+
+    async def mark_synced(self, wallet: str, full: bool) -> None:
+        now = int(time.time())
+        async with self.session_factory() as session:
+            sync = await session.get(WalletSync, wallet)
+            if sync is None:
+                sync = WalletSync(wallet=wallet, full_at=0, seq=0)
+                session.add(sync)
+            sync.synced_at = now
+            if full:
+                sync.full_at = now
+            await session.commit()
+
+
+class InstanceRepository:
+    """ instance deadlines are read by range from partial indexes, never by scanning the table
+
+    a disable is due at timestamp_stop, a destroy destroy_time after it.
+    """
+    # bound parameters per statement, sqlite allows 999
+    CHUNK = 500
+
+    def __init__(
+        self, session_factory: Callable[..., AbstractAsyncContextManager[AsyncSession]]
+    ) -> None:
+        self.session_factory = session_factory
+
+    async def add(self, instance: Instance) -> Instance:
+        async with self.session_factory() as session:
+            session.add(instance)
+            await session.commit()
+            await session.refresh(instance)
+            return instance
+
+    async def due(self, until: int, destroy_time: int) -> list[tuple[int, str, str]]:
+        """ (due, instance_id, action) of every transition due by until, overdue ones included """
+        async with self.session_factory() as session:
+            disable = await session.execute(
+                select(Instance.timestamp_stop, Instance.instance_id)
+                .where(Instance.timestamp_stop <= until, Instance.DISABLE_PENDING)
+            )
+            destroy = await session.execute(
+                select(Instance.timestamp_stop, Instance.instance_id)
+                .where(Instance.timestamp_stop <= until - destroy_time, Instance.DESTROY_PENDING)
+            )
+            return [
+                *((stop, instance_id, "disable") for stop, instance_id in disable),
+                *((stop + destroy_time, instance_id, "destroy") for stop, instance_id in destroy),
+            ]
+
+    async def apply(self, action: str, instance_ids: List[str], now: int, destroy_time: int) -> List[str]:
+        """ applies one transition to many instances, returns the ids it changed
+
+        the where clause checks the deadline again, an instance extended since it
+        was scheduled or handled by another process is left alone.
+        """
+        if action == "disable":
+            guard = and_(Instance.DISABLE_PENDING, Instance.timestamp_stop <= now)
+        else:
+            guard = and_(Instance.DESTROY_PENDING, Instance.timestamp_stop <= now - destroy_time)
+        changed: List[str] = []
+        async with self.session_factory() as session:
+            for start in range(0, len(instance_ids), self.CHUNK):
+                chunk = Instance.instance_id.in_(instance_ids[start:start + self.CHUNK])
+                # row locks on postgres, the ids handed on are exactly the ones this update changes
+                result = await session.execute(
+                    select(Instance.instance_id).where(chunk, guard).with_for_update()
+                )
+                ids = result.scalars().all()
+                if not ids:
+                    continue
+                await session.execute(
+                    update(Instance)
+                    .where(Instance.instance_id.in_(ids))
+                    .values(enabled=False, action=action)
+                    .execution_options(synchronize_session=False)
+                )
+                changed.extend(ids)
+            await session.commit()
+        return changed
 
 
 class NotFoundError(Exception):
@@ -0,0 +1,88 @@
+"""Serializer module."""
+
+import json
+import logging
+import secrets
+from typing import Any
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+logger = logging.getLogger("uvicorn")
+
+
+class RawJSON:
+    """ an already encoded json document, embedded verbatim when serialized """
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+
+class Serializer:
+    """ stdlib json, always available """
+    name = "json"
+
+    def __init__(self) -> None:
+        # raw fragments are encoded as this marker first and spliced in afterwards
+        self._marker = f"__raw_json_{secrets.token_hex(8)}_"
+
+    def encode(self, obj: Any, default) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=default).encode("utf-8")
+
+    def loads(self, data: bytes | str) -> Any:
+        return json.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        fragments: list[bytes] = []
+
+        def default(value):
+            if isinstance(value, RawJSON):
+                fragments.append(value.data)
+                return f"{self._marker}{len(fragments) - 1}"
+            raise TypeError(f"type is not json serializable: {type(value).__name__}")
+
+        encoded = self.encode(obj, default)
+        for index, fragment in enumerate(fragments):
+            encoded = encoded.replace(f'"{self._marker}{index}"'.encode("utf-8"), fragment, 1)
+        return encoded
+
+    def dumps_text(self, obj: Any) -> str:
+        """ for websocket text frames """
+        return self.dumps(obj).decode("utf-8")
+
+
+class OrjsonSerializer(Serializer):
+    name = "orjson"
+
+    def encode(self, obj: Any, default) -> bytes:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data: bytes | str) -> Any:
+        return orjson.loads(data)
+
+
+def create_serializer(backend: str | None = None) -> Serializer:
+    backend = backend or "auto"
+    if backend in ("auto", "orjson"):
+        if orjson is not None:
+            return OrjsonSerializer()
+        if backend == "orjson":
+            logger.warning("orjson is not installed, falling back to stdlib json")
+        return Serializer()
+    if backend != "json":
+        raise ValueError(f"unknown json backend: {backend}")
+    return Serializer()
+
+
+def json_response_class(serializer: Serializer) -> type[JSONResponse]:
+    """ default response class of the app, rendering with the configured serializer """
+    class SerializedJSONResponse(JSONResponse):
+        def render(self, content: Any) -> bytes:
+            return serializer.dumps(content)
+
+    return SerializedJSONResponse
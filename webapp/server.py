@@ -1,15 +1,257 @@
+"""Server module."""
+
+import asyncio
+import logging
+import logging.config
+import os
+import selectors
+import signal
+import socket
+import time
+
 import uvicorn
 
 from .application import create_app
+from .containers import Container
+from .services.eventbus import UnixSocketEventBus
+
+logger = logging.getLogger("uvicorn")
+
+
+def bind_socket(host: str, port: int, backlog: int) -> socket.socket:
+    """ the listening socket is bound once in the supervisor and inherited by every worker """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def heartbeat(app, fd: int, interval: float) -> None:
+    """ writes to the supervisor pipe for as long as the event loop of the worker keeps turning """
+    @app.on_event("startup")
+    async def start_heartbeat():
+        loop = asyncio.get_running_loop()
+
+        def beat():
+            try:
+                os.write(fd, b".")
+            except BlockingIOError:
+                pass
+            except BrokenPipeError:
+                logger.warning("supervisor is gone, shutting down")
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            loop.call_later(interval, beat)
+
+        beat()
+
+
+class DrainingServer(uvicorn.Server):
+    """ closes the websockets with going away before uvicorn drops their connections """
+    def __init__(self, config: uvicorn.Config, drain_timeout: float) -> None:
+        super().__init__(config)
+        self._drain_timeout = drain_timeout
+
+    async def shutdown(self, sockets: list[socket.socket] | None = None) -> None:
+        for server in self.servers:
+            server.close()
+        registry = self.config.app.container.connection_registry()
+        if len(registry):
+            logger.info(f"closing {len(registry)} websockets")
+            try:
+                await asyncio.wait_for(registry.close_all(), self._drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"websockets did not close in {self._drain_timeout}s")
+        await super().shutdown(sockets)
+
+
+def forwarded_allow_ips(options: dict) -> str:
+    """ proxies whose X-Forwarded-For sets the client address, the per address limits key on it """
+    return options.get("forwarded_allow_ips") or "127.0.0.1"
+
+
+def serve_worker(container: Container, sock: socket.socket, fd: int, health_interval: float, drain_timeout: float) -> None:
+    # the supervisor only read the config, engines, pools and hubs are built on startup and belong to this worker
+    app = create_app(container)
+    heartbeat(app, fd, health_interval)
+    config = uvicorn.Config(app, forwarded_allow_ips=forwarded_allow_ips(container.config.uvicorn()))
+    DrainingServer(config, drain_timeout).run(sockets=[sock])
+
+
+class Worker:
+    __slots__ = ("pid", "fd", "started", "seen")
+
+    def __init__(self, pid: int, fd: int) -> None:
+        self.pid = pid
+        self.fd = fd
+        self.started = self.seen = time.monotonic()
+
+
+class Supervisor:
+    """ forks the workers, replaces the ones that die or stop beating and drains them on SIGTERM """
+    MAX_BACKOFF = 30.0
+
+    def __init__(
+        self,
+        container: Container,
+        sock: socket.socket,
+        workers: int,
+        graceful_timeout: float,
+        health_interval: float,
+        health_timeout: float,
+    ) -> None:
+        self._container = container
+        self._sock = sock
+        self._size = workers
+        self._graceful_timeout = graceful_timeout
+        self._health_interval = health_interval
+        self._health_timeout = health_timeout
+        self._workers: dict[int, Worker] = {}
+        self._selector = selectors.DefaultSelector()
+        self._stopping = False
+        self._failures = 0
+        self._spawn_after = 0.0
+        # a worker killed before it closed its bus leaves its socket behind
+        self._unix_bus = container.config.bus.backend() == "unix"
+        self._bus_path = container.config.bus.path()
+
+    def stop(self, signum, _) -> None:
+        logger.info(f"supervisor received {signal.Signals(signum).name}, draining workers")
+        self._stopping = True
+
+    def spawn(self) -> None:
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        os.set_blocking(write_fd, False)
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._selector.close()
+            for worker in self._workers.values():
+                os.close(worker.fd)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                serve_worker(self._container, self._sock, write_fd, self._health_interval, self._graceful_timeout / 2)
+            except BaseException:
+                logger.exception("worker crashed")
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        self._workers[pid] = Worker(pid, read_fd)
+        self._selector.register(read_fd, selectors.EVENT_READ, pid)
+        logger.info(f"started worker {pid}")
+
+    def forget(self, pid: int, status: int) -> None:
+        worker = self._workers.pop(pid, None)
+        if not worker:
+            return
+        self._selector.unregister(worker.fd)
+        os.close(worker.fd)
+        if self._unix_bus:
+            UnixSocketEventBus.remove_peer(self._bus_path, str(pid))
+        code = os.waitstatus_to_exitcode(status)
+        if self._stopping:
+            logger.info(f"worker {pid} exited with {code}")
+            return
+        logger.error(f"worker {pid} exited with {code}, replacing it")
+        # a worker that dies right after the fork usually dies again, back off before the next one
+        if time.monotonic() - worker.started < self._health_timeout:
+            self._failures += 1
+            self._spawn_after = time.monotonic() + min(2 ** self._failures, self.MAX_BACKOFF)
+        else:
+            self._failures = 0
+
+    def reap(self) -> None:
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.forget(pid, status)
+
+    def read_beats(self, timeout: float) -> None:
+        for key, _ in self._selector.select(timeout=timeout):
+            try:
+                os.read(key.fd, 1024)
+            except BlockingIOError:
+                continue
+            worker = self._workers.get(key.data)
+            if worker:
+                worker.seen = time.monotonic()
+
+    def check_health(self) -> None:
+        now = time.monotonic()
+        for worker in self._workers.values():
+            if now - worker.seen > self._health_timeout:
+                logger.error(f"worker {worker.pid} missed its heartbeat for {now - worker.seen:.0f}s, killing it")
+                os.kill(worker.pid, signal.SIGKILL)
+
+    def drain(self) -> None:
+        for pid in self._workers:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self._graceful_timeout
+        while self._workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self._workers):
+            logger.warning(f"worker {pid} did not drain in {self._graceful_timeout}s, killing it")
+            os.kill(pid, signal.SIGKILL)
+            _, status = os.waitpid(pid, 0)
+            self.forget(pid, status)
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(f"supervisor {os.getpid()} serving {self._size} workers")
+        while not self._stopping:
+            if len(self._workers) < self._size and time.monotonic() >= self._spawn_after:
+                self.spawn()
+                continue
+            self.read_beats(min(self._health_interval, 1.0))
+            self.reap()
+            self.check_health()
+        self.drain()
+        self._selector.close()
+        self._sock.close()
+        logger.info("supervisor stopped")
 
 
 def start():
-    app = create_app()
-    config = uvicorn.Config(
-        app,
-        host=app.container.config.uvicorn.host(),
-        port=app.container.config.uvicorn.port(),
-        forwarded_allow_ips="*"
-    )
-    server = uvicorn.Server(config)
-    server.run()
+    container = Container()
+    config = container.config
+    options = config.uvicorn()
+    workers = options.get("workers") or 1
+    if workers <= 1:
+        app = create_app(container)
+        DrainingServer(uvicorn.Config(
+            app,
+            host=options["host"],
+            port=options["port"],
+            forwarded_allow_ips=forwarded_allow_ips(options),
+        ), (options.get("graceful_timeout") or 30) / 2).run()
+        return
+
+    logging.config.dictConfig(uvicorn.config.LOGGING_CONFIG)
+    if (config.bus.backend() or "local") == "local":
+        logger.warning("bus backend is local, pushes and sse events will not reach other workers")
+    sock = bind_socket(options["host"], options["port"], options.get("backlog") or 2048)
+    Supervisor(
+        container,
+        sock,
+        workers,
+        graceful_timeout=options.get("graceful_timeout") or 30,
+        health_interval=options.get("health_interval") or 5,
+        health_timeout=options.get("health_timeout") or 30,
+    ).run()
+
+
+if __name__ == "__main__":
+    start()
@@ -0,0 +1,133 @@
+import asyncio
+from itertools import count
+from typing import Any, Coroutine
+
+from fastapi import WebSocket
+
+from webapp.cache import TTLCache
+from webapp.metrics import Metrics
+from webapp.models import UserPrincipal
+from webapp.serializer import Serializer
+from webapp.services.eventbus import EventBus
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class Connection:
+    """ everything one open websocket owns, the services are shared by all of them
+
+    a worker holds many thousands, slots keep the record small and the pieces
+    only a busy connection needs are created on first use.
+    """
+    __slots__ = ("websocket", "user", "ip", "serial", "slots", "ordered", "tasks", "sse", "sse_pending")
+
+    def __init__(self, websocket: WebSocket, user: UserPrincipal, serial: int) -> None:
+        self.websocket = websocket
+        self.user = user
+        # behind a proxy uvicorn takes it from x-forwarded-for
+        self.ip = websocket.client.host if websocket.client else ""
+        # id() of a closed socket gets reused, dedupe keys use the serial instead
+        self.serial = serial
+        # free action slots, set up by the first action
+        self.slots: asyncio.Semaphore | None = None
+        # held by actions that move funds, they run one at a time and in order
+        self.ordered: asyncio.Lock | None = None
+        self.tasks: set[asyncio.Task] | None = None
+        # the service delivering the wallet's sse events, and how many are on their way
+        self.sse: Any = None
+        self.sse_pending = 0
+
+    def spawn(self, coro: Coroutine) -> asyncio.Task:
+        """ runs coro for this connection, it is cancelled when the connection closes """
+        if self.tasks is None:
+            self.tasks = set()
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def cancel(self) -> None:
+        for task in list(self.tasks or ()):
+            task.cancel()
+
+    def put_nowait(self, sse_event: dict) -> None:
+        """ the sse hub hands events to its subscribers like to a queue """
+        self.sse.deliver(self, sse_event)
+
+
+class ConnectionRegistry:
+    """ live websockets of this process by username """
+    def __init__(self, event_bus: EventBus, serializer: Serializer, metrics: Metrics) -> None:
+        self._bus = event_bus
+        self._serializer = serializer
+        self._connections: dict[str, set[Connection]] = {}
+        self._count = 0
+        self._counter = count()
+        # sse and webhook both report lnurlp payments, each socket hears once of them pending and once settled
+        self._delivered = TTLCache(maxsize=100_000, ttl=600)
+        event_bus.subscribe("push", self.on_push)
+        metrics.gauge("websocket_connections", "open websockets", self.__len__)
+
+    def add(self, user: UserPrincipal, websocket: WebSocket) -> Connection:
+        connection = Connection(websocket, user, next(self._counter))
+        self._connections.setdefault(user.username, set()).add(connection)
+        self._count += 1
+        return connection
+
+    def remove(self, connection: Connection) -> None:
+        username = connection.user.username
+        connections = self._connections.get(username)
+        if connections is None or connection not in connections:
+            return
+        connections.discard(connection)
+        self._count -= 1
+        if not connections:
+            del self._connections[username]
+
+    def connections(self, username: str) -> set[Connection]:
+        return self._connections.get(username, set())
+
+    def __len__(self) -> int:
+        return self._count
+
+    async def close_all(self, code: int = 1001) -> None:
+        """ closes every websocket of this process, clients see going away and reconnect """
+        for username, connections in list(self._connections.items()):
+            for connection in list(connections):
+                try:
+                    await connection.websocket.close(code)
+                except Exception as exc:
+                    logger.warning(f"closing websocket of {username} failed: {exc}")
+
+    async def send(self, connection: Connection, message: dict) -> None:
+        if message.get("type") == "payment_received" and isinstance(message.get("data"), dict):
+            payment_hash = message["data"].get("payment_hash")
+            if payment_hash:
+                key = (connection.serial, payment_hash)
+                pending = bool(message["data"].get("pending"))
+                # the webhook's pending stand in is followed by the confirmation, never the other way round
+                delivered = self._delivered.peek(key)
+                if delivered is not None and (pending or not delivered):
+                    return
+                self._delivered.set(key, pending)
+        await connection.websocket.send_text(self._serializer.dumps_text(message))
+
+    async def broadcast(self, username: str, message: dict) -> int:
+        sent = 0
+        for connection in list(self.connections(username)):
+            try:
+                await self.send(connection, message)
+                sent += 1
+            except Exception as exc:
+                logger.warning(f"dropping websocket of {username}: {exc}")
+                self.remove(connection)
+        return sent
+
+    def publish(self, username: str, message: dict) -> None:
+        """ delivers to the user's websockets in whichever worker holds them """
+        self._bus.publish("push", {"username": username, "message": message})
+
+    async def on_push(self, payload: dict) -> None:
+        if payload["username"] in self._connections:
+            await self.broadcast(payload["username"], payload["message"])
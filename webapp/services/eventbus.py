@@ -0,0 +1,231 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+Handler = Callable[[dict], Any]
+
+
+class EventBus(ABC):
+    """ pub/sub between the workers of one host, messages are batched per peer """
+    def __init__(self, batch_delay: float | None = None) -> None:
+        self.peer_id = str(os.getpid())
+        self._batch_delay = batch_delay or 0.002
+        self._handlers: dict[str, list[Handler]] = {}
+        self._pending: dict[str | None, list[tuple[str, dict]]] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+
+    def subscribe(self, kind: str, handler: Handler) -> None:
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def publish(self, kind: str, payload: dict, peer: str | None = None) -> None:
+        """ queues a message for one peer, or for every worker including this one """
+        self._pending.setdefault(peer, []).append((kind, payload))
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self._batch_delay, self.flush)
+
+    def flush(self) -> None:
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        for peer, messages in pending.items():
+            if peer is None or peer == self.peer_id:
+                self.deliver(messages)
+            if peer != self.peer_id:
+                self.send(peer, messages)
+
+    def deliver(self, messages: list[tuple[str, dict]]) -> None:
+        for kind, payload in messages:
+            for handler in self._handlers.get(kind, []):
+                try:
+                    result = handler(payload)
+                    if asyncio.iscoroutine(result):
+                        asyncio.create_task(result)
+                except Exception as exc:
+                    logger.error(f"event bus handler for {kind} failed: {exc!r}")
+
+    @abstractmethod
+    def peers(self) -> list[str]:
+        """ ids of all live workers, this one included """
+
+    @abstractmethod
+    def send(self, peer: str | None, messages: list[tuple[str, dict]]) -> None:
+        """ ships a batch to one other worker, or to all others for None """
+
+    async def start(self) -> None:
+        """ binds the transport, needs the running event loop """
+
+    async def close(self) -> None:
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self.flush()
+
+
+class LocalEventBus(EventBus):
+    """ single process backend, every message stays in this worker """
+    def peers(self) -> list[str]:
+        return [self.peer_id]
+
+    def send(self, peer: str | None, messages: list[tuple[str, dict]]) -> None:
+        if peer is not None:
+            logger.warning(f"event bus peer {peer} unknown to the local backend, dropping {len(messages)} messages")
+
+
+def alive(peer: str) -> bool:
+    """ peer ids are pids, a pid reused by an unrelated process passes until its next send fails """
+    try:
+        os.kill(int(peer), 0)
+    except ValueError:
+        return False
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class UnixSocketEventBus(EventBus):
+    """ every worker binds a datagram socket in a shared directory, its peers are the other sockets there """
+    MAX_DATAGRAM = 64 * 1024
+    PEER_REFRESH = 1.0
+    PATH = "/tmp/webapp-bus"
+
+    def __init__(self, path: str | None = None, batch_delay: float | None = None) -> None:
+        super().__init__(batch_delay)
+        self._path = path or self.PATH
+        self._address = self.address(self._path, self.peer_id)
+        self._receiver: socket.socket | None = None
+        self._sender: socket.socket | None = None
+        self._peers: list[str] = [self.peer_id]
+        self._peers_at = 0.0
+
+    async def start(self) -> None:
+        os.makedirs(self._path, mode=0o700, exist_ok=True)
+        if os.path.exists(self._address):
+            os.unlink(self._address)
+        self._receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._receiver.bind(self._address)
+        self._receiver.setblocking(False)
+        # uvloop has no unix datagram endpoints, a reader callback works on both loops
+        asyncio.get_running_loop().add_reader(self._receiver.fileno(), self.receive)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        logger.info(f"event bus listening on {self._address}")
+
+    async def close(self) -> None:
+        await super().close()
+        if self._receiver:
+            asyncio.get_running_loop().remove_reader(self._receiver.fileno())
+            self._receiver.close()
+            self._receiver = None
+        if self._sender:
+            self._sender.close()
+            self._sender = None
+        if os.path.exists(self._address):
+            os.unlink(self._address)
+
+    @classmethod
+    def address(cls, path: str | None, peer: str) -> str:
+        return os.path.join(path or cls.PATH, f"{peer}.sock")
+
+    @classmethod
+    def remove_peer(cls, path: str | None, peer: str) -> None:
+        """ unlinks the socket of a worker that died without closing its bus """
+        try:
+            os.unlink(cls.address(path, peer))
+        except FileNotFoundError:
+            pass
+
+    def peers(self) -> list[str]:
+        now = time.monotonic()
+        if now - self._peers_at > self.PEER_REFRESH:
+            self._peers_at = now
+            try:
+                names = os.listdir(self._path)
+            except FileNotFoundError:
+                names = []
+            peers = {self.peer_id}
+            for name in names:
+                if not name.endswith(".sock"):
+                    continue
+                peer = name[:-5]
+                if peer == self.peer_id or alive(peer):
+                    peers.add(peer)
+                else:
+                    # a killed worker leaves its socket, and the first peer leads the ledger and expiry
+                    logger.info(f"event bus peer {peer} is gone")
+                    self.remove_peer(self._path, peer)
+            self._peers = sorted(peers)
+        return self._peers
+
+    def batches(self, messages: list[tuple[str, dict]]) -> list[bytes]:
+        batches: list[bytes] = []
+        batch: list[bytes] = []
+        size = 2
+        for kind, payload in messages:
+            encoded = json.dumps([kind, payload], separators=(",", ":")).encode("utf-8")
+            if batch and size + len(encoded) + 1 > self.MAX_DATAGRAM:
+                batches.append(b"[" + b",".join(batch) + b"]")
+                batch, size = [], 2
+            batch.append(encoded)
+            size += len(encoded) + 1
+        if batch:
+            batches.append(b"[" + b",".join(batch) + b"]")
+        return batches
+
+    def send(self, peer: str | None, messages: list[tuple[str, dict]]) -> None:
+        if not self._sender:
+            return
+        targets = [peer] if peer else [p for p in self.peers() if p != self.peer_id]
+        if not targets:
+            return
+        batches = self.batches(messages)
+        for target in targets:
+            address = self.address(self._path, target)
+            for datagram in batches:
+                try:
+                    self._sender.sendto(datagram, address)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # the worker is gone, forget its socket
+                    logger.info(f"event bus peer {target} is gone")
+                    self.forget(target, address)
+                    break
+                except BlockingIOError:
+                    logger.warning(f"event bus peer {target} is not reading, dropping a batch")
+                except OSError as exc:
+                    logger.error(f"event bus send to {target} failed: {exc!r}")
+
+    def forget(self, peer: str, address: str) -> None:
+        if peer in self._peers:
+            self._peers.remove(peer)
+        try:
+            os.unlink(address)
+        except FileNotFoundError:
+            pass
+
+    def receive(self) -> None:
+        while self._receiver:
+            try:
+                data = self._receiver.recv(self.MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                messages = [(kind, payload) for kind, payload in json.loads(data)]
+            except ValueError as exc:
+                logger.error(f"event bus received garbage: {exc!r}")
+                continue
+            self.deliver(messages)
+
+
+def create_event_bus(backend: str | None = None, path: str | None = None, batch_delay: float | None = None) -> EventBus:
+    if backend == "unix":
+        return UnixSocketEventBus(path=path, batch_delay=batch_delay)
+    if backend not in (None, "local"):
+        raise ValueError(f"unknown event bus backend: {backend}")
+    return LocalEventBus(batch_delay=batch_delay)
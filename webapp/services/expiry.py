@@ -0,0 +1,168 @@
+import asyncio
+import heapq
+import time
+from typing import Any, Callable, List
+
+from webapp.repositories import InstanceRepository
+from webapp.services.eventbus import EventBus
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """ disables instances when they stop and destroys them destroy_time later
+
+    the transitions due within the next window are read from the
+    timestamp_stop index into a heap, the scheduler sleeps until the earliest
+    of them and applies everything due by then in one update per transition.
+    the table is read once per window however many instances it holds, and
+    instances stopping inside the current window are added with schedule().
+
+    the database only records the transition, the code that runs instances
+    registers a handler with observe() to actually stop or tear them down.
+    until it does, or schedules an instance, the loop does not touch the table.
+    """
+    def __init__(
+        self,
+        instance_repository: InstanceRepository,
+        event_bus: EventBus,
+        destroy_time: int | None = None,
+        window: float | None = None,
+    ) -> None:
+        self._instances = instance_repository
+        self._bus = event_bus
+        self._destroy_time = int(destroy_time or 1_296_000)
+        self._window = window or 3600.0
+        self._heap: list[tuple[int, str, str]] = []
+        # the current deadline of each scheduled transition, heap entries differing from it are stale
+        self._due: dict[tuple[str, str], int] = {}
+        self._loaded_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._wanted = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.disabled = 0
+        self.destroyed = 0
+        self.last_load = 0
+        self._observers: list[Callable[[str, List[str]], Any]] = []
+        event_bus.subscribe("instance_scheduled", self.on_scheduled)
+
+    def observe(self, observer: Callable[[str, List[str]], Any]) -> None:
+        """ registers a callback, or coroutine function, getting the action and the ids it was applied to """
+        self._observers.append(observer)
+        self._wanted.set()
+
+    def schedule(self, instance_id: str, timestamp_stop: int) -> None:
+        """ call after an instance was created or its timestamp_stop changed, from any worker """
+        self._bus.publish(
+            "instance_scheduled",
+            {"instance_id": instance_id, "timestamp_stop": int(timestamp_stop)},
+            peer=self._bus.peers()[0],
+        )
+
+    def on_scheduled(self, payload: dict) -> None:
+        instance_id, timestamp_stop = payload["instance_id"], payload["timestamp_stop"]
+        self._wanted.set()
+        for due, action in ((timestamp_stop, "disable"), (timestamp_stop + self._destroy_time, "destroy")):
+            if due > self._loaded_until:
+                # the next window load picks it up
+                self._due.pop((instance_id, action), None)
+                continue
+            self._push(due, instance_id, action)
+        self._wakeup.set()
+
+    def _push(self, due: int, instance_id: str, action: str) -> None:
+        if self._due.get((instance_id, action)) == due:
+            return
+        self._due[(instance_id, action)] = due
+        heapq.heappush(self._heap, (due, instance_id, action))
+
+    async def load(self, now: float) -> None:
+        until = now + self._window
+        due = await self._instances.due(int(until), self._destroy_time)
+        # merged rather than replaced, a schedule() arriving during the query is kept
+        for entry in due:
+            self._push(*entry)
+        self._loaded_until = until
+        self.last_load = len(due)
+
+    async def apply_due(self, now: float) -> int:
+        """ pops every transition due by now, one update per transition for all of them """
+        batches: dict[str, list[str]] = {"disable": [], "destroy": []}
+        while self._heap and self._heap[0][0] <= now:
+            due, instance_id, action = heapq.heappop(self._heap)
+            if self._due.get((instance_id, action)) != due:
+                continue
+            del self._due[(instance_id, action)]
+            batches[action].append(instance_id)
+        changed = 0
+        for action, instance_ids in batches.items():
+            if not instance_ids:
+                continue
+            applied = await self._instances.apply(action, instance_ids, int(now), self._destroy_time)
+            if action == "disable":
+                self.disabled += len(applied)
+            else:
+                self.destroyed += len(applied)
+            changed += len(applied)
+            logger.info(f"{action} applied to {len(applied)} of {len(instance_ids)} due instances")
+            if applied:
+                await self._notify(action, applied)
+        return changed
+
+    async def _notify(self, action: str, instance_ids: List[str]) -> None:
+        if not self._observers:
+            logger.warning(f"no {action} handler registered, {len(instance_ids)} instances are only marked in the database")
+        for observer in self._observers:
+            try:
+                result = observer(action, instance_ids)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as exc:
+                logger.error(f"instance {action} handler failed: {exc!r}")
+
+    async def run(self) -> None:
+        await self._wanted.wait()
+        while True:
+            # the database is shared, one worker applies the transitions for all of them
+            if self._bus.peers()[0] != self._bus.peer_id:
+                self._loaded_until = 0.0
+                self._heap.clear()
+                self._due.clear()
+                await asyncio.sleep(min(self._window, 60.0))
+                continue
+            try:
+                now = time.time()
+                if now >= self._loaded_until:
+                    await self.load(now)
+                await self.apply_due(now)
+            except Exception as exc:
+                logger.error(f"instance expiry failed: {exc!r}")
+                await asyncio.sleep(min(self._window, 60.0))
+                continue
+            wake = min(self._heap[0][0], self._loaded_until) if self._heap else self._loaded_until
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(wake - time.time(), 0.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        if not self._task:
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": len(self._due),
+            "next_due": self._heap[0][0] if self._heap else None,
+            "loaded_until": int(self._loaded_until),
+            "last_load": self.last_load,
+            "disabled": self.disabled,
+            "destroyed": self.destroyed,
+        }
@@ -0,0 +1,47 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from bcrypt import checkpw, gensalt, hashpw
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class HashingPoolSaturated(Exception):
+    def __init__(self):
+        super().__init__("too many password hashing requests, try again later")
+
+
+class PasswordHasher:
+    """ runs bcrypt in a bounded thread pool, bcrypt releases the gil while hashing """
+    def __init__(self, pool_size: int | None = None, queue_size: int | None = None) -> None:
+        pool_size = pool_size or 2
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="bcrypt")
+        # running plus waiting jobs, callers beyond that are rejected right away
+        self._slots = pool_size + (queue_size or 16)
+        self._pending = 0
+
+    async def _run(self, fn, *args):
+        if self._pending >= self._slots:
+            logger.warning("password hashing pool saturated, rejecting request")
+            raise HashingPoolSaturated()
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        """ the hash is ascii, stored as text so postgres accepts it for a varchar """
+        hashed = await self._run(hashpw, password.encode("utf-8"), gensalt())
+        return hashed.decode("ascii")
+
+    async def verify(self, password: str, hashed_password: str | bytes) -> bool:
+        # rows written before the hash was stored as text hold bytes
+        if isinstance(hashed_password, str):
+            hashed_password = hashed_password.encode("ascii")
+        return await self._run(checkpw, password.encode("utf-8"), hashed_password)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
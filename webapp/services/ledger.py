@@ -0,0 +1,257 @@
+import asyncio
+import time
+from datetime import datetime
+
+from webapp.models import UserPrincipal
+from webapp.repositories import PaymentRepository, UserRepository
+from webapp.serializer import Serializer
+from webapp.services.eventbus import EventBus
+from webapp.services.lnbits import LnbitsService
+from webapp.services.sse import SSEHub
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+def timestamp(value) -> int:
+    """ lnbits sends unix seconds, newer versions iso dates """
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(datetime.fromisoformat(value).timestamp())
+        except ValueError:
+            pass
+    return int(time.time())
+
+
+class LedgerService:
+    """ mirrors the lnbits payments of our wallets into the payments table
+
+    sse and webhook events are recorded as they arrive. reconciliation walks
+    the newest pages of /api/v1/payments until a page brings nothing new, and
+    the whole history once per full_interval.
+    """
+    def __init__(
+        self,
+        payment_repository: PaymentRepository,
+        user_repository: UserRepository,
+        lnbits_service: LnbitsService,
+        serializer: Serializer,
+        sse_hub: SSEHub,
+        event_bus: EventBus,
+        interval: float | None = None,
+        full_interval: float | None = None,
+        page_size: int | None = None,
+        concurrency: int | None = None,
+    ) -> None:
+        self._payments = payment_repository
+        self._users = user_repository
+        self._lnbits = lnbits_service
+        self._serializer = serializer
+        self._bus = event_bus
+        self._interval = interval or 300.0
+        self._full_interval = full_interval or 86400.0
+        self._page_size = page_size or 100
+        self._concurrency = concurrency or 4
+        self._syncing: dict[str, asyncio.Future] = {}
+        self._synced: set[str] = set()
+        self._dirty: set[str] = set()
+        self._writes: set[asyncio.Task] = set()
+        self._task: asyncio.Task | None = None
+        self._closed = False
+        self.recorded = 0
+        self.reconciled = 0
+        self.last_pass: float | None = None
+        sse_hub.observe(self.on_sse_event)
+        sse_hub.observe_reconnect(self.on_sse_reconnect)
+
+    def normalize(self, payment: dict) -> dict | None:
+        checking_id = payment.get("checking_id") or payment.get("payment_hash")
+        if not checking_id:
+            return None
+        return {
+            "checking_id": checking_id,
+            "payment_hash": payment.get("payment_hash"),
+            "amount": int(payment.get("amount") or 0),
+            "fee": int(payment.get("fee") or 0),
+            "pending": bool(payment.get("pending")),
+            "time": timestamp(payment.get("time")),
+            "data": self._serializer.dumps(payment),
+        }
+
+    async def record(self, wallet: str, payments: list[dict], provisional: bool = False) -> int:
+        rows = [row for row in map(self.normalize, payments) if row]
+        written = await self._payments.upsert(wallet, rows, provisional)
+        self.recorded += written
+        return written
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    def on_sse_event(self, _: str, sse_event: dict) -> None:
+        """ called once per upstream event, by the worker owning the stream """
+        payment = sse_event.get("data")
+        if sse_event.get("event") != "payment-received" or not isinstance(payment, dict):
+            return
+        wallet = payment.get("wallet_id")
+        if wallet:
+            self._spawn(self.record(wallet, [payment]))
+
+    def on_sse_reconnect(self, api_key: str) -> None:
+        """ the upstream of a wallet was down for a while, a pass picks up the events it missed """
+        if not self._closed:
+            self._spawn(self._resync(api_key))
+
+    async def _resync(self, api_key: str) -> None:
+        user = await self._users.find_by_api_key(api_key)
+        if user and user.wallet_id:
+            self.changed(UserPrincipal.from_user(user))
+
+    async def record_webhook(self, user: UserPrincipal, payments: list[dict]) -> None:
+        """ lnurlp webhooks lack the lnbits payment, a stand in is kept until reconciliation
+
+        anyone holding the webhook secret can post one, so the stand in stays
+        pending and out of the balance until lnbits lists the payment.
+        """
+        now = int(time.time())
+        await self.record(user.wallet_id, [{
+            "checking_id": payment.get("payment_hash"),
+            "payment_hash": payment.get("payment_hash"),
+            "wallet_id": user.wallet_id,
+            "amount": payment.get("amount") or 0,
+            "fee": 0,
+            "pending": True,
+            "time": now,
+            "bolt11": payment.get("payment_request"),
+            "memo": payment.get("comment"),
+        } for payment in payments if payment.get("payment_hash")], provisional=True)
+
+    async def reconcile(self, wallet: str, api_key: str, full: bool = False) -> int:
+        if not full and wallet not in self._synced and await self._payments.get_sync(wallet) is None:
+            # an incremental pass must not mark a wallet synced whose history was never pulled
+            full = True
+        # rows written while the pass runs may be missing from its pages
+        through = await self._payments.last_seq(wallet)
+        listed: set[str] = set()
+        written = 0
+        offset = 0
+        while True:
+            page = await self._lnbits.get_payments(api_key, limit=self._page_size, offset=offset)
+            changed = await self.record(wallet, page)
+            written += changed
+            if full:
+                listed.update(payment.get("checking_id") or payment.get("payment_hash") for payment in page)
+            # everything older than a page without news is known already
+            if len(page) < self._page_size or (not full and not changed):
+                break
+            offset += self._page_size
+        if full:
+            # lnbits deletes failed payments and expired invoices, and never lists a stand in nobody paid
+            dropped = await self._payments.drop_missing(wallet, listed, through)
+            if dropped:
+                logger.warning(f"dropped {dropped} payments of wallet {wallet} that lnbits no longer lists")
+            written += dropped
+        await self._payments.mark_synced(wallet, full)
+        self._synced.add(wallet)
+        self.reconciled += 1
+        return written
+
+    def _reconcile_once(self, wallet: str, api_key: str, full: bool) -> asyncio.Future:
+        """ concurrent requests for one wallet share a single pass """
+        inflight = self._syncing.get(wallet)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self.reconcile(wallet, api_key, full))
+            self._syncing[wallet] = inflight
+            inflight.add_done_callback(lambda _: self._syncing.pop(wallet, None))
+        return inflight
+
+    async def ensure_synced(self, user: UserPrincipal) -> None:
+        """ waits for a running pass, and pulls the full history of a wallet never seen before """
+        inflight = self._syncing.get(user.wallet_id)
+        if inflight is None and user.wallet_id not in self._synced:
+            if await self._payments.get_sync(user.wallet_id):
+                self._synced.add(user.wallet_id)
+                return
+            inflight = self._reconcile_once(user.wallet_id, user.api_key, True)
+        if inflight is not None:
+            await asyncio.shield(inflight)
+
+    def changed(self, user: UserPrincipal) -> None:
+        """ our own action moved funds, pick up the new payment right away """
+        if self._closed:
+            return
+        inflight = self._syncing.get(user.wallet_id)
+        if inflight is not None:
+            # the running pass may have fetched before the change, one more pass covers every change meanwhile
+            if user.wallet_id not in self._dirty:
+                self._dirty.add(user.wallet_id)
+                inflight.add_done_callback(lambda _: self._rerun(user))
+            return
+        future = self._reconcile_once(user.wallet_id, user.api_key, False)
+        future.add_done_callback(self._log_failure)
+
+    def _rerun(self, user: UserPrincipal) -> None:
+        self._dirty.discard(user.wallet_id)
+        self.changed(user)
+
+    def _log_failure(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception():
+            logger.error(f"ledger reconciliation failed: {future.exception()!r}")
+
+    async def reconcile_all(self) -> None:
+        started = time.monotonic()
+        users = [user for user in await self._users.get_all() if user.is_active and user.api_key]
+        syncs = await self._payments.get_syncs()
+        now = time.time()
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def reconcile_user(user) -> None:
+            sync = syncs.get(user.wallet_id)
+            full = sync is None or now - sync.full_at >= self._full_interval
+            async with semaphore:
+                try:
+                    await self._reconcile_once(user.wallet_id, user.api_key, full)
+                except Exception as exc:
+                    logger.error(f"reconciling wallet of {user.username} failed: {exc!r}")
+
+        await asyncio.gather(*(reconcile_user(user) for user in users))
+        self.last_pass = time.monotonic() - started
+        logger.info(f"reconciled {len(users)} wallets in {self.last_pass:.1f}s")
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            # the database is shared, one worker reconciles for all of them
+            if self._bus.peers()[0] != self._bus.peer_id:
+                continue
+            try:
+                await self.reconcile_all()
+            except Exception as exc:
+                logger.error(f"ledger reconciliation pass failed: {exc!r}")
+
+    def start(self) -> None:
+        if not self._task:
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        # passes still talking to lnbits are dropped, the next start reconciles anyway
+        passes = list(self._syncing.values())
+        for inflight in passes:
+            inflight.cancel()
+        await asyncio.gather(*passes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "recorded": self.recorded,
+            "reconciled": self.reconciled,
+            "last_pass": self.last_pass,
+        }
@@ -1,28 +1,161 @@
-import requests
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Tuple
 
-from typing import Tuple
+import httpx
+
+from webapp.breaker import Breakers, CircuitOpen
+from webapp.cache import SingleFlightCache
+from webapp.http import HttpClient, cache_ttl
+from webapp.metrics import Metrics
+from webapp.serializer import Serializer
 
 from logging import getLogger
 logger = getLogger(__name__)
 
+HTTP_METHODS = ("get", "post", "put", "patch", "delete")
+
 
 class LnbitsService:
+    # upper bound for lnurl metadata, whatever the upstream cache headers say
+    LNURL_MAX_TTL = 3600.0
+    # read deadlines by endpoint, lnbits.timeouts in config.yml overrides them
+    TIMEOUTS = {
+        "POST /api/v1/payments": 60.0,
+        "lnurl": 10.0,
+        "lnurlp_callback": 15.0,
+        "lnurlw_callback": 30.0,
+    }
 
-    def __init__(self, config) -> None:
+    def __init__(
+        self,
+        config,
+        http_client: HttpClient,
+        serializer: Serializer,
+        metrics: Metrics,
+        lnurl_cache: SingleFlightCache,
+        breakers: Breakers,
+    ) -> None:
         self._config = config
+        self._http = http_client
+        self._serializer = serializer
+        self._lnurl_cache = lnurl_cache
+        self._breakers = breakers
+        lnbits = config["lnbits"]
+        self._read_timeout = lnbits.get("timeout") or 10.0
+        self._connect_timeout = lnbits.get("connect_timeout") or 3.0
+        self._timeouts = {**self.TIMEOUTS, **(lnbits.get("timeouts") or {})}
+        self._hedges = lnbits.get("hedges", 1) or 0
+        self._hedge_delay = lnbits.get("hedge_delay", 0.5) or 0.0
+        self._latency = metrics.histogram("lnbits_request_seconds", "latency of lnbits and lnurl requests", ("endpoint",))
+        self._errors = metrics.counter("lnbits_request_errors_total", "failed lnbits and lnurl requests", ("endpoint",))
+        self._rejected = metrics.counter("lnbits_circuit_rejections_total", "requests failed fast by an open circuit", ("endpoint",))
+        self._hedged = metrics.counter("lnbits_hedged_requests_total", "extra attempts of idempotent reads", ("endpoint",))
+        metrics.gauge("lnbits_circuits_open", "upstream hosts whose circuit is open or half open", breakers.open)
+
+    def _deadline(self, endpoint: str, timeout: float | None) -> httpx.Timeout:
+        read = timeout or self._timeouts.get(endpoint) or self._read_timeout
+        return httpx.Timeout(read, connect=self._connect_timeout, pool=self._connect_timeout)
+
+    async def _send(self, endpoint: str, method: str, url: str, timeout: float | None = None, hedge: bool = False, **kwargs):
+        """ every upstream request goes through here, labeled by endpoint and never by full url
+
+        hedge is for idempotent reads only, they may reach the upstream more than once
+        """
+        breaker = self._breakers.get(httpx.URL(url).netloc.decode("ascii"))
+
+        async def attempt() -> httpx.Response:
+            try:
+                breaker.acquire()
+            except CircuitOpen:
+                self._rejected.labels(endpoint).inc()
+                raise
+            deadline = self._deadline(endpoint, timeout)
+            start = time.perf_counter()
+            try:
+                # httpx times single reads, a server trickling its answer is cut off here
+                response = await asyncio.wait_for(
+                    self._http.client.request(method, url, timeout=deadline, **kwargs),
+                    deadline.connect + deadline.read,
+                )
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as exc:
+                breaker.failure()
+                self._errors.labels(endpoint).inc()
+                if isinstance(exc, asyncio.TimeoutError):
+                    raise httpx.TimeoutException(f"{endpoint} timed out after {deadline.connect + deadline.read:.0f}s")
+                raise
+            finally:
+                self._latency.labels(endpoint).observe(time.perf_counter() - start)
+            if response.status_code >= 500:
+                breaker.failure()
+            else:
+                breaker.success()
+            if response.is_error:
+                self._errors.labels(endpoint).inc()
+            return response
+
+        if hedge and self._hedges and self._hedge_delay:
+            return await self._hedge(endpoint, attempt)
+        return await attempt()
+
+    async def _hedge(self, endpoint: str, attempt: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """ another attempt starts when the running ones are slow or failed, the first good answer wins """
+        pending: set[asyncio.Task] = set()
+        failed: httpx.Response | Exception | None = None
+        started = 0
+        try:
+            while True:
+                # the first attempt, or one replacing a slow or failed attempt
+                if started <= self._hedges:
+                    if started:
+                        self._hedged.labels(endpoint).inc()
+                    pending.add(asyncio.create_task(attempt()))
+                    started += 1
+                # jitter keeps hedges of concurrent callers from arriving in lockstep
+                delay = self._hedge_delay * random.uniform(0.5, 1.5) if started <= self._hedges else None
+                done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                answer = None
+                for task in done:
+                    exc = task.exception()
+                    if exc is None and task.result().status_code < 500:
+                        answer = answer or task.result()
+                    else:
+                        failed = exc or task.result()
+                if answer is not None:
+                    return answer
+                if not pending:
+                    # an open circuit rejects further attempts just the same
+                    if started > self._hedges or isinstance(failed, CircuitOpen):
+                        if isinstance(failed, Exception):
+                            raise failed
+                        return failed  # type: ignore
+                    await asyncio.sleep(self._hedge_delay * random.uniform(0, 0.5))
+        finally:
+            for task in pending:
+                task.cancel()
 
-    def request(self, url, method="post", payload=None, api_key=None):
+    async def request(
+        self, url, method="post", payload=None, api_key=None, timeout: float | None = None, hedge: bool = False,
+    ):
+        endpoint = f"{method.upper()} {url.split('?')[0]}"
         url = f"{self._config['lnbits']['url']}{url}"
         headers = {
             "Content-Type": "application/json; charset=utf-8",
-            "X-Api-Key": api_key,
         }
-        if hasattr(requests, method):
-            fn = getattr(requests, method)
+        if api_key:
+            headers["X-Api-Key"] = api_key
+        if method in HTTP_METHODS:
             try:
-                response = fn(url, headers=headers, json=payload)
+                content = self._serializer.dumps(payload) if payload is not None else None
+                response = await self._send(
+                    endpoint, method.upper(), url, timeout=timeout, hedge=hedge, headers=headers, content=content,
+                )
                 response.raise_for_status()
-                json = response.json()
+                json = self._serializer.loads(response.content)
                 return json
 
             except Exception as exc:
@@ -35,8 +168,8 @@ class LnbitsService:
             logger.error(msg)
             raise Exception(msg)
 
-    def create_invoice(self, api_key: str, amount: int, description: str = "withdraw"):
-        data = self.request("/api/v1/payments", api_key=api_key, method="post", payload={
+    async def create_invoice(self, api_key: str, amount: int, description: str = "withdraw"):
+        data = await self.request("/api/v1/payments", api_key=api_key, method="post", payload={
             "amount": amount,
             "memo": description,
             "unit": "sat",
@@ -44,15 +177,15 @@ class LnbitsService:
         })
         return data.get("payment_hash"), data.get("payment_request")
 
-    def send_withdraw(self, callback, k1, payment_request):
+    async def send_withdraw(self, callback, k1, payment_request, timeout: float | None = None):
         try:
-            url = f"{callback}?k1={k1}&pr={payment_request}"
-            response = requests.get(url)
+            params = {"k1": k1, "pr": payment_request}
+            response = await self._send("lnurlw_callback", "GET", callback, timeout=timeout, params=params)
         except Exception as exc:
             msg = str(exc)
             logger.error(msg)
             raise Exception(msg)
-        json = response.json()
+        json = self._serializer.loads(response.content)
         if response.status_code > 300:
             msg = f"{json['detail']}"
             logger.error(msg)
@@ -64,55 +197,72 @@ class LnbitsService:
 
         return json.get("pr"), successMessage
 
-    def decode_invoice(self, invoice: str):
-        data = self.request("/api/v1/payments/decode", payload={"data": invoice})
+    async def decode_invoice(self, invoice: str):
+        data = await self.request("/api/v1/payments/decode", payload={"data": invoice}, hedge=True)
         return data
 
-    def get_lnurl_invoice(self, callback: str, amount: int, comment: str | None) -> tuple[str, str]:
+    async def get_lnurl_invoice(
+        self, callback: str, amount: int, comment: str | None, timeout: float | None = None
+    ) -> tuple[str, str]:
         try:
-            url = f"{callback}?amount={amount}"
-            response = requests.get(url)
+            params = {"amount": amount}
+            response = await self._send("lnurlp_callback", "GET", callback, timeout=timeout, params=params)
         except Exception as exc:
             msg = f"ERROR: making lnurl invoice request. {exc}"
             logger.error(msg)
             raise Exception(msg)
-        json = response.json()
+        json = self._serializer.loads(response.content)
         if response.status_code > 300:
             msg = f"ERROR: making lnurl invoice request. {json['detail']}"
             logger.error(msg)
             raise Exception(msg)
         return json.get("pr"), json.get("successAction").get("message")
 
-    def decode_lnurl(self, domain: str):
+    async def decode_lnurl(self, domain: str, timeout: float | None = None):
+        """ lnurl pay metadata is the same for every scan of a code, concurrent scans share one request
+
+        invoices from lnurl callbacks and withdraw requests carry single use
+        material, a k1 or the invoice, and are never cached
+        """
+        return await self._lnurl_cache.get_or_load(domain, lambda: self._fetch_lnurl(domain, timeout))
+
+    async def _fetch_lnurl(self, domain: str, timeout: float | None) -> tuple[dict, float, int]:
         try:
-            response = requests.get(domain)
+            response = await self._send("lnurl", "GET", domain, timeout=timeout)
         except Exception as exc:
             msg = f"ERROR: making lnurl request. {exc}"
             logger.error(msg)
             raise Exception(msg)
-        json = response.json()
+        json = self._serializer.loads(response.content)
         if response.status_code > 300:
             msg = f"ERROR: making lnurl request. {json['detail']}"
             logger.error(msg)
             raise Exception(msg)
-        return json
+        if not isinstance(json, dict) or json.get("tag") != "payRequest" or "k1" in json:
+            # a withdraw k1 may be single use or bound to the session that scanned it
+            return json, 0, len(response.content)
+        ttl = min(cache_ttl(response.headers, self._lnurl_cache.ttl), self.LNURL_MAX_TTL)
+        return json, ttl, len(response.content)
 
 
-    def get_payments(self, api_key: str):
-        data = self.request("/api/v1/payments", method="get", api_key=api_key)
+    async def get_payments(self, api_key: str, limit: int | None = None, offset: int | None = None):
+        url = "/api/v1/payments"
+        if limit is not None:
+            url = f"{url}?limit={limit}&offset={offset or 0}"
+        data = await self.request(url, method="get", api_key=api_key, hedge=True)
         return data
 
-    def get_balance(self, api_key: str) -> int:
-        data = self.request("/api/v1/wallet", method="get", api_key=api_key)
+    async def get_balance(self, api_key: str) -> int:
+        data = await self.request("/api/v1/wallet", method="get", api_key=api_key, hedge=True)
         balance = 0
         if data:
             balance = data.get("balance") / 1000
         return balance
 
-    def create_user_and_wallet(self, username) -> Tuple:
+    async def create_user_and_wallet(self, username) -> Tuple:
         api_key = self._config['lnbits']['api_key']
         admin_id = self._config['lnbits']['admin_id']
-        json = self.request("/usermanager/api/v1/users", api_key=api_key, payload={
+        json = await self.request("/usermanager/api/v1/users", api_key=api_key, payload={
           "user_name": username,
           "wallet_name": username,
           "admin_id": admin_id,
@@ -121,8 +271,24 @@ class LnbitsService:
         return wallet["user"], wallet["id"], wallet["adminkey"]
 
 
-    def create_user_lnurlw(self, username, api_key, wallet_id) -> str:
-        json = self.request("/withdraw/api/v1/links", api_key=api_key, payload={
+    async def delete_user(self, usr: str) -> None:
+        """ removes a usermanager user with its wallets, a user already gone counts as removed """
+        url = f"{self._config['lnbits']['url']}/usermanager/api/v1/users/{usr}"
+        headers = {"X-Api-Key": self._config["lnbits"]["api_key"]}
+        try:
+            response = await self._send("DELETE /usermanager/api/v1/users", "DELETE", url, headers=headers)
+        except Exception as exc:
+            msg = f"ERROR: deleting lnbits user. {exc}"
+            logger.error(msg)
+            raise Exception(msg)
+        if response.is_error and response.status_code != 404:
+            msg = f"ERROR: deleting lnbits user. {response.status_code}"
+            logger.error(msg)
+            raise Exception(msg)
+
+
+    async def create_user_lnurlw(self, username, api_key, wallet_id) -> str:
+        json = await self.request("/withdraw/api/v1/links", api_key=api_key, payload={
             "wallet_id": wallet_id,
             "title": f"personal lnurlw for {username}",
             "min_withdrawable": 10,
@@ -135,9 +301,9 @@ class LnbitsService:
         return json["lnurl"]
 
 
-    def create_user_tpos(self, username, api_key) -> str:
+    async def create_user_tpos(self, username, api_key) -> str:
         try:
-            json = self.request("/tpos/api/v1/tposs", api_key=api_key, payload={
+            json = await self.request("/tpos/api/v1/tposs", api_key=api_key, payload={
                 "name": f"tpos for {username}",
                 "currency": "EUR",
                 "tip_options": "[]",
@@ -150,17 +316,17 @@ class LnbitsService:
             raise Exception(e)
 
 
-    def create_payment(self, api_key, bolt11) -> str:
-        json = self.request("/api/v1/payments", api_key=api_key, payload={
+    async def create_payment(self, api_key, bolt11) -> str:
+        json = await self.request("/api/v1/payments", api_key=api_key, payload={
             "bolt11": bolt11,
         })
         return json.get("payment_hash")
 
 
-    def create_user_lnurlp(self, username, api_key, wallet_id) -> str:
+    async def create_user_lnurlp(self, username, api_key, wallet_id) -> str:
         webhook = self._config["webhook"]["url"]
         webhook_secret = self._config["webhook"]["secret"]
-        json = self.request("/lnurlp/api/v1/links", api_key=api_key, payload={
+        json = await self.request("/lnurlp/api/v1/links", api_key=api_key, payload={
             "wallet_id": wallet_id,
             "description": f"personal lnurlp for {username}",
             "min": 1,
@@ -1,5 +1,5 @@
 from fastapi_login import LoginManager
-from webapp.models import User
+from webapp.models import UserPrincipal
 from webapp.services.user import UserService
 
 
@@ -9,12 +9,12 @@ class LoginService:
 
         @self._manager.user_loader()  # type: ignore
         async def load_user(username: str):
-            return user_service.get_user_by_username(username)
+            return await user_service.get_principal(username)
 
     def manager(self) -> LoginManager:
         return self._manager
 
-    async def user(self, token) -> User:
+    async def user(self, token) -> UserPrincipal:
         return await self._manager.get_current_user(token)
 
     def create_access_token(self, **kwargs) -> str:
@@ -0,0 +1,66 @@
+import asyncio
+import secrets
+
+from webapp.metrics import Metrics, merge, render
+from webapp.services.eventbus import EventBus
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class MetricsService:
+    """ answers a scrape for all workers
+
+    a scrape lands on any one worker, it asks the others for their snapshots
+    over the event bus and sums them up. workers not answering within the
+    timeout are left out, metrics_workers tells how many made it.
+    """
+    def __init__(self, metrics: Metrics, event_bus: EventBus, timeout: float | None = None) -> None:
+        self._metrics = metrics
+        self._bus = event_bus
+        self._timeout = timeout or 1.0
+        self._pending: dict[str, tuple[asyncio.Future, list[dict], int]] = {}
+        metrics.gauge("metrics_workers", "workers whose metrics are part of this scrape", lambda: 0)
+        event_bus.subscribe("metrics_request", self.on_request)
+        event_bus.subscribe("metrics_snapshot", self.on_snapshot)
+
+    def on_request(self, payload: dict) -> None:
+        if payload["peer"] == self._bus.peer_id:
+            return
+        self._bus.publish("metrics_snapshot", {
+            "nonce": payload["nonce"],
+            "snapshot": self._metrics.snapshot(),
+        }, peer=payload["peer"])
+
+    def on_snapshot(self, payload: dict) -> None:
+        pending = self._pending.get(payload["nonce"])
+        if pending is None:
+            return
+        future, snapshots, expected = pending
+        snapshots.append(payload["snapshot"])
+        if len(snapshots) >= expected and not future.done():
+            future.set_result(None)
+
+    async def collect(self) -> dict:
+        snapshots = [self._metrics.snapshot()]
+        others = len(self._bus.peers()) - 1
+        if others > 0:
+            nonce = secrets.token_hex(8)
+            future = asyncio.get_running_loop().create_future()
+            received: list[dict] = []
+            self._pending[nonce] = (future, received, others)
+            self._bus.publish("metrics_request", {"nonce": nonce, "peer": self._bus.peer_id})
+            try:
+                await asyncio.wait_for(future, self._timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"metrics of {others - len(received)} workers missing from the scrape")
+            finally:
+                del self._pending[nonce]
+            snapshots.extend(received)
+        merged = merge(snapshots)
+        # the gauge of every snapshot reads 0, the real count is only known here
+        merged["metrics_workers"]["samples"] = {(): float(len(snapshots))}
+        return merged
+
+    async def render(self) -> str:
+        return render(await self.collect())
@@ -1,12 +1,20 @@
 import json
 import asyncio
-
-import json
-import asyncio
-import json
+import hashlib
+import random
+import time
 import urllib.parse
 from abc import ABC, abstractmethod
 from enum import Enum, auto
+from typing import Any, Callable
+
+from webapp.metrics import Metrics
+from webapp.serializer import Serializer
+from webapp.services.connections import Connection, ConnectionRegistry
+from webapp.services.eventbus import EventBus
+
+from logging import getLogger
+logger = getLogger(__name__)
 
 class SSEType(Enum):
     payment_received = auto()
@@ -45,8 +53,9 @@ class SSEPaymentAction(SSEAction):
 
 
 class SSEDispatcher():
+    """ registry of sse actions by event type, built once per process """
     def __init__(self):
-        self.actions = []
+        self.actions: dict[str, SSEAction] = {}
         self.unhandled = SSEUnhandled(SSEType.unhandled)
         self.add_action(SSEPingAction, SSEType.ping)
         self.add_action(SSEPaymentAction, SSEType.payment_received)
@@ -55,78 +64,466 @@ class SSEDispatcher():
         return action(action_type)
 
     def add_action(self, action, action_type: SSEType):
-        self.actions.append(self.create_action(action, action_type))
+        self.actions[action_type.name] = self.create_action(action, action_type)
 
     def get_action(self, action_type: str) -> SSEAction:
-        search_action = [action for action in self.actions if action.type.name == action_type]
-        found_action = self.unhandled
-        if len(search_action) > 0:
-            found_action = search_action.pop()
-        return found_action
+        return self.actions.get(action_type, self.unhandled)
 
     def dispatch(self, action_type: str, data):
         action = self.get_action(action_type)
         return action.execute(data)
 
 
-class SSEService:
-    def __init__(self):
-        self.dispatcher = SSEDispatcher()
-
-    async def handler(self, websocket, sse_event):
-        event = sse_event.get("event").replace("-", "_")
-        action_data = self.dispatcher.dispatch(event, sse_event.get("data"))
-        if action_data:
-            await websocket.send_json(action_data)
-
-    async def process_sse(self):
-        event = await self.reader.readline()
-        event = event.decode().strip()
-        if event.startswith('event'):
-            data = await self.reader.readline()
-            data = data.decode().strip()
-            if data.startswith('data'):
-                event = event.lstrip('event: ')
-                data = data.lstrip('data: ')
-                try:
-                    data = json.loads(data)
-                except:
-                    """ just a string no json """
-                return {
-                    'event': event,
-                    'data': data,
-                }
-
-
-    async def init_sse_stream(self, url):
-        url = urllib.parse.urlsplit(url)
-        full_path = '{}?{}'.format(url.path, url.query)
+class SSEParser:
+    """ incremental text/event-stream parser, fed with raw body bytes """
+    def __init__(self, loads: Callable[[str], Any] = json.loads):
+        self._loads = loads
+        self.last_event_id: str | None = None
+        self.retry: int | None = None
+        self.reset()
+
+    def reset(self):
+        """ drops a partially received event, e.g. after the connection broke """
+        self._buffer = b""
+        self._event = ""
+        self._data: list[str] = []
+
+    def feed(self, chunk: bytes) -> list[dict]:
+        events = []
+        buffer = self._buffer + chunk
+        start = 0
+        length = len(buffer)
+        while start < length:
+            cr = buffer.find(b"\r", start)
+            lf = buffer.find(b"\n", start)
+            if cr == -1 and lf == -1:
+                break
+            if cr != -1 and (lf == -1 or cr < lf):
+                # a trailing CR may be the first half of a CRLF split across chunks
+                if cr == length - 1:
+                    break
+                end, next_start = cr, cr + 2 if buffer[cr + 1:cr + 2] == b"\n" else cr + 1
+            else:
+                end, next_start = lf, lf + 1
+            event = self.process_line(buffer[start:end].decode("utf-8", errors="replace"))
+            if event:
+                events.append(event)
+            start = next_start
+        self._buffer = buffer[start:]
+        return events
+
+    def process_line(self, line: str) -> dict | None:
+        if not line:
+            return self.dispatch()
+        if line.startswith(":"):
+            return None
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "event":
+            self._event = value
+        elif field == "data":
+            self._data.append(value)
+        elif field == "id":
+            if "\0" not in value:
+                self.last_event_id = value
+        elif field == "retry":
+            if value.isdigit():
+                self.retry = int(value)
+        return None
+
+    def dispatch(self) -> dict | None:
+        event, data = self._event, self._data
+        self._event = ""
+        self._data = []
+        if not data:
+            return None
+        payload = "\n".join(data)
         try:
-            self.reader, self.writer = await asyncio.open_connection(url.netloc, 443, ssl=True)
-            query = ('GET {path} HTTP/1.0\r\n'
-                     'Host: {hostname}\r\n'
-                     '\r\n').format(path=full_path, hostname=url.hostname)
-            self.writer.write(query.encode('latin-1'))
-        except Exception as e:
-            print("ERROR: starting sse listener")
-            print(url)
-            print(e)
-            self.cancel_listener()
-
-
-    async def watch_sse_stream(self, websocket):
+            payload = self._loads(payload)
+        except ValueError:
+            """ just a string no json """
+        return {
+            "event": event or "message",
+            "data": payload,
+            "id": self.last_event_id,
+        }
+
+
+class SSEStream:
+    """ one upstream lnbits payment stream, shared by all subscribers of a wallet """
+    # reconnect delay in ms until the upstream sends a retry field
+    RETRY = 1000
+    MAX_BACKOFF = 30.0
+    CONNECT_TIMEOUT = 10.0
+    # lnbits pings regularly, silence this long means a half-open connection
+    READ_TIMEOUT = 90.0
+
+    def __init__(self, url: str, queue_size: int, loads: Callable[[str], Any] = json.loads):
+        self.url = url
+        self.queue_size = queue_size
+        # queues, or anything else with put_nowait
+        self.subscribers: set = set()
+        self.teardown: asyncio.TimerHandle | None = None
+        self.task: asyncio.Task | None = None
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.parser = SSEParser(loads)
+        self.chunked = False
+        # worker holding the upstream connection, other workers mirror its events
+        self.owner: str | None = None
+        # workers mirroring this stream, with the time their interest expires
+        self.remote: dict[str, float] = {}
+        self.forward = None
+        # called once per event read from the upstream, never for mirrored ones
+        self.observer = None
+        # called when the upstream is back after an interruption, events of the gap are lost
+        self.reconnected = None
+
+    def publish(self, sse_event):
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(sse_event)
+            except asyncio.QueueFull:
+                logger.warning(f"sse subscriber queue full, dropping event: {sse_event.get('event')}")
+
+    def emit(self, sse_event):
+        self.publish(sse_event)
+        if self.forward and self.remote:
+            self.forward(sse_event)
+
+    async def readline(self) -> bytes:
+        line = await asyncio.wait_for(self.reader.readline(), self.READ_TIMEOUT)
+        if not line:
+            raise ConnectionError("sse upstream closed the connection")
+        return line
+
+    async def read_chunk(self) -> bytes:
+        """ reads the next piece of the body, undoing http/1.1 chunked framing """
+        if not self.chunked:
+            chunk = await asyncio.wait_for(self.reader.read(65536), self.READ_TIMEOUT)
+            if not chunk:
+                raise ConnectionError("sse upstream closed the connection")
+            return chunk
+        size_line = await self.readline()
+        size = int(size_line.split(b";")[0].strip(), 16)
+        if size == 0:
+            raise ConnectionError("sse upstream ended the stream")
+        chunk = await asyncio.wait_for(self.reader.readexactly(size + 2), self.READ_TIMEOUT)
+        return chunk[:-2]
+
+    async def process_sse(self) -> list[dict]:
+        """ waits for the next body chunk and returns the events completed by it """
+        return self.parser.feed(await self.read_chunk())
+
+    async def init_sse_stream(self):
+        url = urllib.parse.urlsplit(self.url)
+        secure = url.scheme == "https"
+        port = url.port or (443 if secure else 80)
+        full_path = '{}?{}'.format(url.path, url.query)
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(url.hostname, port, ssl=secure or None),
+            self.CONNECT_TIMEOUT,
+        )
+        headers = [
+            f"GET {full_path} HTTP/1.1",
+            f"Host: {url.netloc}",
+            "Accept: text/event-stream",
+            "Cache-Control: no-cache",
+        ]
+        if self.parser.last_event_id:
+            headers.append(f"Last-Event-ID: {self.parser.last_event_id}")
+        self.writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1"))
+        await self.writer.drain()
+
+        status = (await self.readline()).decode("latin-1").split(" ", 2)
+        if len(status) < 2 or status[1] != "200":
+            raise ConnectionError(f"sse upstream answered: {' '.join(status).strip()}")
+        self.chunked = False
+        while True:
+            header = (await self.readline()).decode("latin-1").strip()
+            if not header:
+                break
+            name, _, value = header.partition(":")
+            if name.strip().lower() == "transfer-encoding" and "chunked" in value.lower():
+                self.chunked = True
+        self.parser.reset()
+
+    def backoff(self, attempt: int) -> float:
+        """ exponential backoff from the retry field, with jitter against reconnect storms """
+        base = (self.parser.retry or self.RETRY) / 1000
+        delay = min(self.MAX_BACKOFF, base * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def watch_sse_stream(self):
+        attempt = 0
+        interrupted = False
         while True:
-            sse_event = await self.process_sse()
-            if not sse_event:
-                await asyncio.sleep(1)
-                continue
-            await self.handler(websocket, sse_event)
-
-    async def start_listener(self, websocket, url: str):
-        await self.init_sse_stream(url)
-        self.task = asyncio.create_task(self.watch_sse_stream(websocket))
-        await self.task
-
-    def cancel_listener(self):
-        self.writer.close()
-        self.task.cancel()
+            try:
+                await self.init_sse_stream()
+                # lnbits does not replay from Last-Event-ID
+                if interrupted and self.reconnected:
+                    self.reconnected()
+                interrupted = False
+                while True:
+                    for sse_event in await self.process_sse():
+                        # a delivered event proves the connection is healthy
+                        attempt = 0
+                        self.emit(sse_event)
+                        if self.observer:
+                            self.observer(sse_event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                interrupted = True
+                logger.warning(f"sse stream interrupted, reconnecting: {exc!r}")
+            finally:
+                self.close_connection()
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def start(self):
+        if self.task and not self.task.done():
+            return
+        self.task = asyncio.create_task(self.watch_sse_stream())
+
+    def close_connection(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def close(self):
+        self.close_connection()
+        if self.task:
+            self.task.cancel()
+
+
+class SSEHub:
+    """ process wide registry of upstream sse streams, one per wallet api_key
+
+    with several workers only the owner of a wallet, picked by rendezvous hashing
+    over the live workers, holds its upstream. the others register interest and
+    get the events forwarded over the event bus.
+    """
+    # remote interest is renewed this often and expires after three missed renewals
+    INTEREST_INTERVAL = 10.0
+
+    def __init__(
+        self,
+        url: str,
+        event_bus: EventBus,
+        serializer: Serializer,
+        metrics: Metrics,
+        linger: float | None = None,
+        queue_size: int | None = None,
+    ):
+        self._url = url
+        self._bus = event_bus
+        self._serializer = serializer
+        self._linger = linger or 5.0
+        self._queue_size = queue_size or 100
+        self._maintenance: asyncio.Task | None = None
+        self._observers: list[Callable[[str, dict], None]] = []
+        self._reconnect_observers: list[Callable[[str], None]] = []
+        self.streams: dict[str, SSEStream] = {}
+        event_bus.subscribe("sse_interest", self.on_interest)
+        event_bus.subscribe("sse_release", self.on_release)
+        event_bus.subscribe("sse_event", self.on_event)
+        self._events = metrics.counter("sse_events_total", "events read from lnbits sse streams", ("type",))
+        metrics.gauge("sse_upstream_streams", "lnbits sse streams held open by the workers", self.upstreams)
+        metrics.gauge("sse_subscribers", "websockets subscribed to a wallet stream", self.subscribers)
+
+    def owner(self, api_key: str) -> str:
+        def weight(peer: str) -> bytes:
+            return hashlib.blake2b(f"{peer}:{api_key}".encode(), digest_size=8).digest()
+        return max(self._bus.peers(), key=weight)
+
+    def _stream(self, api_key: str) -> SSEStream:
+        stream = SSEStream(f"{self._url}/api/v1/payments/sse?api-key={api_key}", self._queue_size, self._serializer.loads)
+        stream.forward = lambda sse_event: self._forward(api_key, stream, sse_event)
+        stream.observer = lambda sse_event: self._observe(api_key, sse_event)
+        stream.reconnected = lambda: self._reconnected(api_key)
+        self.streams[api_key] = stream
+        if not self._maintenance:
+            self._maintenance = asyncio.create_task(self.maintain())
+        return stream
+
+    def _attach(self, api_key: str, stream: SSEStream):
+        """ opens the upstream if we own the wallet, else asks the owner for its events """
+        stream.owner = self.owner(api_key)
+        if stream.owner == self._bus.peer_id:
+            stream.start()
+        else:
+            self._bus.publish("sse_interest", {"wallet": api_key, "peer": self._bus.peer_id}, peer=stream.owner)
+
+    def observe(self, observer: Callable[[str, dict], None]):
+        """ registers a callback seeing each upstream event exactly once across all workers """
+        self._observers.append(observer)
+
+    def observe_reconnect(self, observer: Callable[[str], None]):
+        """ registers a callback getting the api_key of an upstream that reconnected after an interruption """
+        self._reconnect_observers.append(observer)
+
+    def upstreams(self) -> int:
+        return sum(1 for stream in self.streams.values() if stream.owner == self._bus.peer_id)
+
+    def subscribers(self) -> int:
+        return sum(len(stream.subscribers) for stream in self.streams.values())
+
+    def _observe(self, api_key: str, sse_event: dict):
+        event = str(sse_event.get("event")).replace("-", "_")
+        self._events.labels(event if event in SSEType.__members__ else SSEType.unhandled.name).inc()
+        for observer in self._observers:
+            try:
+                observer(api_key, sse_event)
+            except Exception as exc:
+                logger.error(f"sse observer failed: {exc!r}")
+
+    def _reconnected(self, api_key: str):
+        for observer in self._reconnect_observers:
+            try:
+                observer(api_key)
+            except Exception as exc:
+                logger.error(f"sse reconnect observer failed: {exc!r}")
+
+    def _forward(self, api_key: str, stream: SSEStream, sse_event: dict):
+        for peer in stream.remote:
+            if peer != stream.owner:
+                self._bus.publish("sse_event", {"wallet": api_key, "event": sse_event}, peer=peer)
+
+    def subscribe(self, api_key: str, subscriber=None):
+        """ subscriber gets the events through put_nowait, a new queue unless given """
+        stream = self.streams.get(api_key)
+        if not stream:
+            stream = self._stream(api_key)
+            self._attach(api_key, stream)
+        if stream.teardown:
+            stream.teardown.cancel()
+            stream.teardown = None
+        if subscriber is None:
+            subscriber = asyncio.Queue(maxsize=stream.queue_size)
+        stream.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, api_key: str, subscriber):
+        stream = self.streams.get(api_key)
+        if not stream or subscriber not in stream.subscribers:
+            return
+        stream.subscribers.discard(subscriber)
+        self._check_idle(api_key, stream)
+
+    def _check_idle(self, api_key: str, stream: SSEStream):
+        if not stream.subscribers and not stream.remote and not stream.teardown:
+            # keep the upstream open shortly, reloads and reconnects reuse it
+            loop = asyncio.get_running_loop()
+            stream.teardown = loop.call_later(self._linger, self._close_stream, api_key)
+
+    def _close_stream(self, api_key: str):
+        stream = self.streams.get(api_key)
+        if stream and not stream.subscribers and not stream.remote:
+            del self.streams[api_key]
+            stream.close()
+            if stream.owner != self._bus.peer_id:
+                self._bus.publish("sse_release", {"wallet": api_key, "peer": self._bus.peer_id}, peer=stream.owner)
+
+    def on_interest(self, payload: dict):
+        api_key, peer = payload["wallet"], payload["peer"]
+        stream = self.streams.get(api_key)
+        if not stream:
+            stream = self._stream(api_key)
+            stream.owner = self._bus.peer_id
+            stream.start()
+        elif stream.owner == peer:
+            # both sides picked the other as owner while the worker set changed,
+            # the higher peer id takes the upstream over
+            if self._bus.peer_id < peer:
+                return
+            stream.owner = self._bus.peer_id
+            stream.start()
+            self._bus.publish("sse_release", {"wallet": api_key, "peer": self._bus.peer_id}, peer=peer)
+        if stream.teardown:
+            stream.teardown.cancel()
+            stream.teardown = None
+        stream.remote[peer] = time.monotonic() + 3 * self.INTEREST_INTERVAL
+
+    def on_release(self, payload: dict):
+        api_key, peer = payload["wallet"], payload["peer"]
+        stream = self.streams.get(api_key)
+        if stream:
+            stream.remote.pop(peer, None)
+            self._check_idle(api_key, stream)
+
+    def on_event(self, payload: dict):
+        stream = self.streams.get(payload["wallet"])
+        if stream:
+            stream.emit(payload["event"])
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(self.INTEREST_INTERVAL)
+            now = time.monotonic()
+            peers = set(self._bus.peers())
+            for api_key, stream in list(self.streams.items()):
+                for peer, expires in list(stream.remote.items()):
+                    if expires < now or peer not in peers:
+                        del stream.remote[peer]
+                if stream.owner != self._bus.peer_id:
+                    if stream.owner in peers:
+                        self._bus.publish("sse_interest", {"wallet": api_key, "peer": self._bus.peer_id}, peer=stream.owner)
+                    else:
+                        logger.info(f"sse owner {stream.owner} is gone, reassigning wallet stream")
+                        self._attach(api_key, stream)
+                self._check_idle(api_key, stream)
+
+    def close(self):
+        if self._maintenance:
+            self._maintenance.cancel()
+            self._maintenance = None
+        for stream in self.streams.values():
+            if stream.teardown:
+                stream.teardown.cancel()
+            stream.close()
+        self.streams.clear()
+
+
+class SSEService:
+    """ hands the wallet's sse events to its websockets, shared by all connections
+
+    events are sent from a short task each, an idle connection costs nothing
+    here. a connection more than queue_size events behind drops the next ones.
+    """
+    def __init__(
+        self,
+        hub: SSEHub,
+        dispatcher: SSEDispatcher,
+        connection_registry: ConnectionRegistry,
+        queue_size: int | None = None,
+    ):
+        self.dispatcher = dispatcher
+        self._hub = hub
+        self._registry = connection_registry
+        self._queue_size = queue_size or 100
+
+    def subscribe(self, connection: Connection):
+        connection.sse = self
+        self._hub.subscribe(connection.user.api_key, connection)
+
+    def unsubscribe(self, connection: Connection):
+        self._hub.unsubscribe(connection.user.api_key, connection)
+
+    def deliver(self, connection: Connection, sse_event: dict):
+        if connection.sse_pending >= self._queue_size:
+            raise asyncio.QueueFull()
+        connection.sse_pending += 1
+        connection.spawn(self.handler(connection, sse_event))
+
+    async def handler(self, connection: Connection, sse_event: dict):
+        try:
+            event = sse_event.get("event").replace("-", "_")
+            action_data = self.dispatcher.dispatch(event, sse_event.get("data"))
+            if action_data:
+                await self._registry.send(connection, action_data)
+        except Exception as exc:
+            logger.warning(f"sending sse event to {connection.user.username} failed: {exc!r}")
+        finally:
+            connection.sse_pending -= 1
@@ -1,67 +1,171 @@
 from logging import getLogger
 logger = getLogger(__name__)
 
+import asyncio
+import time
 from typing import List
 
-from bcrypt import checkpw, gensalt, hashpw
-
-from webapp.models import User, createUser
+from webapp.cache import TTLCache
+from webapp.models import User, UserPrincipal, createUser
 from webapp.repositories import UserRepository
+from webapp.services.eventbus import EventBus
+from webapp.services.hashing import PasswordHasher
 from webapp.services.lnbits import LnbitsService
 
 
 class UserService:
-    def __init__(self, user_repository: UserRepository, lnbits_service: LnbitsService) -> None:
+    def __init__(
+        self,
+        user_repository: UserRepository,
+        lnbits_service: LnbitsService,
+        password_hasher: PasswordHasher,
+        principal_cache: TTLCache,
+    ) -> None:
         self._repository: UserRepository = user_repository
         self._lnbits: LnbitsService = lnbits_service
+        self._hasher: PasswordHasher = password_hasher
+        self._principals: TTLCache = principal_cache
+
+    async def get_users(self) -> List[User]:
+        return await self._repository.get_all()
 
-    def get_users(self) -> List[User]:
-        return self._repository.get_all()
+    async def get_user_by_id(self, user_id: int) -> User:
+        return await self._repository.get_by_id(user_id)
 
-    def get_user_by_id(self, user_id: int) -> User:
-        return self._repository.get_by_id(user_id)
+    async def get_user_by_email(self, email: str) -> User:
+        return await self._repository.get_by_email(email)
 
-    def get_user_by_email(self, email: str) -> User:
-        return self._repository.get_by_email(email)
+    async def get_user_by_username(self, username: str) -> User:
+        return await self._repository.get_by_username(username)
 
-    def get_user_by_username(self, username: str) -> User:
-        return self._repository.get_by_username(username)
+    async def get_principal(self, username: str) -> UserPrincipal:
+        principal = self._principals.get(username)
+        if principal is None:
+            principal = UserPrincipal.from_user(await self._repository.get_by_username(username))
+            # an unfinished signup changes with every step, and in whichever worker resumes it
+            if principal.is_active:
+                self._principals.set(username, principal)
+        return principal
+
+    async def _update(self, user: User, **fields) -> User:
+        user = await self._repository.update(user.id, **fields)  # type: ignore
+        self._principals.invalidate(user.username)
+        return user
 
-    def login(self, username: str, password: str) -> User:
-        pwd_bytes: bytes = password.encode("utf-8")
-        user = self._repository.get_by_username(username)
-        if not user or not checkpw(pwd_bytes, user.hashed_password):  # type: ignore
+    async def login(self, username: str, password: str) -> User:
+        user = await self._repository.get_by_username(username)
+        if not user or not user.is_active or not await self._hasher.verify(password, user.hashed_password):  # type: ignore
             raise
         return user
 
-    def create_user(self, data: createUser) -> User:
-
-        if self._repository.exists(data.username):
-            raise Exception("user exists")
-
-        pwd_bytes = data.password.encode("utf-8")
-        salt = gensalt()
-        password = hashpw(pwd_bytes, salt)
-
-        usr, wallet_id, api_key = self._lnbits.create_user_and_wallet(data.username)
-        lnurlp = self._lnbits.create_user_lnurlp(data.username, api_key, wallet_id)
-        lnurlw = self._lnbits.create_user_lnurlw(data.username, api_key, wallet_id)
-        tpos = self._lnbits.create_user_tpos(data.username, api_key)
-        print("TPOS")
-        print(tpos)
-
-        user = User(
-            username=data.username,
-            hashed_password=password,
-            is_active=True,
-            usr=usr,
-            wallet_id=wallet_id,
-            api_key=api_key,
-            lnurlp=lnurlp,
-            lnurlw=lnurlw,
-            tpos=tpos,
-        )
-        return self._repository.add(user)
-
-    def delete_user_by_id(self, user_id: int) -> None:
-        return self._repository.delete_by_id(user_id)
+    async def create_user(self, data: createUser) -> User:
+        user = await self._repository.find_by_username(data.username)
+        if user:
+            # an unfinished signup is resumed by its owner, anyone else gets rejected
+            if user.is_active or not await self._hasher.verify(data.password, user.hashed_password):  # type: ignore
+                raise Exception("user exists")
+            logger.info(f"resuming account setup for {data.username}")
+            # a resumed signup is not abandoned, whatever the outcome of this attempt
+            user = await self._update(user, updated_at=int(time.time()))
+        else:
+            password = await self._hasher.hash(data.password)
+            # the inactive row reserves the username and records each finished step
+            user = await self._repository.add(User(
+                username=data.username,
+                hashed_password=password,
+                is_active=False,
+            ))
+        return await self.provision_user(user)
+
+    async def provision_user(self, user: User) -> User:
+        username: str = user.username  # type: ignore
+        if not user.api_key:
+            usr, wallet_id, api_key = await self._lnbits.create_user_and_wallet(username)
+            user = await self._update(user, usr=usr, wallet_id=wallet_id, api_key=api_key)
+
+        steps = {}
+        if not user.lnurlp:
+            steps["lnurlp"] = self._lnbits.create_user_lnurlp(username, user.api_key, user.wallet_id)
+        if not user.lnurlw:
+            steps["lnurlw"] = self._lnbits.create_user_lnurlw(username, user.api_key, user.wallet_id)
+        if not user.tpos:
+            steps["tpos"] = self._lnbits.create_user_tpos(username, user.api_key)
+        results = await asyncio.gather(*steps.values(), return_exceptions=True)
+
+        done = {}
+        failed = []
+        for step, result in zip(steps, results):
+            if isinstance(result, BaseException):
+                logger.error(f"account setup step {step} failed for {username}: {result}")
+                failed.append(step)
+            else:
+                done[step] = result
+        if done:
+            user = await self._update(user, **done)
+        if failed:
+            raise Exception(f"account setup incomplete ({', '.join(failed)}), sign up again to resume")
+        return await self._update(user, is_active=True)
+
+    async def remove_abandoned(self, max_age: float) -> int:
+        """ compensates signups that failed and were never resumed
+
+        the lnbits user goes first, together with its wallet and links. the
+        row, and with it the username, is only released once that worked.
+        """
+        removed = 0
+        for user in await self._repository.get_abandoned(int(time.time() - max_age)):
+            try:
+                if user.usr:
+                    await self._lnbits.delete_user(user.usr)  # type: ignore
+                await self._repository.delete_by_id(user.id)  # type: ignore
+            except Exception as exc:
+                logger.error(f"removing abandoned signup of {user.username} failed: {exc!r}")
+                continue
+            self._principals.invalidate(user.username)
+            removed += 1
+        if removed:
+            logger.info(f"removed {removed} abandoned signups")
+        return removed
+
+    async def delete_user_by_id(self, user_id: int) -> None:
+        user = await self._repository.get_by_id(user_id)
+        await self._repository.delete_by_id(user_id)
+        self._principals.invalidate(user.username)
+
+
+class SignupSweeper:
+    """ removes abandoned signups now and then, see UserService.remove_abandoned """
+    def __init__(
+        self,
+        user_service: UserService,
+        event_bus: EventBus,
+        max_age: float | None = None,
+        interval: float | None = None,
+    ) -> None:
+        self._users = user_service
+        self._bus = event_bus
+        self._max_age = max_age or 86400.0
+        self._interval = interval or 3600.0
+        self._task: asyncio.Task | None = None
+        self.removed = 0
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            # the database is shared, one worker sweeps for all of them
+            if self._bus.peers()[0] != self._bus.peer_id:
+                continue
+            try:
+                self.removed += await self._users.remove_abandoned(self._max_age)
+            except Exception as exc:
+                logger.error(f"sweeping abandoned signups failed: {exc!r}")
+
+    def start(self) -> None:
+        if not self._task:
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
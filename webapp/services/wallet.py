@@ -0,0 +1,81 @@
+from sqlalchemy.engine import Row
+
+from webapp.models import UserPrincipal
+from webapp.repositories import PaymentRepository
+from webapp.serializer import RawJSON
+from webapp.services.ledger import LedgerService
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class WalletService:
+    """ balance and payment history of a wallet, served from the local ledger
+
+    lnbits is only asked when a wallet is seen for the first time and by
+    reconciliation, see LedgerService.
+    """
+    def __init__(self, ledger_service: LedgerService, payment_repository: PaymentRepository) -> None:
+        self._ledger = ledger_service
+        self._payments = payment_repository
+
+    def encode(self, rows: list[Row]) -> RawJSON:
+        """ the stored payments are joined as they are, nothing is decoded """
+        return RawJSON(b"[" + b",".join(row.data for row in rows) + b"]")
+
+    async def balance(self, wallet: str) -> float:
+        return await self._payments.balance(wallet) / 1000
+
+    async def sync(self, user: UserPrincipal, cursor: str | None = None, since: int | None = None) -> dict:
+        """ payments added or changed after the client's cursor, the full list when it has none or an unknown one
+
+        the cursor is the seq of the wallet at the last sync, a settled invoice
+        is sent again however old it is.
+        """
+        await self._ledger.ensure_synced(user)
+        wallet = user.wallet_id
+        # read before the payments, a write in between is sent again next time rather than lost
+        last_seq = await self._payments.last_seq(wallet)
+        newer: list[Row] | None = None
+        if cursor is not None:
+            after = await self._seq(wallet, cursor)
+            if after is not None and after <= last_seq:
+                newer = await self._payments.list(wallet, changed_after=after)
+        elif since is not None:
+            newer = await self._payments.list(wallet, since=since)
+        payments = newer if newer is not None else await self._payments.list(wallet)
+        return {
+            "balance": await self.balance(wallet),
+            "payments": self.encode(payments),
+            "cursor": str(last_seq),
+            "delta": newer is not None,
+        }
+
+    async def _seq(self, wallet: str, cursor: str) -> int | None:
+        if cursor.isdecimal() and len(cursor) < 19:
+            return int(cursor)
+        # a payment_hash from a client predating seq cursors
+        anchor = await self._payments.find(wallet, cursor)
+        return anchor.seq if anchor is not None else None
+
+    async def page(self, user: UserPrincipal, before: str | None = None, limit: int = 50) -> dict | None:
+        """ one page of the history, newest first, None for an unknown before cursor """
+        await self._ledger.ensure_synced(user)
+        wallet = user.wallet_id
+        anchor = None
+        if before is not None:
+            anchor = await self._payments.find(wallet, before)
+            if anchor is None:
+                return None
+        rows = await self._payments.list(wallet, before=anchor, limit=limit + 1)
+        chunk = rows[:limit]
+        return {
+            "balance": await self.balance(wallet),
+            "payments": self.encode(chunk),
+            "next": chunk[-1].payment_hash if len(rows) > limit else None,
+            "total": await self._payments.count(wallet),
+        }
+
+    def invalidate(self, user: UserPrincipal) -> None:
+        """ our own action changed the wallet, the ledger catches up in the background """
+        self._ledger.changed(user)
@@ -0,0 +1,47 @@
+import hmac
+
+from webapp.repositories import NotFoundError
+from webapp.services.connections import ConnectionRegistry
+from webapp.services.ledger import LedgerService
+from webapp.services.user import UserService
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class WebhookService:
+    def __init__(
+        self,
+        secret: str,
+        user_service: UserService,
+        ledger_service: LedgerService,
+        connection_registry: ConnectionRegistry,
+    ) -> None:
+        self._secret = secret.encode("utf-8")
+        self._user_service = user_service
+        self._ledger = ledger_service
+        self._registry = connection_registry
+
+    def verify(self, secret: str) -> bool:
+        return hmac.compare_digest(secret.encode("utf-8"), self._secret)
+
+    async def deliver(self, username: str, payments: list[dict]) -> None:
+        try:
+            user = await self._user_service.get_principal(username)
+        except NotFoundError:
+            logger.warning(f"webhook payment for unknown user: {username}")
+            return
+        await self._ledger.record_webhook(user, payments)
+        # confirms the stand ins right away instead of on the next reconciliation
+        self._ledger.changed(user)
+        for payment in payments:
+            self._registry.publish(username, {
+                "type": "payment_received",
+                "data": {
+                    "payment_hash": payment.get("payment_hash"),
+                    "payment_request": payment.get("payment_request"),
+                    "amount": payment.get("amount"),
+                    "comment": payment.get("comment"),
+                    "pending": True,
+                },
+            })
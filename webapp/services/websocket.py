@@ -1,13 +1,29 @@
 import asyncio
+import time
 
 from enum import Enum, auto
 from abc import ABC, abstractmethod
 
-from fastapi import WebSocket, WebSocketDisconnect
-
-from webapp.models import User
+from pydantic import BaseModel, ValidationError
+
+from webapp.models import (
+    Bolt11Payload,
+    InvoicePayload,
+    LnurlpPayload,
+    LnurlwPayload,
+    PaymentsCursorPayload,
+    PaymentsPagePayload,
+    UserPrincipal,
+)
+from webapp.metrics import Metrics
+from webapp.ratelimit import Admission, Overloaded, RateLimited, RateLimiter
+from webapp.serializer import Serializer
+from webapp.services.connections import Connection
 from webapp.services.lnbits import LnbitsService
-from webapp.services.login import LoginService
+from webapp.services.wallet import WalletService
+
+from logging import getLogger
+logger = getLogger(__name__)
 
 
 class WsType(Enum):
@@ -18,18 +34,47 @@ class WsType(Enum):
     create_invoice = auto()
     pay_lnurlp = auto()
     pay_lnurlw = auto()
+    payments = auto()
     unhandled = auto()
 
 
 class WsAction(ABC):
-    def __init__(self, action_type: WsType, lnbits_service: LnbitsService):
+    # actions moving funds run one at a time per connection, in arrival order
+    ordered: bool = False
+    # payload model, validated before execute is called
+    schema: type[BaseModel] | None = None
+    # process wide limit of concurrent executions, None is unlimited
+    concurrency: int | None = None
+    # seconds until the client gets a timeout error, None waits forever
+    timeout: float | None = 10.0
+    # waits on lnbits, counts against the process wide cap of upstream requests
+    upstream: bool = True
+
+    def __init__(self, action_type: WsType, lnbits_service: LnbitsService, wallet_service: WalletService):
         self.type = action_type
         self._lnbits_service = lnbits_service
+        self._wallet_service = wallet_service
+        self._semaphore = asyncio.Semaphore(self.concurrency) if self.concurrency else None
 
     @abstractmethod
-    def execute(self, user: User, data: dict) -> dict:
+    async def execute(self, user: UserPrincipal, data) -> dict:
         """ called when websocket action is dispatched """
 
+    async def run(self, user: UserPrincipal, data) -> dict:
+        if self.schema:
+            try:
+                data = self.schema.parse_obj(data or {})
+            except ValidationError as exc:
+                fields = ", ".join(str(error["loc"][0]) for error in exc.errors())
+                return {"type": "error", "message": f"invalid {fields}"}
+        try:
+            if self._semaphore:
+                async with self._semaphore:
+                    return await asyncio.wait_for(self.execute(user, data), self.timeout)
+            return await asyncio.wait_for(self.execute(user, data), self.timeout)
+        except asyncio.TimeoutError:
+            return {"type": "error", "message": f"{self.type.name} timed out"}
+
     def return_with_type(self, data) -> dict:
         return  {
             "type": self.type.name,
@@ -37,17 +82,24 @@ class WsAction(ABC):
         }
 
 class WsUnhandledAction(WsAction):
-    def execute(self, *_) -> dict:
+    timeout = None
+    upstream = False
+
+    async def execute(self, *_) -> dict:
         return self.return_with_type({"message": "unhandled"})
 
 class WsPingAction(WsAction):
-    def execute(self, *_) -> dict:
+    timeout = None
+    upstream = False
+
+    async def execute(self, *_) -> dict:
         return self.return_with_type({"message": "pong"})
 
 class WsUserAction(WsAction):
-    def execute(self, user: User, _) -> dict:
-        payments = self._lnbits_service.get_payments(user.api_key)
-        balance = self._lnbits_service.get_balance(user.api_key)
+    """ with a cursor only the payments added or changed since are sent, "delta" tells which one the client got """
+    schema = PaymentsCursorPayload
+
+    async def execute(self, user: UserPrincipal, data: PaymentsCursorPayload) -> dict:
         return self.return_with_type({
             "username": user.username,
             "usr": user.usr,
@@ -56,25 +108,41 @@ class WsUserAction(WsAction):
             "lnurlp": user.lnurlp,
             "lnurlw": user.lnurlw,
             "tpos": user.tpos,
-            "payments": payments,
-            "balance": balance,
+            **await self._wallet_service.sync(user, data.cursor, data.since),
         })
 
+class WsPaymentsAction(WsAction):
+    """ delta sync like user, or the full history page by page without a cursor """
+    schema = PaymentsPagePayload
+
+    async def execute(self, user: UserPrincipal, data: PaymentsPagePayload) -> dict:
+        if data.cursor is not None or data.since is not None:
+            return self.return_with_type(await self._wallet_service.sync(user, data.cursor, data.since))
+        page = await self._wallet_service.page(user, data.before, data.limit)
+        if page is None:
+            return {"type": "error", "message": "unknown before cursor"}
+        return self.return_with_type(page)
+
 class WsCreateInvoiceAction(WsAction):
-    def execute(self, user: User, data) -> dict:
-        amount = data.get("amount")
-        if not amount or amount <= 0:
-            return {"type": "error", "message": "invalid amount"}
-        payment_hash, payment_request = self._lnbits_service.create_invoice(user.api_key, amount, str(data.get("description")))
+    schema = InvoicePayload
+
+    async def execute(self, user: UserPrincipal, data: InvoicePayload) -> dict:
+        payment_hash, payment_request = await self._lnbits_service.create_invoice(user.api_key, data.amount, str(data.description))
+        self._wallet_service.invalidate(user)
         return self.return_with_type({
             "invoice": payment_request,
             "payment_hash": payment_hash,
         })
 
 class WsPayAction(WsAction):
-    def execute(self, user: User, data) -> dict:
+    ordered = True
+    schema = Bolt11Payload
+    timeout = 60.0
+
+    async def execute(self, user: UserPrincipal, data: Bolt11Payload) -> dict:
         try:
-            payment_hash = self._lnbits_service.create_payment(user.api_key, data.get("bolt11"))
+            payment_hash = await self._lnbits_service.create_payment(user.api_key, data.bolt11)
+            self._wallet_service.invalidate(user)
             return self.return_with_type({"payment_hash": payment_hash})
         except Exception as exc:
             print("Error: paying invoice")
@@ -82,16 +150,17 @@ class WsPayAction(WsAction):
             return {"type": "error", "message": str(exc) }
 
 class WsInvoiceAction(WsAction):
-    def execute(self, _: User, data) -> dict:
+    schema = Bolt11Payload
+    # lnurl lookups hit third party servers
+    concurrency = 32
+
+    async def execute(self, _: UserPrincipal, data: Bolt11Payload) -> dict:
         try:
-            bolt11 = data.get("bolt11")
-            if not bolt11:
-                raise Exception("no bolt11")
-            invoice = self._lnbits_service.decode_invoice(bolt11)
+            invoice = await self._lnbits_service.decode_invoice(data.bolt11)
             if "payment_hash" in invoice:
                 return self.return_with_type(invoice)
             elif "domain" in invoice:
-                lnurl = self._lnbits_service.decode_lnurl(invoice.get("domain"))
+                lnurl = await self._lnbits_service.decode_lnurl(invoice.get("domain"))
                 return {"type": "lnurl", "data": lnurl}
             else:
                 return {"type": "error", "message": "unhandled"}
@@ -101,30 +170,30 @@ class WsInvoiceAction(WsAction):
 
 
 class WsLnurlpAction(WsAction):
-    def execute(self, user: User, data) -> dict:
+    ordered = True
+    schema = LnurlpPayload
+    timeout = 60.0
+
+    async def execute(self, user: UserPrincipal, data: LnurlpPayload) -> dict:
         try:
-            callback = data.get("callback")
-            amount = data.get("amount")
-            if not callback or not amount:
-                return {"type": "error", "message": "invalid amount or callback"}
-            comment = data.get("comment")
-            bolt11, successMessage = self._lnbits_service.get_lnurl_invoice(callback, amount, comment)
-            payment_hash = self._lnbits_service.create_payment(user.api_key, bolt11)
+            bolt11, successMessage = await self._lnbits_service.get_lnurl_invoice(str(data.callback), data.amount, data.comment)
+            payment_hash = await self._lnbits_service.create_payment(user.api_key, bolt11)
+            self._wallet_service.invalidate(user)
             return {"type": "lnurl_success", "data": { "payment_hash": payment_hash, "message": successMessage }}
         except Exception as exc:
             print(exc)
             return {"type": "error", "message": str(exc) }
 
 class WsLnurlwAction(WsAction):
-    def execute(self, user: User, data) -> dict:
+    ordered = True
+    schema = LnurlwPayload
+    timeout = 60.0
+
+    async def execute(self, user: UserPrincipal, data: LnurlwPayload) -> dict:
         try:
-            callback = data.get("callback")
-            amount = data.get("amount")
-            k1 = data.get("k1")
-            if not callback or not amount or not k1:
-                return {"type": "error", "message": "invalid amount or callback or k1"}
-            payment_hash, payment_request = self._lnbits_service.create_invoice(user.api_key, amount)
-            self._lnbits_service.send_withdraw(callback, k1, payment_request)
+            payment_hash, payment_request = await self._lnbits_service.create_invoice(user.api_key, data.amount)
+            await self._lnbits_service.send_withdraw(str(data.callback), data.k1, payment_request)
+            self._wallet_service.invalidate(user)
             return {"type": "lnurl_success", "data": { "payment_hash": payment_hash, "message": "withdrawn" }}
         except Exception as exc:
             print(exc)
@@ -132,9 +201,16 @@ class WsLnurlwAction(WsAction):
 
 
 class WebSocketDispatcher():
-    def __init__(self, lnbits_service: LnbitsService):
+    """ registry of websocket actions by wire type, built once per process """
+    def __init__(
+        self, lnbits_service: LnbitsService, wallet_service: WalletService, metrics: Metrics, admission: Admission,
+    ):
         self._lnbits_service = lnbits_service
-        self.actions: list[WsAction] = []
+        self._wallet_service = wallet_service
+        self._admission = admission
+        self._latency = metrics.histogram("websocket_action_seconds", "time from dispatch to reply per action", ("action",))
+        self._results = metrics.counter("websocket_actions_total", "dispatched actions per action and result", ("action", "result"))
+        self.actions: dict[str, WsAction] = {}
 
         self.unhandled: WsAction = self.create_action(WsType.unhandled, WsUnhandledAction)
 
@@ -142,74 +218,156 @@ class WebSocketDispatcher():
         self.add_action(WsType.invoice, WsInvoiceAction)
         self.add_action(WsType.create_invoice, WsCreateInvoiceAction)
         self.add_action(WsType.user, WsUserAction)
+        self.add_action(WsType.payments, WsPaymentsAction)
         self.add_action(WsType.pay, WsPayAction)
         self.add_action(WsType.pay_lnurlp, WsLnurlpAction)
         self.add_action(WsType.pay_lnurlw, WsLnurlwAction)
 
     def create_action(self, action_type: WsType, action) -> WsAction:
-        return action(action_type, self._lnbits_service)
+        return action(action_type, self._lnbits_service, self._wallet_service)
 
     def add_action(self, action_type: WsType, action) -> None:
-        self.actions.append(self.create_action(action_type, action))
+        self.actions[action_type.name] = self.create_action(action_type, action)
 
-    def get_action(self, action_type: WsType) -> WsAction:
-        search_action = [action for action in self.actions if action.type.name == action_type]
-        found_action = self.unhandled
-        if len(search_action) > 0:
-            found_action = search_action.pop()
-        return found_action
+    def get_action(self, action_type: str) -> WsAction:
+        if not isinstance(action_type, str):
+            return self.unhandled
+        return self.actions.get(action_type, self.unhandled)
 
-    def dispatch(self, user, action_type: WsType, data) -> dict:
+    async def dispatch(self, user, action_type: str, data) -> dict:
         action = self.get_action(action_type)
-        return action.execute(user, data)
+        start = time.perf_counter()
+        result = "exception"
+        try:
+            if action.upstream:
+                try:
+                    self._admission.acquire_upstream()
+                except Overloaded as exc:
+                    result = "shed"
+                    return {"type": "error", "code": "busy", "message": str(exc), "retry_after": exc.retry_after}
+            try:
+                reply = await action.run(user, data)
+            finally:
+                if action.upstream:
+                    self._admission.release_upstream()
+            result = "error" if reply.get("type") == "error" else "ok"
+            return reply
+        except asyncio.CancelledError:
+            # the client went away
+            result = "cancelled"
+            raise
+        finally:
+            self._latency.labels(action.type.name).observe(time.perf_counter() - start)
+            self._results.labels(action.type.name, result).inc()
 
 
 class WebSocketService():
-    def __init__(self, login_service: LoginService, lnbits_service: LnbitsService):
-        self._login_service = login_service
-        self._lnbits_service = lnbits_service
-        self.queue: asyncio.Queue = asyncio.Queue()
-        self.tasks: list = []
-        self.dispatcher = WebSocketDispatcher(lnbits_service)
-        self.user: None | User = None
-
-    async def handle_websocket_message(self, websocket: WebSocket, data):
+    """ runs the actions of every connection of this process
+
+    a frame holds one action, or an array of up to MAX_BATCH actions. actions
+    run concurrently and reply as they finish, an "id" on the action is echoed
+    on its reply so clients can pipeline requests. a connection runs up to
+    concurrency actions at once, beyond that its frames stay unread. actions
+    over the rate limits of their user or address are answered right away.
+    """
+    MAX_BATCH = 32
+
+    def __init__(
+        self,
+        dispatcher: WebSocketDispatcher,
+        serializer: Serializer,
+        metrics: Metrics,
+        rate_limiter: RateLimiter,
+        concurrency: int | None = None,
+    ):
+        self._serializer = serializer
+        self._limiter = rate_limiter
+        self._concurrency = concurrency or 4
+        self._saturated = metrics.counter(
+            "websocket_saturated_total", "actions that waited for a free slot of their connection",
+        )
+        self.dispatcher = dispatcher
+
+    async def send(self, connection: Connection, message: dict):
+        await connection.websocket.send_text(self._serializer.dumps_text(message))
+
+    def reply(self, data, message: dict) -> dict:
+        """ echoes the request id, pipelining clients match replies to requests by it """
+        if isinstance(data, dict) and "id" in data:
+            return {**message, "id": data["id"]}
+        return message
+
+    async def handle_websocket_message(self, connection: Connection, data):
+        if not isinstance(data, dict):
+            await self.send(connection, {"type": "error", "message": "invalid message"})
+            return
         print("handle_websocket_message")
         print(data.get("type"))
-        if self.user:
-            action_data = self.dispatcher.dispatch(self.user, data.get("type"), data.get("data"))
-            await websocket.send_json(action_data)
-
-    async def start_listener(self, websocket: WebSocket, token: str):
-        self.user = await self._login_service.user(token)
-        task_read = asyncio.create_task(self.read_from_socket(websocket))
-        task_send = asyncio.create_task(self.get_data_and_send(websocket))
-        self.tasks.append(task_read)
-        self.tasks.append(task_send)
-        task = asyncio.gather(task_read, task_send)
+        if "id" in data and (not isinstance(data["id"], (str, int)) or isinstance(data["id"], bool)):
+            await self.send(connection, {"type": "error", "message": "invalid id"})
+            return
+        action_type = data.get("type")
+        if self.dispatcher.get_action(action_type).ordered:
+            if connection.ordered is None:
+                connection.ordered = asyncio.Lock()
+            async with connection.ordered:
+                action_data = await self.dispatcher.dispatch(connection.user, action_type, data.get("data"))
+        else:
+            action_data = await self.dispatcher.dispatch(connection.user, action_type, data.get("data"))
+        await self.send(connection, self.reply(data, action_data))
+
+    async def run_action(self, connection: Connection, data):
         try:
-            await task
-        except:
-            raise
+            await self.handle_websocket_message(connection, data)
+        except Exception:
+            logger.exception("error handling websocket message")
+            try:
+                await self.send(connection, self.reply(data, {"type": "error", "message": "internal error"}))
+            except Exception:
+                pass
         finally:
-            task.cancel()
+            connection.slots.release()  # type: ignore
 
-        return task
-
-
-    async def cancel_listener(self):
-        print("cancels websocket")
-        for task in self.tasks:
-            task.cancel()
-
-    async def read_from_socket(self, websocket: WebSocket):
-        async for data in websocket.iter_json():
-            self.queue.put_nowait(data)
-
-    async def get_data_and_send(self, websocket: WebSocket):
-        while True:
-            if self.queue.empty():
-                await asyncio.sleep(1)
-            else:
-                data = self.queue.get_nowait()
-                await self.handle_websocket_message(websocket, data)
+    def limit(self, connection: Connection, data) -> dict | None:
+        """ the error reply for an action over its rate limit, before it waits for anything """
+        if not isinstance(data, dict):
+            return None
+        action = self.dispatcher.get_action(data.get("type")).type.name
+        try:
+            self._limiter.take("user", action, connection.user.username)
+            self._limiter.take("ip", action, connection.ip)
+        except RateLimited as exc:
+            return self.reply(data, {
+                "type": "error", "code": "rate_limited", "message": str(exc), "retry_after": exc.retry_after,
+            })
+        return None
+
+    async def start_action(self, connection: Connection, data):
+        limited = self.limit(connection, data)
+        if limited:
+            await self.send(connection, limited)
+            return
+        if connection.slots is None:
+            connection.slots = asyncio.Semaphore(self._concurrency)
+        if connection.slots.locked():
+            self._saturated.inc()
+        # a flooding client waits here, its frames stay in the socket instead of growing memory
+        await connection.slots.acquire()
+        connection.spawn(self.run_action(connection, data))
+
+    async def listen(self, connection: Connection):
+        """ reads frames until the client goes away """
+        async for text in connection.websocket.iter_text():
+            try:
+                data = self._serializer.loads(text)
+            except ValueError:
+                await self.send(connection, {"type": "error", "message": "invalid json"})
+                continue
+            if not isinstance(data, list):
+                await self.start_action(connection, data)
+                continue
+            if not 0 < len(data) <= self.MAX_BATCH:
+                await self.send(connection, {"type": "error", "message": f"a batch holds 1 to {self.MAX_BATCH} actions"})
+                continue
+            for message in data:
+                await self.start_action(connection, message)
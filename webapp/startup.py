@@ -0,0 +1,46 @@
+"""Startup report module."""
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import webapp
+
+logger = logging.getLogger("uvicorn")
+
+
+class StartupReport:
+    """ how long this process took from importing the package to serving
+
+    forked workers inherit the modules the supervisor imported, their import
+    time is the supervisor's and they are marked as preloaded.
+    """
+    def __init__(self, imported: float) -> None:
+        self.started = time.perf_counter()
+        self.imports = imported - webapp.IMPORT_STARTED
+        self.preloaded = os.getpid() != webapp.IMPORT_PID
+        self.phases: dict[str, float] = {}
+        self.ready: float | None = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def done(self) -> None:
+        self.ready = time.perf_counter() - self.started
+        phases = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases.items())
+        imports = "preloaded" if self.preloaded else f"{self.imports * 1000:.0f}ms"
+        logger.info(f"ready in {self.ready * 1000:.0f}ms, imports {imports}, {phases}")
+
+    def stats(self) -> dict:
+        return {
+            "imports": round(self.imports, 4),
+            "preloaded": self.preloaded,
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "ready": None if self.ready is None else round(self.ready, 4),
+        }